@@ -0,0 +1,355 @@
+'''Micro-benchmarks of game_management hot paths. Each benchmark reports
+wall time and Redis round trips and commands per operation, and compares
+them with the baselines tracked in benchmarks/baselines.json. Run it with
+"python3 -m benchmarks.bench_hot_paths [NAME_PREFIX ...] [--save] [--check]"
+against the local Redis (db of TestingConfig) or with --fake against an
+in-memory fakeredis server (pip install fakeredis lupa, not required by
+the app).
+
+Round trips and commands are deterministic, so any change of them is a
+regression or an improvement to be explained in review. Wall time is only
+compared with --tolerance. The tracked baselines were saved against a local
+Redis 6.2, not --fake.'''
+from hydraChess.__main__ import app  # Patches the standard library first
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from uuid import uuid4
+import argparse
+import json
+import os
+import sys
+from chess import Move
+import rom.util
+from hydraChess.config import TestingConfig
+from hydraChess.game_management import get_game_info_data, search_game
+from hydraChess.models import User, Game, compute_rating_changes
+from hydraChess.board_cache import board_cache
+from hydraChess.entity_session import counters
+from hydraChess.settlement import settle_game
+from hydraChess import entity_session, game_history, leaderboard, \
+    matchmaking, timers
+from benchmarks.bench_move_latency import random_moves
+
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), 'baselines.json')
+
+SECONDS = 7777  # Time control of benchmark games, nobody else plays it
+
+# Operation, and reset run before each round untimed and uncounted
+Case = Tuple[Callable[[], object], Optional[Callable[[], object]]]
+
+BENCHMARKS: Dict[str, Callable[[], Iterator[Case]]] = {}
+
+
+def benchmark(name: str):
+    '''Registers the generator function, which sets up fixtures, yields
+       the case and cleans up afterwards'''
+    def decorator(func):
+        BENCHMARKS[name] = contextmanager(func)
+        return func
+    return decorator
+
+
+class Fixtures:
+    '''Users and games created by a benchmark, deleted with cleanup()'''
+
+    def __init__(self):
+        self.users = []
+        self.games = []
+
+    def user(self, rating: int = 1200) -> User:
+        user = User(login=f'bench_{uuid4().hex[:14]}', rating=rating)
+        user.save()
+        self.users.append(user)
+        return user
+
+    def game(self, plies: int = 0) -> Game:
+        white_user, black_user = self.user(), self.user()
+        game = Game(white_user=white_user, black_user=black_user,
+                    white_rating=1200, black_rating=1200, is_started=1)
+        game.rating_changes = compute_rating_changes(1200, 40, 1200, 40)
+        game.total_clock = timedelta(seconds=SECONDS)
+        game.white_clock = timedelta(seconds=SECONDS)
+        game.black_clock = timedelta(seconds=SECONDS)
+        game.save()
+        board = game.get_board()
+        for move_san in random_moves(plies):
+            game.push_san(board, move_san)
+        game.last_move_datetime = datetime.utcnow()
+        game.save()
+        self.games.append(game)
+        return game
+
+    def cleanup(self) -> None:
+        conn = rom.util.get_connection()
+        for game in self.games:
+            game.delete()
+        for user in self.users:
+            conn.zrem(leaderboard.board_key(), user.id)
+            conn.zrem(leaderboard.board_key(SECONDS), user.id)
+            conn.delete(*[game_history.history_key(user.id, outcome, seconds)
+                          for outcome in (None, ) + game_history.OUTCOMES
+                          for seconds in (None, SECONDS)])
+            user.delete()
+
+
+@contextmanager
+def fixtures() -> Iterator[Fixtures]:
+    created = Fixtures()
+    try:
+        yield created
+    finally:
+        created.cleanup()
+
+
+def register_get_board(plies: int) -> None:
+    @benchmark(f'get_board cold {plies} plies')
+    def get_board_cold():
+        with fixtures() as created:
+            game_id = created.game(plies).id
+            yield (lambda: Game.get(game_id).get_board(),
+                   lambda: board_cache.discard(game_id))
+
+    @benchmark(f'get_board cached {plies} plies')
+    def get_board_cached():
+        with fixtures() as created:
+            game = created.game(plies)
+            yield game.get_board, None
+
+
+for plies in (0, 40, 200):
+    register_get_board(plies)
+
+
+@benchmark('Game.moves 80 plies')
+def game_moves():
+    with fixtures() as created:
+        game_id = created.game(80).id
+        yield lambda: Game.get(game_id).moves, None
+
+
+@benchmark('append_move and save')
+def append_move():
+    # Knights go forth and back, so the moves stay legal
+    moves = [Move.from_uci(uci) for uci in ('g1f3', 'g8f6', 'f3g1', 'f6g8')]
+    with fixtures() as created:
+        game = created.game()
+
+        def append_and_save():
+            game.append_move(moves[game.get_moves_cnt() % 4])
+            game.save()
+        yield append_and_save, None
+
+
+@benchmark('clocks set, save and load')
+def clocks():
+    with fixtures() as created:
+        game = created.game()
+
+        def set_save_and_load():
+            game.white_clock -= timedelta(milliseconds=1)
+            game.black_clock -= timedelta(milliseconds=1)
+            game.save()
+            loaded = Game.get(game.id)
+            return loaded.white_clock, loaded.black_clock
+        yield set_save_and_load, None
+
+
+def register_search_game(waiting: int) -> None:
+    @benchmark(f'search_game {waiting} waiting')
+    def search_game_waiting():
+        # Waiting seeks are out of the searcher's rating window, so the
+        # search is added to the order book and cancelled after each round
+        waiting_ids = range(-waiting, 0)
+        for user_id in waiting_ids:
+            matchmaking.pair_or_seek(user_id, 1000 + user_id % 1000, SECONDS,
+                                     matchmaking.new_search_token(user_id))
+        try:
+            with fixtures() as created:
+                user = created.user(rating=3000)
+                tokens = []
+
+                def cancel_and_request():
+                    cancel(user.id)
+                    tokens.append(matchmaking.new_search_token(user.id))
+                yield (lambda: search_game(user.id, SECONDS, tokens[-1]),
+                       cancel_and_request)
+                cancel(user.id)
+                delete_search_tokens([user.id])
+        finally:
+            for user_id in waiting_ids:
+                cancel(user_id)
+            delete_search_tokens(waiting_ids)
+            timers.cancel(timers.match_seeks_timer(SECONDS))
+
+
+def cancel(user_id: int) -> None:
+    matchmaking.cancel_seek(user_id, matchmaking.new_search_token(user_id))
+
+
+def delete_search_tokens(user_ids) -> None:
+    keys = [matchmaking.search_token_key(user_id) for user_id in user_ids]
+    if keys:
+        rom.util.get_connection().delete(*keys)
+
+
+for waiting in (0, 100, 1000):
+    register_search_game(waiting)
+
+
+@benchmark('get_rating_changes')
+def rating_changes():
+    yield lambda: compute_rating_changes(1500, 20, 1450, 40), None
+
+
+@benchmark('Game.rating_changes')
+def game_rating_changes():
+    with fixtures() as created:
+        game = created.game()
+        yield lambda: game.rating_changes, None
+
+
+@benchmark('send_game_info payload player')
+def game_info_player():
+    with fixtures() as created:
+        game = created.game(40)
+        game_id, user_id = game.id, game.white_user.id
+        yield lambda: get_game_info_data(game_id, user_id), None
+
+
+@benchmark('send_game_info payload spectator')
+def game_info_spectator():
+    with fixtures() as created:
+        game_id = created.game(40).id
+        yield lambda: get_game_info_data(game_id), None
+
+
+@benchmark('end_game settlement')
+def settlement():
+    with fixtures() as created:
+        games = []
+
+        def make_game():
+            games.append(created.game(2))
+        yield (lambda: settle_game(games[-1], '1-0', True, True),
+               make_game)
+
+
+def measure(case: Case, rounds: int) -> dict:
+    '''Runs the case. Returns mean and best wall time in microseconds,
+       round trips and commands per operation.'''
+    op, reset = case
+    timings = []
+    round_trips = commands = 0
+    for _ in range(rounds):
+        if reset is not None:
+            reset()
+        start_round_trips, start_commands = \
+            counters.round_trips, counters.commands
+        start = perf_counter()
+        op()
+        timings.append(perf_counter() - start)
+        round_trips += counters.round_trips - start_round_trips
+        commands += counters.commands - start_commands
+
+    return {'mean_us': sum(timings) / rounds * 10 ** 6,
+            'best_us': min(timings) * 10 ** 6,
+            'round_trips': round_trips / rounds,
+            'commands': commands / rounds}
+
+
+def compare(result: dict, baseline: Optional[dict],
+            tolerance: Optional[float]) -> List[str]:
+    '''Returns regressions of the result against the baseline'''
+    if baseline is None:
+        return []
+    regressions = [f"{key} {baseline[key]:g} -> {result[key]:g}"
+                   for key in ('round_trips', 'commands')
+                   if result[key] > baseline[key]]
+    if tolerance is not None and \
+            result['best_us'] > baseline['best_us'] * (1 + tolerance):
+        regressions.append(f"best {baseline['best_us']:.1f} -> "
+                           f"{result['best_us']:.1f} us")
+    return regressions
+
+
+def load_baselines() -> dict:
+    if not os.path.exists(BASELINES_PATH):
+        return {}
+    with open(BASELINES_PATH) as baselines_file:
+        return json.load(baselines_file)
+
+
+def save_baselines(results: dict) -> None:
+    baselines = load_baselines()
+    baselines.update(results)
+    with open(BASELINES_PATH, 'w') as baselines_file:
+        json.dump(baselines, baselines_file, indent=2, sort_keys=True)
+        baselines_file.write('\n')
+
+
+def use_fake_redis() -> None:
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit('--fake requires fakeredis and lupa to be installed')
+    entity_session.set_connection_settings(
+        connection_pool=fakeredis.FakeStrictRedis().connection_pool)
+
+
+def run(names: List[str], rounds: int, tolerance: Optional[float]
+        ) -> Tuple[dict, int]:
+    '''Runs benchmarks, whose names start with any of the names.
+       Returns results and count of regressions.'''
+    baselines = load_baselines()
+    results = {}
+    regressions_cnt = 0
+
+    print(f"{'benchmark':<36}{'mean us':>11}{'best us':>11}"
+          f"{'trips':>7}{'cmds':>7}")
+    for name, bench in BENCHMARKS.items():
+        if names and not any(name.startswith(prefix) for prefix in names):
+            continue
+        with app.app_context(), bench() as case:
+            result = measure(case, rounds)
+        results[name] = result
+
+        regressions = compare(result, baselines.get(name), tolerance)
+        regressions_cnt += len(regressions)
+        print(f"{name:<36}{result['mean_us']:>11.1f}"
+              f"{result['best_us']:>11.1f}{result['round_trips']:>7g}"
+              f"{result['commands']:>7g}", end='')
+        print(f"  REGRESSED {', '.join(regressions)}" if regressions else '')
+    return results, regressions_cnt
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark game_management hot paths')
+    parser.add_argument('names', nargs='*',
+                        help='prefixes of benchmark names, all by default')
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--fake', action='store_true',
+                        help='use in-memory fakeredis instead of Redis')
+    parser.add_argument('--save', action='store_true',
+                        help='save the results as baselines')
+    parser.add_argument('--check', action='store_true',
+                        help='exit with 1 if there are regressions')
+    parser.add_argument('--tolerance', type=float,
+                        help='allowed relative growth of the best time, '
+                             'it is not compared by default')
+    args = parser.parse_args()
+
+    if args.fake:
+        use_fake_redis()
+    else:
+        entity_session.set_connection_settings(db=TestingConfig.REDIS_DB_ID)
+    rom.util.use_null_session()
+
+    results, regressions_cnt = run(args.names, args.rounds, args.tolerance)
+    if args.save:
+        save_baselines(results)
+    if args.check and regressions_cnt:
+        sys.exit(1)
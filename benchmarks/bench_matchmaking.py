@@ -0,0 +1,38 @@
+'''Benchmark of batch pairing. Run it with
+"python3 -m benchmarks.bench_matchmaking [SEEKS]"'''
+from random import gauss, random, seed
+from time import perf_counter
+import sys
+from hydraChess.matchmaking import pair_seeks
+
+
+def make_seeks(count: int) -> list:
+    seeks = [(user_id, int(gauss(1500, 300)), random() * 60)
+             for user_id in range(count)]
+    seeks.sort(key=lambda seek: seek[1])
+    return seeks
+
+
+def run(count: int = 10000, rounds: int = 10) -> None:
+    seed(0)
+    seeks = make_seeks(count)
+
+    timings = []
+    for _ in range(rounds):
+        start = perf_counter()
+        pairs = pair_seeks(seeks)
+        timings.append(perf_counter() - start)
+
+    paired = {user_id for pair in pairs for user_id in pair}
+    ratings = dict((user_id, rating) for user_id, rating, _ in seeks)
+    total_diff = sum(abs(ratings[a] - ratings[b]) for a, b in pairs)
+
+    print(f"{count} seeks: {len(pairs)} pairs, "
+          f"{count - len(paired)} unpaired, "
+          f"mean difference {total_diff / max(len(pairs), 1):.1f}")
+    print(f"best {min(timings) * 1000:.2f} ms, "
+          f"mean {sum(timings) / rounds * 1000:.2f} ms")
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
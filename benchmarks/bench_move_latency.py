@@ -0,0 +1,101 @@
+'''Latency of moves from the socket handler to the published game_updated
+event, with moves made by Celery workers and inline. Run it with
+"python3 -m benchmarks.bench_move_latency [MOVES] [--mode celery|inline]".
+The celery mode needs running game workers, see scripts/run_high.sh. Start
+them with --without-mingle, or wait until they are ready, because tasks
+sent meanwhile are delayed by the worker startup.'''
+from hydraChess.__main__ import app  # Patches the standard library first
+from datetime import timedelta
+from random import choice, seed
+from time import perf_counter
+from uuid import uuid4
+import argparse
+import pickle
+from chess import Board
+import rom.util
+from hydraChess.game_management import execute_move, make_move
+from hydraChess.models import User, Game
+from hydraChess import timers
+
+
+# Channel of the Socket.IO message queue, Flask-SocketIO's default
+SOCKETIO_CHANNEL = 'flask-socketio'
+
+
+def random_moves(count: int) -> list:
+    '''Returns SAN of random legal moves, which don't end the game'''
+    seed(0)
+    board = Board()
+    moves = []
+    while len(moves) < count:
+        move = choice(list(board.legal_moves))
+        move_san = board.san(move)
+        board.push(move)
+        if board.is_game_over():
+            board.pop()
+            continue
+        moves.append(move_san)
+    return moves
+
+
+def wait_game_updated(pubsub, game_id: int) -> None:
+    for message in pubsub.listen():
+        if message['type'] != 'message':
+            continue
+        data = pickle.loads(message['data'])
+        if data.get('event') == 'game_updated' and \
+                data.get('room') == game_id:
+            return
+
+
+def run(moves_cnt: int, mode: str) -> None:
+    white_user = User(login=uuid4().hex[:15])
+    white_user.save()
+    black_user = User(login=uuid4().hex[:15])
+    black_user.save()
+    game = Game(white_user=white_user, black_user=black_user,
+                white_rating=1200, black_rating=1200, is_started=1)
+    game.total_clock = timedelta(hours=1)
+    game.white_clock = timedelta(hours=1)
+    game.black_clock = timedelta(hours=1)
+    game.save()
+
+    pubsub = rom.util.get_connection().pubsub()
+    pubsub.subscribe(SOCKETIO_CHANNEL)
+
+    timings = []
+    try:
+        for i, move_san in enumerate(random_moves(moves_cnt)):
+            user_id = (white_user, black_user)[i % 2].id
+            start = perf_counter()
+            if mode == 'inline':
+                execute_move(user_id, game.id, move_san)
+            else:
+                make_move.delay(user_id, game.id, move_san)
+            wait_game_updated(pubsub, game.id)
+            timings.append(perf_counter() - start)
+    finally:
+        pubsub.close()
+        timers.cancel(timers.first_move_timer(game.id),
+                      timers.time_is_up_timer(game.id))
+        Game.get(game.id).delete()
+        white_user.delete()
+        black_user.delete()
+
+    timings.sort()
+    print(f"{mode}: {len(timings)} moves, "
+          f"median {timings[len(timings) // 2] * 1000:.2f} ms, "
+          f"p95 {timings[int(len(timings) * 0.95)] * 1000:.2f} ms, "
+          f"mean {sum(timings) / len(timings) * 1000:.2f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark move latency')
+    parser.add_argument('moves', nargs='?', type=int, default=100)
+    parser.add_argument('--mode', choices=('celery', 'inline'),
+                        action='append', help='both modes by default')
+    args = parser.parse_args()
+
+    with app.app_context():
+        for mode in args.mode or ('inline', 'celery'):
+            run(args.moves, mode)
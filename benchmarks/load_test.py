@@ -0,0 +1,361 @@
+'''Load test of a running deployment over Socket.IO. Simulated players
+search games, play random legal moves, offer draws and resign through the
+same events as the browser client, while spectators watch their games.
+Run the app and the workers (scripts/run_all_tmux.sh), then run it with
+"python3 -m benchmarks.load_test --players 1000 --spectators 2 --minutes 5"
+on the host of the local Redis, which the app uses.
+
+Users are created in Redis and signed in with session cookies made by the
+app, because /register and /sign_in admit few attempts per IP. They are
+deleted with their games at the end of the run.'''
+from hydraChess.__main__ import app  # Patches the standard library first
+from collections import defaultdict
+from random import choice, random
+from time import perf_counter
+from typing import List, Optional, Tuple
+from uuid import uuid4
+import argparse
+import json
+import gevent
+from gevent.queue import Empty, Queue
+import chess
+import rom.util
+import socketio
+from flask import session
+from flask_login import login_user
+from hydraChess.models import User, Game
+from hydraChess import game_history, leaderboard
+
+
+# Events of the server, which simulated clients react to
+EVENTS = ('redirect', 'game_started', 'game_updated', 'move_rejected',
+          'draw_offer', 'game_ended')
+
+
+class Stats:
+    '''Latencies in seconds, attempts and errors of each kind of request'''
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.attempts = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.counts = defaultdict(int)
+
+    def attempt(self, kind: str) -> None:
+        self.attempts[kind] += 1
+
+    def timing(self, kind: str, seconds: float) -> None:
+        self.latencies[kind].append(seconds)
+
+    def error(self, kind: str) -> None:
+        self.errors[kind] += 1
+
+    def count(self, kind: str) -> None:
+        self.counts[kind] += 1
+
+    def to_dict(self) -> dict:
+        report = {}
+        for kind in sorted(set(self.attempts) | set(self.latencies)):
+            latencies = sorted(self.latencies[kind])
+            report[kind] = {
+                'attempts': self.attempts[kind],
+                'errors': self.errors[kind],
+                'error_rate': self.errors[kind] / max(self.attempts[kind], 1),
+            }
+            for q in (50, 95, 99):
+                report[kind][f'p{q}_ms'] = \
+                    percentile(latencies, q) * 1000 if latencies else None
+        report['counts'] = dict(self.counts)
+        return report
+
+
+def percentile(values: List[float], q: float) -> float:
+    '''Nearest-rank percentile of sorted values'''
+    return values[min(int(len(values) * q / 100), len(values) - 1)]
+
+
+def make_session_cookie(user: User) -> str:
+    '''Returns Cookie header of the signed in user's session'''
+    with app.test_request_context():
+        login_user(user)
+        response = app.response_class()
+        app.session_interface.save_session(app, session, response)
+    return response.headers['Set-Cookie'].split(';', 1)[0]
+
+
+class Client:
+    '''Socket.IO connection, which queues received events'''
+
+    def __init__(self, url: str, stats: Stats, timeout: float,
+                 cookie: Optional[str] = None):
+        self.url = url
+        self.stats = stats
+        self.timeout = timeout
+        self.cookie = cookie
+        self.events = Queue()
+        self.sio = None
+
+    def connect(self, game_id: Optional[int] = None,
+                kind: str = 'connect') -> bool:
+        self.sio = socketio.Client(reconnection=False)
+        for event in EVENTS:
+            self.sio.on(event, self._make_handler(event))
+
+        url = self.url if game_id is None else f'{self.url}/?game_id={game_id}'
+        headers = {'Cookie': self.cookie} if self.cookie else {}
+        self.stats.attempt(kind)
+        start = perf_counter()
+        try:
+            self.sio.connect(url, headers=headers)
+        except socketio.exceptions.ConnectionError:
+            self.stats.error(kind)
+            return False
+        self.stats.timing(kind, perf_counter() - start)
+        return True
+
+    def _make_handler(self, event: str):
+        def handler(*args):
+            self.events.put((event, args[0] if args else None, perf_counter()))
+        return handler
+
+    def emit(self, event: str, data: Optional[dict] = None) -> None:
+        self.sio.emit(event, data)
+
+    def wait(self, *events: str, timeout: Optional[float] = None
+             ) -> Optional[Tuple[str, Optional[dict], float]]:
+        '''Returns (event, data, receive time) of the first of the events or
+           of 'game_ended'. Draw offers are accepted meanwhile. Returns None
+           on timeout.'''
+        deadline = perf_counter() + (timeout or self.timeout)
+        while True:
+            try:
+                event = self.events.get(
+                    timeout=max(deadline - perf_counter(), 0))
+            except Empty:
+                return None
+            if event[0] in events or event[0] == 'game_ended':
+                return event
+            if event[0] == 'draw_offer':
+                self.emit('accept_draw_offer')
+
+    def disconnect(self) -> None:
+        if self.sio is not None:
+            self.sio.disconnect()
+            self.sio = None
+        self.events = Queue()
+
+
+class Player(Client):
+    def __init__(self, user: User, options: argparse.Namespace,
+                 stats: Stats):
+        super().__init__(options.url, stats, options.timeout,
+                         make_session_cookie(user))
+        self.user = user
+        self.options = options
+        self.game_ids = []
+
+    def search(self, minutes: int) -> Optional[int]:
+        '''Searches a game from the lobby. Returns id of the game.'''
+        if not self.connect():
+            return None
+
+        self.stats.attempt('pairing')
+        start = perf_counter()
+        self.emit('search_game', {'minutes': minutes})
+        event = self.wait('redirect', timeout=self.options.pairing_timeout)
+        # The browser leaves the lobby for the game page
+        self.disconnect()
+        if event is None or event[0] != 'redirect':
+            self.stats.error('pairing')
+            return None
+        self.stats.timing('pairing', event[2] - start)
+        return int(event[1]['url'].rsplit('/', 1)[1])
+
+    def play(self, game_id: int) -> None:
+        self.game_ids.append(game_id)
+        if not self.connect(game_id):
+            return
+        try:
+            self._play(game_id)
+        finally:
+            self.disconnect()
+
+    def _play(self, game_id: int) -> None:
+        self.stats.attempt('game')
+        event = self.wait('game_started')
+        if event is None or event[0] != 'game_started':
+            self.stats.error('game')
+            return
+        data = event[1]
+        color = chess.WHITE if data.get('color') == 'w' else chess.BLACK
+        board = chess.Board()
+        for san in filter(None, data['moves'].split(',')):
+            board.push_san(san)
+
+        if color == chess.WHITE:
+            for _ in range(self.options.spectators):
+                gevent.spawn(watch, game_id, self.options, self.stats)
+
+        while not board.is_game_over():
+            if board.turn != color:
+                event = self.wait('game_updated')
+            elif board.ply() >= self.options.max_plies:
+                self.emit('resign' if random() < 0.5 else 'make_draw_offer')
+                break
+            else:
+                gevent.sleep(random() * self.options.think_time)
+                san = board.san(choice(list(board.legal_moves)))
+                self.stats.attempt('move')
+                start = perf_counter()
+                self.emit('make_move', {'san': san, 'game_id': game_id})
+                event = self.wait('game_updated', 'move_rejected')
+                if event is None or event[0] == 'move_rejected':
+                    self.stats.error('move')
+                elif event[0] == 'game_updated':
+                    self.stats.timing('move', event[2] - start)
+
+            if event is None or event[0] == 'move_rejected':
+                # Stalled or out of sync, the game is freed for the others
+                self.emit('resign')
+            if event is None or event[0] != 'game_updated':
+                break
+            board.push_san(event[1]['san'])
+
+        if event is None or event[0] != 'game_ended':
+            event = self.wait('game_ended')
+        if event is None:
+            self.stats.error('game')
+        else:
+            self.stats.count(f"result {event[1]['result']}")
+
+
+def watch(game_id: int, options: argparse.Namespace, stats: Stats) -> None:
+    '''Spectator of the game, which is anonymous like in the browser'''
+    client = Client(options.url, stats, options.timeout)
+    start = perf_counter()
+    if not client.connect(game_id, kind='spectator_connect'):
+        return
+    try:
+        stats.attempt('spectator_info')
+        event = client.wait('game_started')
+        if event is None or event[0] != 'game_started':
+            stats.error('spectator_info')
+            return
+        stats.timing('spectator_info', event[2] - start)
+
+        while event is not None and event[0] != 'game_ended':
+            event = client.wait('game_updated')
+            if event is not None and event[0] == 'game_updated':
+                stats.count('spectator_updates')
+    finally:
+        client.disconnect()
+
+
+def run_player(player: Player, minutes: int, games: int) -> None:
+    for _ in range(games):
+        game_id = player.search(minutes)
+        if game_id is not None:
+            player.play(game_id)
+
+
+def create_users(count: int) -> List[User]:
+    users = []
+    for _ in range(count):
+        user = User(login=f'load_{uuid4().hex[:15]}')
+        user.save()
+        users.append(user)
+    return users
+
+
+def delete_users(users: List[User], game_ids: List[int],
+                 minutes: List[int]) -> None:
+    '''Deletes the users, their games, ranks and histories'''
+    for game_id in set(game_ids):
+        game = Game.get(game_id)
+        if game is not None:
+            game.delete()
+
+    conn = rom.util.get_connection()
+    board_keys = [leaderboard.board_key()] + \
+        [leaderboard.board_key(m * 60) for m in minutes]
+    for user in users:
+        for key in board_keys:
+            conn.zrem(key, user.id)
+        conn.delete(*[game_history.history_key(user.id, outcome, seconds)
+                      for outcome in (None, ) + game_history.OUTCOMES
+                      for seconds in [None] + [m * 60 for m in minutes]])
+        user.delete()
+
+
+def run(options: argparse.Namespace) -> dict:
+    '''Runs the load test. Returns the report of Stats.to_dict().'''
+    stats = Stats()
+    with app.app_context():
+        users = create_users(options.players)
+    players = [Player(user, options, stats) for user in users]
+
+    start = perf_counter()
+    try:
+        # Both players of a pair search the same time control
+        gevent.joinall([
+            gevent.spawn(run_player, player,
+                         options.minutes[i // 2 % len(options.minutes)],
+                         options.games)
+            for i, player in enumerate(players)])
+    finally:
+        with app.app_context():
+            delete_users(users, [game_id for player in players
+                                 for game_id in player.game_ids],
+                         options.minutes)
+
+    report = stats.to_dict()
+    report['duration_s'] = perf_counter() - start
+    return report
+
+
+def print_report(report: dict) -> None:
+    def fmt(value: Optional[float]) -> str:
+        return '-' if value is None else f'{value:.2f}'
+
+    print(f"{'kind':<18}{'attempts':>9}{'errors':>8}{'rate':>8}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind, row in report.items():
+        if not isinstance(row, dict) or kind == 'counts':
+            continue
+        print(f"{kind:<18}{row['attempts']:>9}{row['errors']:>8}"
+              f"{row['error_rate']:>8.2%}{fmt(row['p50_ms']):>10}"
+              f"{fmt(row['p95_ms']):>10}{fmt(row['p99_ms']):>10}")
+    for kind, count in sorted(report['counts'].items()):
+        print(f"{kind}: {count}")
+    print(f"duration {report['duration_s']:.1f} s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load test a running deployment over Socket.IO')
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--players', type=int, default=100,
+                        help='even number, players are paired')
+    parser.add_argument('--spectators', type=int, default=0,
+                        help='spectators per game')
+    parser.add_argument('--minutes', type=int, nargs='+', default=[5],
+                        choices=(1, 2, 3, 5, 10, 20, 30, 60),
+                        help='time controls, assigned to pairs in turn')
+    parser.add_argument('--games', type=int, default=1,
+                        help='games played by each player one by one')
+    parser.add_argument('--max-plies', type=int, default=80,
+                        help='the game is resigned or drawn after it')
+    parser.add_argument('--think-time', type=float, default=0.5,
+                        help='max seconds before a move, random')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='seconds to wait for an event')
+    parser.add_argument('--pairing-timeout', type=float, default=60)
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as JSON')
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
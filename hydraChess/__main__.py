@@ -1,14 +1,11 @@
 from gevent import monkey
 monkey.patch_all()
 
-import os
+import atexit
 import sys
-import uuid
-from io import BytesIO
-from PIL import Image
-from flask import Flask, request, url_for
+from flask import Flask, Response, request, send_from_directory
+from flask import stream_with_context, url_for
 from flask import render_template, redirect
-from rom.util import EntityLock
 import rom.util
 from flask_socketio import SocketIO, disconnect, join_room
 from flask_login import LoginManager, login_user, logout_user
@@ -16,13 +13,19 @@ from flask_login import current_user, login_required
 from hydraChess.config import ProductionConfig, TestingConfig
 from hydraChess.forms import RegisterForm, LoginForm, SettingsForm
 from hydraChess.models import User, Game
+from hydraChess.move_commit import forget_forwarded_move, prevalidate_move
+from hydraChess.user_cache import user_cache
+from hydraChess import archive, auth, avatars, entity_session, game_history
+from hydraChess import leaderboard, matchmaking, pgn_export
 
 
 app = Flask(__name__)
 app.config.from_object(ProductionConfig)
 
-rom.util.set_connection_settings(db=app.config['REDIS_DB_ID'])
+entity_session.set_connection_settings(db=app.config['REDIS_DB_ID'])
 rom.util.use_null_session()
+archive.set_archive_path(app.config['ARCHIVE_PATH'])
+atexit.register(archive.close)
 
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -43,7 +46,7 @@ def authenticated_only(func):
 
 @login_manager.user_loader
 def load_user(user_id: int) -> User:
-    return User.get(user_id)
+    return user_cache.get(int(user_id))
 
 
 @app.route('/index', methods=['GET'])
@@ -57,7 +60,18 @@ def index():
 @app.route('/lobby', methods=['GET'])
 @login_required
 def lobby():
-    return render_template('lobby.html', title='Lobby - Hydra Chess')
+    # Leaderboard page, overall or of the time control
+    page = max(request.args.get('page', 1, type=int), 1)
+    minutes = request.args.get('minutes', None, type=int)
+    seconds = minutes * 60 if minutes else None
+
+    start = (page - 1) * leaderboard.PAGE_SIZE
+    return render_template(
+        'lobby.html', title='Lobby - Hydra Chess',
+        top_players=leaderboard.get_top_players(start, seconds=seconds),
+        rank=leaderboard.get_rank(current_user.id, seconds),
+        page=page, page_size=leaderboard.PAGE_SIZE, minutes=minutes,
+    )
 
 
 @app.route('/game/<int:game_id>', methods=['GET'])
@@ -73,14 +87,25 @@ def game_page(game_id: int):
                            is_player=is_player)
 
 
+TOO_MANY_ATTEMPTS = "Too many attempts. Try again in a minute."
+
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
         return redirect('/')
     form = RegisterForm()
     if form.validate_on_submit():
+        if not auth.admit_registration(request.remote_addr):
+            return render_template('register.html', title='Register',
+                                   message=TOO_MANY_ATTEMPTS, form=form), 429
+
         user = User(login=form.login.data)
-        user.set_password(form.password.data)
+        try:
+            user.set_password(form.password.data)
+        except auth.HashingOverloaded:
+            return render_template('register.html', title='Register',
+                                   message=TOO_MANY_ATTEMPTS, form=form), 503
         user.save()
 
         login_user(user)
@@ -96,8 +121,17 @@ def sign_in():
 
     form = LoginForm()
     if form.validate_on_submit():
+        if not auth.admit_sign_in(request.remote_addr, form.login.data):
+            return render_template('sign_in.html', title="Sign in",
+                                   message=TOO_MANY_ATTEMPTS, form=form), 429
+
         user = User.get_by(login=form.login.data)
-        if user and user.check_password(form.password.data):
+        try:
+            is_valid = user and user.check_password(form.password.data)
+        except auth.HashingOverloaded:
+            return render_template('sign_in.html', title="Sign in",
+                                   message=TOO_MANY_ATTEMPTS, form=form), 503
+        if is_valid:
             login_user(user, remember=form.remember_me.data)
             return redirect("/")
         return render_template('sign_in.html',
@@ -112,14 +146,54 @@ def user_profile(nickname: str):
     user = User.get_by(login=nickname)
     if not user:
         return render_template('404.html'), 404
+
+    # Page of the game history, filtered by outcome and time control
+    cursor = request.args.get('cursor', None, type=float)
+    outcome = request.args.get('outcome', None)
+    if outcome not in game_history.OUTCOMES:
+        outcome = None
+    minutes = request.args.get('minutes', None, type=int)
+    seconds = minutes * 60 if minutes else None
+
+    games, next_cursor = game_history.get_games(
+        user.id, cursor and repr(cursor), outcome=outcome, seconds=seconds)
+
     return render_template('user_profile.html',
                            title=f"{user.login}'s profile - Hydra Chess",
                            nickname=user.login,
                            rating=user.rating,
-                           avatar_hash=user.avatar_hash)
+                           rank=leaderboard.get_rank(user.id),
+                           avatar_hash=user.avatar_hash,
+                           games=games,
+                           next_cursor=next_cursor,
+                           outcome=outcome,
+                           minutes=minutes)
+
+
+@app.route('/user/<nickname>/games.pgn', methods=['GET'])
+def user_games_pgn(nickname: str):
+    '''Streams all finished games of the user in PGN, gzipped if requested'''
+    user = User.get_by(login=nickname)
+    if not user:
+        return render_template('404.html'), 404
+
+    chunks = pgn_export.export_pgn(pgn_export.iter_user_game_ids(user.id))
+    filename = f'{user.login}.pgn'
+    if request.args.get('gzip'):
+        chunks = pgn_export.gzip_stream(chunks)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    else:
+        mimetype = 'application/x-chess-pgn'
+
+    return Response(
+        stream_with_context(chunks), mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={filename}'},
+    )
 
 
 @sio.on('search_game')
+@entity_session.scoped
 @authenticated_only
 def on_search_game(*args, **kwargs):
     if any([current_user.cur_game_id, current_user.in_search]):
@@ -145,16 +219,22 @@ def on_search_game(*args, **kwargs):
         except (ValueError, TypeError):
             return
 
-    game_management.search_game.delay(current_user.id, minutes * 60)
+    # Tokens order the user's search and cancel, which run on different
+    # workers
+    token = matchmaking.new_search_token(current_user.id)
+    game_management.search_game.delay(current_user.id, minutes * 60, token)
 
 
 @sio.on('cancel_search')
+@entity_session.scoped
 @authenticated_only
 def on_cancel_search(*args, **kwargs):
-    game_management.cancel_search.delay(current_user.id)
+    token = matchmaking.new_search_token(current_user.id)
+    game_management.cancel_search.delay(current_user.id, token)
 
 
 @sio.on('resign')
+@entity_session.scoped
 @authenticated_only
 def on_resign(*args, **kwargs) -> None:
     if current_user.cur_game_id is None:
@@ -166,6 +246,7 @@ def on_resign(*args, **kwargs) -> None:
 # TODO
 """
 @sio.on('send_message')
+@entity_session.scoped
 @authenticated_only
 def on_send_message(*args, **kwargs) -> None:
     if not current_user.cur_game_id:
@@ -181,6 +262,7 @@ def on_send_message(*args, **kwargs) -> None:
 
 
 @sio.on('connect')
+@entity_session.scoped
 def on_connect(*args, **kwargs) -> None:
     game_id = request.args.get('game_id')
     game = None
@@ -193,39 +275,39 @@ def on_connect(*args, **kwargs) -> None:
         game = Game.get(game_id)
 
     if current_user.is_authenticated:
-        cur_user = User.get(current_user.id)
-        with EntityLock(cur_user, 10, 10):
-            cur_user.sid = request.sid
-            cur_user.save()
+        current_user.set_sid(request.sid)
 
         if not game:
-            if cur_user.cur_game_id:
+            if current_user.cur_game_id:
                 sio.emit('redirect',
-                         {'url': f'/game/{cur_user.cur_game_id}'},
-                         room=cur_user.sid,
+                         {'url': f'/game/{current_user.cur_game_id}'},
+                         room=request.sid,
                          )
             return
 
     is_player = current_user.is_authenticated and\
         current_user.id in (game.white_user.id, game.black_user.id)
 
-    #  If the user is player and game isn't finished, we update user sid and
-    #   reconnect him to the game.
+    #  If the user is player and game isn't finished, we update user sid,
+    #   join him to the game room and reconnect him to the game.
     #  If the game is finished, we only send game info to the user.
     #  If the game isn't finished and user isn't player, we send him the game
     #   info and join him to the game room.
 
     if is_player and not game.is_finished:
+        join_room(game_id)
         game_management.reconnect.delay(current_user.id, game_id)
     elif game.is_finished:
-        game_management.send_game_info.delay(game_id, request.sid, is_player)
+        game_management.send_game_info.delay(
+            game_id, request.sid, current_user.id if is_player else None)
         # TODO: disconnect here
     else:
-        game_management.send_game_info.delay(game_id, request.sid, False)
+        game_management.send_game_info.delay(game_id, request.sid)
         join_room(game_id)
 
 
 @sio.on('make_draw_offer')
+@entity_session.scoped
 @authenticated_only
 def on_make_draw_offer(*args, **kwargs) -> None:
     if current_user.cur_game_id:
@@ -234,6 +316,7 @@ def on_make_draw_offer(*args, **kwargs) -> None:
 
 
 @sio.on('accept_draw_offer')
+@entity_session.scoped
 @authenticated_only
 def on_accept_draw_offer(*args, **kwargs) -> None:
     if current_user.cur_game_id:
@@ -242,15 +325,17 @@ def on_accept_draw_offer(*args, **kwargs) -> None:
 
 
 @sio.on('disconnect')
+@entity_session.scoped
 @authenticated_only
 def on_disconnect(*args, **kwargs) -> None:
     if current_user.cur_game_id:
         game_management.on_disconnect.delay(current_user.id,
                                             current_user.cur_game_id)
-    game_management.cancel_search.delay(current_user.id)
+    game_management.cancel_search_later(current_user.id)
 
 
 @sio.on('make_move')
+@entity_session.scoped
 @authenticated_only
 def on_make_move(*args, **kwargs):
     if args and isinstance(args[0], dict):
@@ -261,8 +346,26 @@ def on_make_move(*args, **kwargs):
             game_id = int(game_id)
         except (TypeError, ValueError):
             return
-        if san and game_id:
-            game_management.make_move.delay(user_id, game_id, san)
+        if not (san and isinstance(san, str) and game_id):
+            return
+
+        reason = prevalidate_move(user_id, game_id, san)
+        if reason is not None:
+            sio.emit('move_rejected', {'san': san, 'reason': reason},
+                     room=request.sid)
+            return
+
+        sent = False
+        try:
+            if app.config['MOVE_EXECUTION'] == 'inline':
+                # Saves two queue hops: the broker and the worker's emit
+                sent = game_management.execute_move(user_id, game_id, san)
+            else:
+                game_management.make_move.delay(user_id, game_id, san)
+                sent = True
+        finally:
+            if not sent:
+                forget_forwarded_move(game_id)
 
 
 @app.route('/settings', methods=['GET', 'POST'])
@@ -273,25 +376,41 @@ def settings():
     message = ""
     if form.validate_on_submit():
         form.image.data.seek(0)  # Because the stream was already read on validation
-        raw_img = BytesIO(form.image.data.read())
-
-        img = Image.open(raw_img)
-        new_size = min(300, img.width), min(300, img.height)
-        img = img.resize(new_size).convert('RGB')
-
-        img_hash = uuid.uuid4().hex
-        path = os.path.dirname(os.path.realpath(__file__)) +\
-            url_for('static', filename=f'img/profiles/{img_hash}.jpg')
-        img.save(path)
-
-        current_user.avatar_hash = img_hash
-        current_user.save()
+        raw_img = form.image.data.read()
+
+        avatar_hash = avatars.content_hash(raw_img)
+        if avatars.has_variants(avatar_hash):
+            current_user.avatar_hash = avatar_hash
+            current_user.save()
+        else:
+            avatars.save_upload(raw_img, avatar_hash)
+            game_management.process_avatar.delay(current_user.id, avatar_hash)
         message = "Your settings were successfuly updated!"
 
     return render_template('settings.html', title='Settings - Hydra Chess',
                            form=form, message=message)
 
 
+@app.route('/avatar/<avatar_hash>/<int:size>.webp', methods=['GET'])
+def avatar(avatar_hash: str, size: int):
+    '''Serves profile image of the size. Images never change.'''
+    response = send_from_directory(avatars.AVATARS_DIR,
+                                   avatars.avatar_filename(avatar_hash, size))
+    response.headers['Cache-Control'] = \
+        'public, max-age=31536000, immutable'
+    return response
+
+
+@app.context_processor
+def avatar_url_processor():
+    def avatar_url(avatar_hash: str, size: int) -> str:
+        if avatar_hash == avatars.DEFAULT_AVATAR or \
+                size not in avatars.AVATAR_SIZES:
+            return url_for('static', filename='img/profiles/default.jpg')
+        return url_for('avatar', avatar_hash=avatar_hash, size=size)
+    return {'avatar_url': avatar_url}
+
+
 @app.route('/logout')
 @login_required
 def logout():
@@ -0,0 +1,185 @@
+'''Cold archive of finished games. Games, which were finished long ago, are
+moved from Redis to a SQLite database, so Redis memory is proportional to
+live games. Game.get(...) falls back to the archive transparently.
+
+The process shares a single connection to the archive, greenlets and
+threads take turns on it. Run the archiver with
+"python3 -m hydraChess.archive"'''
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import islice
+from time import sleep
+from typing import Iterator, List, Optional, Tuple
+import json
+import os
+import sqlite3
+import threading
+import rom.util
+from hydraChess.config import ProductionConfig
+from hydraChess import models
+
+
+ARCHIVE_INTERVAL = 60 * 60  # Seconds between archivings
+BATCH_SIZE = 100
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY,
+    end_ts REAL,
+    data TEXT NOT NULL,
+    moves BLOB NOT NULL,
+    info TEXT
+)
+'''
+
+_path = ProductionConfig.ARCHIVE_PATH
+_conn = None
+_lock = threading.RLock()
+
+
+def set_archive_path(path: str) -> None:
+    global _path
+    with _lock:
+        close()
+        _path = path
+
+
+def close() -> None:
+    '''Closes the connection, the next call opens it again'''
+    global _conn
+    with _lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
+
+@contextmanager
+def _connect(create: bool = True) -> Iterator[Optional[sqlite3.Connection]]:
+    '''Holds the shared connection. Gives None, if the archive doesn't exist
+       and create is False.'''
+    global _conn
+    with _lock:
+        if _conn is None and (create or _path == ':memory:' or
+                              os.path.exists(_path)):
+            _conn = sqlite3.connect(_path, check_same_thread=False)
+            _conn.execute('PRAGMA journal_mode=WAL')
+            _conn.execute(_SCHEMA)
+        yield _conn
+
+
+def put_games(rows: List[Tuple[int, Optional[float], dict, bytes,
+                               Optional[str]]]) -> None:
+    '''Stores (id, end timestamp, column values, packed moves, info snapshot)
+       of games'''
+    with _connect() as conn, conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?, ?)',
+            [(game_id, end_ts, json.dumps(data), moves, info)
+             for game_id, end_ts, data, moves, info in rows])
+
+
+def get_games(game_ids: List[int]) -> dict:
+    '''Returns {id: (column values, packed moves, info snapshot)} of the
+       archived games'''
+    if not game_ids:
+        return {}
+
+    placeholders = ','.join('?' * len(game_ids))
+    with _connect(create=False) as conn:
+        if conn is None:
+            return {}
+        rows = conn.execute(
+            f'SELECT id, data, moves, info FROM games '
+            f'WHERE id IN ({placeholders})', list(game_ids)).fetchall()
+    return {game_id: (json.loads(data), bytes(moves), info)
+            for game_id, data, moves, info in rows}
+
+
+def iter_game_ids(batch_size: int = BATCH_SIZE) -> Iterator[int]:
+    '''Yields ids of archived games in order of creation'''
+    last_id = 0
+    while True:
+        with _connect(create=False) as conn:
+            if conn is None:
+                return
+            game_ids = [game_id for game_id, in conn.execute(
+                'SELECT id FROM games WHERE id > ? ORDER BY id LIMIT ?',
+                (last_id, batch_size))]
+        yield from game_ids
+
+        if len(game_ids) < batch_size:
+            return
+        last_id = game_ids[-1]
+
+
+def archive_games(older_than: datetime, batch_size: int = BATCH_SIZE) -> int:
+    '''Moves games finished before older_than to the archive.
+       Returns number of the moved games.'''
+    conn = rom.util.get_connection()
+    min_ts = rom.util.dt2ts(older_than)
+    columns = set(models.Game._columns)
+
+    # Ids are paged by the last one, so deleting archived games is safe
+    game_ids = models.iter_game_ids(batch_size)
+    archived = 0
+    while True:
+        batch = list(islice(game_ids, batch_size))
+        if not batch:
+            break
+
+        pipe = conn.pipeline(False)
+        for game_id in batch:
+            pipe.hgetall(f'Game:{game_id}')
+            pipe.get(f'Game:{game_id}:moves')
+            pipe.get(f'Game:{game_id}:info')
+        replies = pipe.execute()
+
+        rows = []
+        for j, game_id in enumerate(batch):
+            data, moves, info = replies[3 * j:3 * j + 3]
+            data = {key.decode(): value.decode()
+                    for key, value in data.items()}
+            if data.get('is_finished') != '1':
+                continue
+
+            # Games finished before end_datetime was stored have no exact
+            # end time
+            end_ts = data.get('end_datetime') or \
+                data.get('last_move_datetime')
+            end_ts = float(end_ts) if end_ts else None
+            if end_ts is not None and end_ts >= min_ts:
+                continue
+
+            # Fields of removed columns are dropped
+            data = {key: value for key, value in data.items()
+                    if key in columns}
+            rows.append((game_id, end_ts, data, moves or b'',
+                         info.decode() if info else None))
+
+        if not rows:
+            continue
+
+        put_games(rows)
+        # Deleting entities also removes them from rom indices
+        for game in models.Game.get([row[0] for row in rows]):
+            game.delete()
+        archived += len(rows)
+
+    return archived
+
+
+def run_archiver(archive_after: timedelta) -> None:
+    '''Archives old games forever'''
+    try:
+        while True:
+            archived = archive_games(datetime.utcnow() - archive_after)
+            print(f"Archived {archived} games")
+            sleep(ARCHIVE_INTERVAL)
+    finally:
+        close()
+
+
+if __name__ == '__main__':
+    rom.util.set_connection_settings(db=ProductionConfig.REDIS_DB_ID)
+    rom.util.use_null_session()
+    run_archiver(timedelta(days=ProductionConfig.ARCHIVE_AFTER_DAYS))
@@ -0,0 +1,87 @@
+'''Password hashing and admission control of sign-in and registration.
+
+PBKDF2 is CPU bound, so hashes are computed by a small pool of native
+threads (hashlib releases the GIL) and the event loop keeps serving games.
+Attempts are counted per IP and per account in Redis and rejected before
+any hashing, once they exceed the limits, so a credential stuffing burst
+costs one round trip per request.'''
+from typing import Callable, Optional
+import os
+from gevent.threadpool import ThreadPool
+from werkzeug.security import check_password_hash, generate_password_hash
+from hydraChess.redis_utils import LuaScript
+
+
+HASHING_THREADS = 4
+MAX_PENDING_HASHES = 64  # Hashing requests are rejected beyond it
+
+ATTEMPTS_WINDOW = 60  # Seconds
+SIGN_IN_ATTEMPTS_PER_IP = 30
+SIGN_IN_ATTEMPTS_PER_ACCOUNT = 10
+REGISTRATIONS_PER_IP = 20
+
+
+class HashingOverloaded(Exception):
+    '''Too many passwords are being hashed already'''
+
+
+_count_attempts_lua = LuaScript('''
+local counts = {}
+for i, key in ipairs(KEYS) do
+    counts[i] = redis.call('INCR', key)
+    if counts[i] == 1 then
+        redis.call('EXPIRE', key, ARGV[1])
+    end
+end
+return counts
+''')
+
+
+def _count_attempts(*keys: str) -> list:
+    return _count_attempts_lua(keys=keys, args=(ATTEMPTS_WINDOW, ))
+
+
+def admit_sign_in(ip: str, login: str) -> bool:
+    '''Counts the sign-in attempt. Returns False if it should be rejected.'''
+    ip_attempts, account_attempts = _count_attempts(
+        f'attempts:sign_in:ip:{ip}',
+        f'attempts:sign_in:login:{login.lower()}')
+    return ip_attempts <= SIGN_IN_ATTEMPTS_PER_IP and \
+        account_attempts <= SIGN_IN_ATTEMPTS_PER_ACCOUNT
+
+
+def admit_registration(ip: str) -> bool:
+    '''Counts the registration. Returns False if it should be rejected.'''
+    attempts, = _count_attempts(f'attempts:register:ip:{ip}')
+    return attempts <= REGISTRATIONS_PER_IP
+
+
+_pool: Optional[ThreadPool] = None
+_pool_pid: Optional[int] = None
+_pending = 0
+
+
+def _run_in_pool(func: Callable, *args):
+    '''Runs the function in the hashing pool, blocking only the current
+       greenlet'''
+    global _pool, _pool_pid, _pending
+    if _pending >= MAX_PENDING_HASHES:
+        raise HashingOverloaded()
+
+    if _pool_pid != os.getpid():  # Threads don't survive fork
+        _pool = ThreadPool(HASHING_THREADS)
+        _pool_pid = os.getpid()
+
+    _pending += 1
+    try:
+        return _pool.apply(func, args)
+    finally:
+        _pending -= 1
+
+
+def hash_password(password: str) -> str:
+    return _run_in_pool(generate_password_hash, password)
+
+
+def check_password(hashed_password: str, password: str) -> bool:
+    return _run_in_pool(check_password_hash, hashed_password, password)
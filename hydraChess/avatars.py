@@ -0,0 +1,73 @@
+'''Profile images. Uploads are named by hash of their content and processed
+by a worker, so Pillow never runs in the web process. Each image is
+cropped to a square and saved in several sizes in WebP format. Files of a
+hash never change, so they are served with long-lived cache headers.'''
+from contextlib import suppress
+from hashlib import sha256
+from io import BytesIO
+import os
+from PIL import Image, ImageOps
+
+
+AVATAR_SIZES = (64, 150, 300)
+DEFAULT_AVATAR = 'default'
+
+_PACKAGE_DIR = os.path.dirname(os.path.realpath(__file__))
+AVATARS_DIR = os.path.join(_PACKAGE_DIR, 'static', 'img', 'profiles')
+# Uploads waiting for processing. Web and worker processes must share it.
+UPLOADS_DIR = os.path.join(_PACKAGE_DIR, 'uploads')
+
+
+def content_hash(raw_img: bytes) -> str:
+    return sha256(raw_img).hexdigest()[:32]
+
+
+def avatar_filename(avatar_hash: str, size: int) -> str:
+    return f'{avatar_hash}_{size}.webp'
+
+
+def has_variants(avatar_hash: str) -> bool:
+    return all(
+        os.path.exists(os.path.join(AVATARS_DIR,
+                                    avatar_filename(avatar_hash, size)))
+        for size in AVATAR_SIZES)
+
+
+def save_upload(raw_img: bytes, avatar_hash: str) -> None:
+    os.makedirs(UPLOADS_DIR, exist_ok=True)
+    with open(os.path.join(UPLOADS_DIR, avatar_hash), 'wb') as upload:
+        upload.write(raw_img)
+
+
+def make_variants(raw_img: bytes, avatar_hash: str) -> None:
+    '''Saves square variants of the image in all sizes'''
+    img = Image.open(BytesIO(raw_img))
+    img = ImageOps.exif_transpose(img).convert('RGB')
+    for size in AVATAR_SIZES:
+        variant = ImageOps.fit(img, (size, size), Image.LANCZOS)
+        path = os.path.join(AVATARS_DIR, avatar_filename(avatar_hash, size))
+        # Variants are never seen half-written
+        variant.save(path + '.tmp', 'WEBP', quality=85)
+        os.replace(path + '.tmp', path)
+
+
+def process_upload(avatar_hash: str) -> bool:
+    '''Makes variants of the uploaded image and removes the upload.
+       Returns False if the image can't be read.'''
+    path = os.path.join(UPLOADS_DIR, avatar_hash)
+    try:
+        with open(path, 'rb') as upload:
+            raw_img = upload.read()
+    except FileNotFoundError:
+        # The same image was processed by another task
+        return has_variants(avatar_hash)
+
+    try:
+        if not has_variants(avatar_hash):
+            make_variants(raw_img, avatar_hash)
+    except (OSError, Image.DecompressionBombError):
+        return False
+    finally:
+        with suppress(FileNotFoundError):
+            os.remove(path)
+    return True
@@ -0,0 +1,47 @@
+from collections import OrderedDict
+from typing import Optional, Tuple
+from chess import Board
+
+
+class BoardCache:
+    '''Per-process LRU cache of live boards, keyed by game id and ply count'''
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._boards = OrderedDict()
+
+    def get(self, game_id: int, ply: int) -> Optional[Board]:
+        '''Returns copy of the cached board, if it has the given ply count'''
+        entry = self._boards.get(game_id)
+        if entry is None or entry[0] != ply:
+            return None
+
+        self._boards.move_to_end(game_id)
+        return entry[1].copy()
+
+    def get_latest(self, game_id: int) -> Optional[Tuple[int, Board]]:
+        '''Returns ply count and copy of the cached board of any ply'''
+        entry = self._boards.get(game_id)
+        if entry is None:
+            return None
+
+        self._boards.move_to_end(game_id)
+        return entry[0], entry[1].copy()
+
+    def put(self, game_id: int, ply: int, board: Board) -> None:
+        '''Caches copy of the board. Only moves since the last capture or
+           pawn move are kept, they are enough to detect repetitions.'''
+        stack = min(board.halfmove_clock, len(board.move_stack))
+        self._boards[game_id] = (ply, board.copy(stack=stack))
+        self._boards.move_to_end(game_id)
+
+        while len(self._boards) > self.max_size:
+            self._boards.popitem(last=False)
+
+    def discard(self, game_id: int) -> None:
+        self._boards.pop(game_id, None)
+
+    def clear(self) -> None:
+        self._boards.clear()
+
+
+board_cache = BoardCache()
@@ -1,4 +1,5 @@
 from kombu import Queue, Exchange
+from hydraChess.routing import GAME_PARTITIONS, SEARCH_SHARDS, route_task
 
 
 CELERY_QUEUES = (
@@ -6,32 +7,37 @@ CELERY_QUEUES = (
     Queue('normal', Exchange('normal'), routing_key='normal'),
     Queue('low', Exchange('low'), routing_key='low'),
     Queue('search', Exchange('search'), routing_key='search')
+) + tuple(
+    Queue(f'high.{partition}', Exchange('high'),
+          routing_key=f'high.{partition}')
+    for partition in range(GAME_PARTITIONS)
+) + tuple(
+    Queue(f'search.{shard}', Exchange('search'), routing_key=f'search.{shard}')
+    for shard in range(SEARCH_SHARDS)
 )
 
+# Messages are smaller and faster to encode than in JSON
+CELERY_TASK_SERIALIZER = 'msgpack'
+CELERY_RESULT_SERIALIZER = 'msgpack'
+CELERY_ACCEPT_CONTENT = ['msgpack']
+
 CELERY_DEFAULT_QUEUE = 'normal'
 CELERY_DEFAULT_EXCHANGE = 'normal'
 CELERY_DEFAULT_ROUTING_KEY = 'normal'
-CELERY_ROUTES = {
-    # -- HIGH PRIORITY QUEUE -- #
-    'make_move': {'queue': 'high'},
-    'start_game': {'queue': 'high'},
-    'end_game': {'queue': 'high'},
-    'reconnect': {'queue': 'high'},
-    'resign': {'queue': 'high'},
-    'accept_draw_offer': {'queue': 'high'},
-    'decline_draw_offer': {'queue': 'high'},
-    'send_game_info': {'queue': 'high'},
-    # -- NORMAL PRIORITY QUEUE -- #
-    'on_first_move_timed_out': {'queue': 'normal'},
-    'on_disconnect_timed_out': {'queue': 'normal'},
-    'on_time_is_up': {'queue': 'normal'},
+CELERY_ROUTES = (route_task, {
+    # -- GAME PARTITION QUEUES -- #
+    # Tasks of a game (make_move, start_game, end_game, reconnect, resign,
+    # draw offers, send_game_info, on_disconnect and timer callbacks) are
+    # routed to the partition of the game by route_task
     # -- LOW PRIORITY QUEUE -- #
     # 'send_message': {'queue': 'low'},
-    'update_k_factor': {'queue': 'low'},
-    'on_disconnect': {'queue': 'low'},
-    'update_rating': {'queue': 'low'},
-    'make_draw_offer': {'queue': 'low'},
-    # -- SEARCH QUEUE -- #
-    'search_game': {'queue': 'search'},
-    'cancel_search': {'queue': 'search'}
-}
+    # Image processing is CPU bound, prefork workers of the queue do it
+    'process_avatar': {'queue': 'low'},
+    # -- SEARCH QUEUES -- #
+    # search_game and match_seeks are routed to the shard of their time
+    # control by route_task. Cancels may run before the search they
+    # cancel, search tokens of matchmaking.py order them
+    'cancel_search': {'queue': 'search'},
+    # Batch of cancel_search calls, see task_batching.py
+    'cancel_searches': {'queue': 'search'}
+})
@@ -5,6 +5,12 @@ class ProductionConfig:
     REDIS_DB_ID = 0
     CELERY_BROKER_URL = f'redis://localhost:6379/{REDIS_DB_ID}'
     MAX_CONTENT_LENGTH = 4 * 1024 * 1024  # 4 MB
+    LEADERBOARD_TIME_CONTROLS = True  # Keep leaderboards of time controls
+    ARCHIVE_PATH = 'games_archive.sqlite3'  # SQLite archive of old games
+    ARCHIVE_AFTER_DAYS = 7  # Finished games older than it are archived
+    # "celery" sends moves to workers, "inline" makes them in web processes.
+    # Inline moves aren't ordered by game partitions, see routing.py
+    MOVE_EXECUTION = 'celery'
 
 
 class TestingConfig:
@@ -14,4 +20,8 @@ class TestingConfig:
     REDIS_DB_ID = 1
     CELERY_BROKER_URL = f'redis://localhost:6379/{REDIS_DB_ID}'
     MAX_CONTENT_LENGTH = 4 * 1024 * 1024  # 4 Mb
+    LEADERBOARD_TIME_CONTROLS = True
+    ARCHIVE_PATH = ':memory:'
+    ARCHIVE_AFTER_DAYS = 7
+    MOVE_EXECUTION = 'celery'
     WTF_CSRF_ENABLED = False
@@ -0,0 +1,124 @@
+'''Scoped rom sessions. Inside a scope every entity is read from Redis once,
+later Model.get(...) calls and relation accesses like game.white_user return
+the loaded instance. Entities left modified are saved when the scope ends,
+only their changed columns are written. Entities changed by Lua scripts are
+dropped from the scope with forget(...). Each Celery task and each Socket.IO
+event runs in its own scope.
+
+The Redis connection counts round trips and commands, so their numbers per
+scope can be measured, see get_task_stats().'''
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict, Iterator, Optional
+import threading
+from redis import Redis
+from redis.client import Pipeline
+import rom
+import rom.util
+
+
+class Counters(threading.local):
+    '''Round trips and commands sent by the current thread'''
+    def __init__(self):
+        self.round_trips = 0
+        self.commands = 0
+
+
+counters = Counters()
+
+
+class CountingPipeline(Pipeline):
+    def execute(self, raise_on_error=True):
+        if self.command_stack:
+            counters.round_trips += 1
+            counters.commands += len(self.command_stack)
+        return super().execute(raise_on_error)
+
+
+class CountingRedis(Redis):
+    '''Redis client, which updates counters on each round trip'''
+    def execute_command(self, *args, **options):
+        counters.round_trips += 1
+        counters.commands += 1
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return CountingPipeline(self.connection_pool, self.response_callbacks,
+                                transaction, shard_hint)
+
+
+def set_connection_settings(**kwargs) -> None:
+    '''Same as rom.util.set_connection_settings(...), but the connection
+       counts round trips'''
+    rom.util.CONNECTION = CountingRedis(**kwargs)
+
+
+class ScopeStats:
+    def __init__(self):
+        self.calls = 0
+        self.round_trips = 0
+        self.commands = 0
+
+    def to_dict(self) -> dict:
+        return {'calls': self.calls, 'round_trips': self.round_trips,
+                'commands': self.commands}
+
+
+_stats: Dict[str, ScopeStats] = {}
+_scope = threading.local()
+
+
+@contextmanager
+def scope(name: Optional[str] = None) -> Iterator[None]:
+    '''Runs the block in an entity session. Nested scopes share the session
+       of the outer one. Round trips of named scopes are added to stats.'''
+    if getattr(_scope, 'active', False):
+        yield
+        return
+
+    _scope.active = True
+    rom.session.null_session = False
+    rom.session.rollback()
+    round_trips, commands = counters.round_trips, counters.commands
+    try:
+        yield
+        rom.session.commit()
+    finally:
+        rom.session.rollback()
+        del rom.session.null_session
+        _scope.active = False
+
+        if name is not None:
+            stats = _stats.setdefault(name, ScopeStats())
+            stats.calls += 1
+            stats.round_trips += counters.round_trips - round_trips
+            stats.commands += counters.commands - commands
+
+
+def forget(model, *ids) -> None:
+    '''Drops the entities from the current scope, after a Lua script has
+       changed them in Redis. Otherwise their stale copies would be
+       returned by later Model.get(...) calls and saved when the scope ends.'''
+    for entity_id in ids:
+        entity = rom.session.get(f'{model._namespace}:{entity_id}')
+        if entity is not None:
+            rom.session.forget(entity)
+
+
+def scoped(func):
+    '''Decorator, which runs the function in a scope named after it'''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with scope(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def get_task_stats() -> Dict[str, dict]:
+    '''Returns number of calls, round trips and commands of each scope name,
+       which is a task name or an event handler name'''
+    return {name: stats.to_dict() for name, stats in _stats.items()}
+
+
+def reset_task_stats() -> None:
+    _stats.clear()
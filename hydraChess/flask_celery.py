@@ -1,5 +1,5 @@
 from celery import Celery
-from hydraChess import celery_config
+from hydraChess import celery_config, entity_session
 
 
 def make_celery(app):
@@ -16,7 +16,8 @@ def make_celery(app):
         abstract = True
 
         def __call__(self, *args, **kwargs):
-            with app.app_context():
+            # Each task loads entities once and saves them at its end
+            with app.app_context(), entity_session.scope(self.name):
                 return TaskBase.__call__(self, *args, **kwargs)
 
     celery.Task = ContextTask
@@ -0,0 +1,96 @@
+'''Game history of users. Finished games of a user are indexed in Redis
+sorted sets scored by the end time of the game. Besides the index of all
+games, there are indices by outcome for the user, by time control and by
+both, so a filtered page is read with one range query. Summaries of the
+games are taken from their info snapshots. The indices are appended by
+the end of game settlement.'''
+from datetime import datetime
+from typing import List, Optional, Tuple
+import json
+import rom.util
+from hydraChess.models import get_game_info
+
+
+OUTCOMES = ('win', 'draw', 'loss')
+RATED_RESULTS = ('1-0', '0-1', '1/2-1/2')
+PAGE_SIZE = 10
+
+
+def history_key(user_id: int, outcome: Optional[str] = None,
+                seconds: Optional[int] = None) -> str:
+    key = f'history:{user_id}'
+    if seconds is not None:
+        key += f':{int(seconds)}'
+    if outcome is not None:
+        key += f':{outcome}'
+    return key
+
+
+def get_outcome(result: str, is_white: bool) -> Optional[str]:
+    '''Outcome of the game for the player, None if the game was cancelled'''
+    if result == '1/2-1/2':
+        return 'draw'
+    if result == '1-0':
+        return 'win' if is_white else 'loss'
+    if result == '0-1':
+        return 'loss' if is_white else 'win'
+    return None
+
+
+def get_history_keys(user_id: int, outcome: str, seconds: int) -> List[str]:
+    '''Indices, which the game with the outcome is added to'''
+    return [history_key(user_id),
+            history_key(user_id, outcome),
+            history_key(user_id, seconds=seconds),
+            history_key(user_id, outcome, seconds)]
+
+
+def add_game(user_id: int, game_id: int, outcome: str, seconds: int,
+             end_datetime: datetime) -> None:
+    pipe = rom.util.get_connection().pipeline(True)
+    for key in get_history_keys(user_id, outcome, seconds):
+        pipe.zadd(key, {game_id: rom.util.dt2ts(end_datetime)})
+    pipe.execute()
+
+
+def get_games(user_id: int, cursor: Optional[str] = None,
+              count: int = PAGE_SIZE, outcome: Optional[str] = None,
+              seconds: Optional[int] = None,
+              ) -> Tuple[List[dict], Optional[str]]:
+    '''Returns summaries of finished games of the user, latest first, and
+       cursor of the next page, which is None on the last page.
+       Takes two round trips, if snapshots of the games exist.'''
+    conn = rom.util.get_connection()
+    max_score = f'({cursor}' if cursor else '+inf'
+    entries = conn.zrevrangebyscore(history_key(user_id, outcome, seconds),
+                                    max_score, '-inf', start=0, num=count,
+                                    withscores=True)
+    if not entries:
+        return [], None
+
+    infos = conn.mget([f'Game:{int(game_id)}:info' for game_id, _ in entries])
+
+    games = []
+    for (game_id, end_ts), info in zip(entries, infos):
+        if info is None:
+            # Snapshots of old games are created on the first request
+            info = get_game_info(int(game_id))
+            if info is None:
+                continue
+        else:
+            info = json.loads(info)
+        is_white = info['white_user']['id'] == user_id
+        games.append({
+            'id': int(game_id),
+            'white_user': info['white_user']['nickname'],
+            'black_user': info['black_user']['nickname'],
+            'result': info['result'],
+            'outcome': get_outcome(info['result'], is_white),
+            'minutes': round(float(info['total_clock']) / 60),
+            'end_datetime': rom.util.ts2dt(end_ts),
+        })
+
+    next_cursor = None
+    if len(entries) == count:
+        next_cursor = repr(entries[-1][1])
+    return games, next_cursor
@@ -1,12 +1,14 @@
 from datetime import datetime, timedelta
-from typing import Dict, Optional
-from math import ceil
+from typing import Optional
 import chess
 import rom
-from celery.task.control import revoke
 from hydraChess.flask_celery import make_celery
 from hydraChess.__main__ import app, sio
-from hydraChess.models import User, Game, GameRequest
+from hydraChess.models import User, Game, compute_rating_changes, \
+    get_game_info, parse_clock
+from hydraChess.move_commit import load_move_context, commit_move
+from hydraChess.settlement import settle_game
+from hydraChess import avatars, matchmaking, task_batching, timers
 
 
 FIRST_MOVE_TIME_OUT = 15
@@ -17,45 +19,56 @@ celery = make_celery(app)
 
 
 @celery.task(name='send_game_info', ignore_result=True)
-def send_game_info(game_id: int, room_id: int, is_player: bool):
+def send_game_info(game_id: int, room_id: str,
+                   user_id: Optional[int] = None):
+    '''Sends info snapshot of the game with clocks adjusted for time elapsed
+       since the last move. user_id is given only for players.'''
+    sio.emit('game_started', get_game_info_data(game_id, user_id),
+             room=room_id)
+
+
+def get_game_info_data(game_id: int, user_id: Optional[int] = None) -> dict:
+    '''Returns data of 'game_started' event sent by send_game_info(...)'''
     request_datetime = datetime.utcnow()
-    game = Game.get(game_id)
+    info = get_game_info(game_id)
 
+    is_player = user_id is not None
     data = {
-        "black_user": {"nickname": game.black_user.login,
-                       "rating": game.black_rating},
-        "white_user": {"nickname": game.white_user.login,
-                       "rating": game.white_rating},
-        "moves": game.raw_moves,
+        "black_user": {"nickname": info['black_user']['nickname'],
+                       "rating": info['black_user']['rating']},
+        "white_user": {"nickname": info['white_user']['nickname'],
+                       "rating": info['white_user']['rating']},
+        "moves": info['moves'],
         "is_player": is_player,
+        "version": info['version'],
     }
 
     if is_player:
-        data['color'] = 'w' if game.white_user.sid == room_id else 'b'
-
-    if not game.is_finished:
-        black_clock = game.black_clock
-        white_clock = game.white_clock
-        if game.raw_moves:
-            next_to_move = game.get_next_to_move()
-            if next_to_move == chess.WHITE:
-                white_clock -= request_datetime - game.last_move_datetime
+        data['color'] = 'w' if info['white_user']['id'] == user_id else 'b'
+
+    if not info['is_finished']:
+        black_clock = parse_clock(info['black_clock'])
+        white_clock = parse_clock(info['white_clock'])
+        if info['moves_cnt']:
+            elapsed = request_datetime - rom.util.ts2dt(
+                float(info['last_move_datetime']))
+            if info['moves_cnt'] % 2 == 0:
+                white_clock -= elapsed
             else:
-                black_clock -= request_datetime - game.last_move_datetime
+                black_clock -= elapsed
 
         data["black_clock"] = int(black_clock.total_seconds())
         data["white_clock"] = int(white_clock.total_seconds())
         if is_player:
-            rating_changes = get_rating_changes(game_id)
-            if game.draw_offer_sender is None and game.get_moves_cnt() != 0:
+            if info.get('draw_offer_sender') is None and info['moves_cnt']:
                 data["can_send_draw_offer"] = True
             else:
                 data["can_send_draw_offer"] = False
-            data['rating_changes'] = rating_changes[data['color']].to_dict()
+            data['rating_changes'] = info['rating_changes'][data['color']]
     else:
-        data["result"] = game.result
+        data["result"] = info['result']
 
-    sio.emit('game_started', data, room=room_id)
+    return data
 
 
 @celery.task(name='start_game', ignore_result=True)
@@ -63,22 +76,16 @@ def start_game(game_id: int) -> None:
     '''Marks game as started, sends game info for players,
     emits first_move_waiting signal to white player'''
     game = Game.get(game_id)
-    with rom.util.EntityLock(game, 10, 10):
-        game.is_started = 1
-
-        eta = datetime.utcnow() + timedelta(seconds=FIRST_MOVE_TIME_OUT)
-        task = on_first_move_timed_out.apply_async(
-            args=(game_id, ),
-            eta=eta,
-        )
-
-        game.first_move_timed_out_task_id = task.id
-        game.first_move_timed_out_task_eta = eta
+    game.is_started = 1
+    game.save()
 
-        game.save()
+    eta = datetime.utcnow() + timedelta(seconds=FIRST_MOVE_TIME_OUT)
+    timers.arm(timers.first_move_timer(game_id), eta,
+               'on_first_move_timed_out', (game_id, ))
 
-    send_game_info.delay(game_id, game.white_user.sid, True)
-    send_game_info.delay(game_id, game.black_user.sid, True)
+    # Sent by this task, not by two more messages
+    send_game_info(game_id, game.white_user.sid, game.white_user.id)
+    send_game_info(game_id, game.black_user.sid, game.black_user.id)
     sio.emit(
         'first_move_waiting',
         {'wait_time': FIRST_MOVE_TIME_OUT},
@@ -90,112 +97,66 @@ def start_game(game_id: int) -> None:
 def make_move(user_id: int, game_id: int, move_san: str) -> None:
     '''Updates game state by user's move.
        Calls end_game(...) if the game is ended.'''
+    execute_move(user_id, game_id, move_san)
 
-    request_datetime = datetime.utcnow()
 
-    game = Game.get(game_id)
+def execute_move(user_id: int, game_id: int, move_san: str) -> bool:
+    '''Body of make_move(...). Web processes call it directly, if
+       MOVE_EXECUTION is "inline". The move is committed atomically, so it
+       doesn't need to be serialized with other tasks of the game.
+       Returns False if the move is rejected.'''
+    request_datetime = datetime.utcnow()
 
-    if game.is_finished or\
-            user_id not in (game.white_user.id, game.black_user.id):
-        return
+    context = load_move_context(game_id)
+    if context is None:
+        return False
 
-    board = game.get_board()
-    is_user_white = user_id == game.white_user.id
-
-    if (is_user_white and board.turn == chess.BLACK) or\
-            (not is_user_white and board.turn == chess.WHITE):
-        return
+    board = context.board
+    if user_id != (context.white_user_id if board.turn == chess.WHITE
+                   else context.black_user_id):
+        return False
 
     try:
-        with rom.util.EntityLock(game, 10, 10):
-            board.push_san(move_san)
-            game.append_move(move_san)
-
-            if game.first_move_timed_out_task_id:
-                revoke(game.first_move_timed_out_task_id)
-                game.first_move_timed_out_task_id = None
-
-            if is_user_white:
-                revoke(game.white_time_is_up_task_id)
-            else:
-                revoke(game.black_time_is_up_task_id)
-
-            if game.draw_offer_sender and game.draw_offer_sender != user_id:
-                # Decline draw offer only if it was asked by the opp
-                # This call is waiting because of an entity lock
-                decline_draw_offer.delay(user_id, game_id)
-                game.draw_offer_sender = None
-
-            if is_user_white:
-                if game.get_moves_cnt() != 1:
-                    game.white_clock -=\
-                        request_datetime - game.last_move_datetime
-
-                eta = datetime.utcnow() + game.black_clock
-
-                task = on_time_is_up.apply_async(
-                    args=(game.black_user.id, game_id),
-                    eta=eta,
-                )
-
-                game.black_time_is_up_task_id = task.id
-                game.black_time_is_up_task_eta = eta
-            else:
-                if game.get_moves_cnt() != 1:
-                    game.black_clock -=\
-                            request_datetime - game.last_move_datetime
-
-                eta = datetime.utcnow() + game.white_clock
-
-                task = on_time_is_up.apply_async(
-                    args=(game.white_user.id, game_id),
-                    eta=eta,
-                )
-
-                game.white_time_is_up_task_id = task.id
-                game.white_time_is_up_task_eta = eta
-
-            game.last_move_datetime = request_datetime
-
-            if board.fullmove_number == 1:  # and board.turn == chess.BLACK
-                sio.emit('first_move_waiting',
-                         {'wait_time': FIRST_MOVE_TIME_OUT},
-                         room=game.black_user.sid)
-
-                eta = \
-                    datetime.utcnow() + timedelta(seconds=FIRST_MOVE_TIME_OUT)
-                task = on_first_move_timed_out.\
-                    apply_async((game_id, ), eta=eta)
-
-                game.first_move_timed_out_task_id = task.id
-                game.first_move_timed_out_task_eta = eta
-
-            game.save()
-
-        data = {'san': move_san,
-                'black_clock': int(game.black_clock.total_seconds()),
-                'white_clock': int(game.white_clock.total_seconds())}
-
-        sio.emit('game_updated', data, room=game_id)
-        # DO NOT REMOVE NEXT STRING. SIO CAN'T EMIT TO SPECTATORS WITHOUT
-        # THIS :/
-        data = data
-        sio.emit('game_updated', data, room=game.black_user.sid)
-        sio.emit('game_updated', data, room=game.white_user.sid)
-
-        result = board.result()
-        if result != '*':
-            reason: str
-            if result == '1/2-1/2':
-                reason = "Draw"
-            elif result == '1-0':
-                reason = "Checkmate. White won."
-            else:
-                reason = "Checkmate. Black won."
-
-            end_game.delay(game_id, result, reason)
+        move = board.parse_san(move_san)
     except ValueError:
-        pass
+        return False
+
+    first_move_eta = None
+    if context.ply == 0:
+        first_move_eta = \
+            datetime.utcnow() + timedelta(seconds=FIRST_MOVE_TIME_OUT)
+
+    clocks = commit_move(context, user_id, move, request_datetime,
+                         first_move_eta)
+    if clocks is None:
+        return False
+    white_clock, black_clock = clocks
+
+    # Players and spectators share the game room. Clients handle
+    # role-specific fields themselves.
+    if first_move_eta is not None:
+        sio.emit('first_move_waiting',
+                 {'wait_time': FIRST_MOVE_TIME_OUT, 'color': 'b'},
+                 room=game_id)
+
+    data = {'san': move_san,
+            'black_clock': int(black_clock.total_seconds()),
+            'white_clock': int(white_clock.total_seconds())}
+
+    sio.emit('game_updated', data, room=game_id)
+
+    result = board.result()
+    if result != '*':
+        reason: str
+        if result == '1/2-1/2':
+            reason = "Draw"
+        elif result == '1-0':
+            reason = "Checkmate. White won."
+        else:
+            reason = "Checkmate. Black won."
+
+        end_game.delay(game_id, result, reason)
+    return True
 
 
 @celery.task(name="resign", ignore_result=True)
@@ -204,7 +165,7 @@ def resign(user_id: int, game_id: int) -> None:
     game = Game.get(game_id)
 
     # If there is no moves in the game, just cancel it.
-    if not game.raw_moves:
+    if not game.get_moves_cnt():
         end_game.delay(game_id, '-', 'Game canceled.', update_stats=False)
         return
 
@@ -233,59 +194,50 @@ def reconnect(user_id: int, game_id: int) -> None:
 
     is_user_white = user_id == game.white_user.id
 
+    timers.cancel(timers.disconnect_timer(game_id, user_id))
+
     if is_user_white:
         # Not ".delay()", because of bad emition order
-        send_game_info(game_id, game.white_user.sid, True)
-        if game.white_disconnect_timed_out_task_id:
-            revoke(game.white_disconnect_timed_out_task_id)
-            with rom.util.EntityLock(game, 10, 10):
-                game.white_disconnect_timed_out_task_id = None
-                game.save()
-
+        send_game_info(game_id, game.white_user.sid, user_id)
         sio.emit('opp_reconnected', room=game.black_user.sid)
 
     else:
-        send_game_info.delay(game_id, game.black_user.sid, True)
-
-        if game.black_disconnect_timed_out_task_id:
-            revoke(game.black_disconnect_timed_out_task_id)
-            with rom.util.EntityLock(game, 10, 10):
-                game.black_disconnect_timed_out_task_id = None
-                game.save()
-
+        send_game_info(game_id, game.black_user.sid, user_id)
         sio.emit('opp_reconnected', room=game.white_user.sid)
 
         if is_user_white:
-            if game.first_move_timed_out_task_id and\
-                    next_to_move == chess.WHITE:
-                wait_time = (game.first_move_timed_out_task_eta -
-                             datetime.utcnow()).seconds
+            first_move_eta = timers.get_eta(timers.first_move_timer(game_id))
+            if first_move_eta and next_to_move == chess.WHITE:
+                wait_time = (first_move_eta - datetime.utcnow()).seconds
                 sio.emit(
                     'first_move_waiting',
                     {'wait_time': wait_time},
                     room=game.white_user.sid,
                 )
-            elif game.first_move_timed_out_task_id and\
-                    next_to_move == chess.BLACK:
-                wait_time = (game.first_move_timed_out_task_eta -
-                             datetime.utcnow()).seconds
+            elif first_move_eta and next_to_move == chess.BLACK:
+                wait_time = (first_move_eta - datetime.utcnow()).seconds
                 sio.emit(
                     'first_move_waiting',
                     {'wait_time': wait_time},
                     room=game.black_user.sid,
                 )
 
-        if is_user_white and game.black_disconnect_timed_out_task_id:
-            wait_time = (game.black_disconnect_timed_out_task_eta -
-                         datetime.utcnow()).seconds
+        if is_user_white:
+            opp_disconnect_eta = timers.get_eta(
+                timers.disconnect_timer(game_id, game.black_user.id))
+        else:
+            opp_disconnect_eta = timers.get_eta(
+                timers.disconnect_timer(game_id, game.white_user.id))
+
+        if is_user_white and opp_disconnect_eta:
+            wait_time = (opp_disconnect_eta - datetime.utcnow()).seconds
             sio.emit(
                 'opp_disconnected',
                 {'wait_time': wait_time},
                 room=game.white_user.sid,
             )
-        elif not is_user_white and game.white_disconnect_timed_out_task_id:
-            wait_time = (game.white_disconnect_timed_out_task_eta -
-                         datetime.utcnow()).seconds
+        elif not is_user_white and opp_disconnect_eta:
+            wait_time = (opp_disconnect_eta - datetime.utcnow()).seconds
             sio.emit(
                 'opp_disconnected',
                 {'wait_time': wait_time},
@@ -299,32 +251,23 @@ def on_disconnect(user_id: int, game_id: int) -> None:
        Emits 'opp_disconnected' to the opponent'''
 
     eta = datetime.utcnow() + timedelta(seconds=DISCONNECT_TIME_OUT)
-    task = on_disconnect_timed_out.apply_async(
-        args=(user_id, game_id),
-        eta=eta,
-    )
+    timers.arm(timers.disconnect_timer(game_id, user_id), eta,
+               'on_disconnect_timed_out', (user_id, game_id))
 
     game = Game.get(game_id)
 
     if game.draw_offer_sender:
         #  We aren't checking user_id != draw_offer_sender
         #  It'll be checked in decline_draw_offer func
-        decline_draw_offer.delay(user_id, game_id)
+        decline_draw_offer(user_id, game_id)
 
     is_user_white = user_id == game.white_user.id
 
     opp_sid: Optional[int]
-    with rom.util.EntityLock(game, 10, 10):
-        if is_user_white:
-            game.white_disconnect_timed_out_task_id = task.id
-            game.white_disconnect_timed_out_task_eta = eta
-            opp_sid = game.black_user.sid
-        else:
-            game.black_disconnect_timed_out_task_id = task.id
-            game.black_disconnect_timed_out_task_eta = eta
-            opp_sid = game.white_user.sid
-
-        game.save()
+    if is_user_white:
+        opp_sid = game.black_user.sid
+    else:
+        opp_sid = game.white_user.sid
 
     if opp_sid:
         sio.emit(
@@ -339,18 +282,19 @@ def make_draw_offer(user_id: int, game_id: int):
     '''Makes draw offer, if it's possible.'''
     game = Game.get(game_id)
 
-    with rom.util.EntityLock(game, 10, 10):
-        if game.get_moves_cnt() == 0:
-            #  Do not make draw offer, if game isn't started.
-            return
-        if game.draw_offer_sender and game.draw_offer_sender != user_id:
-            #  Accept draw offer, if it's already exist
-            accept_draw_offer.delay(user_id, game_id)
-        elif game.draw_offer_sender:
-            return
+    if game.get_moves_cnt() == 0:
+        #  Do not make draw offer, if game isn't started.
+        return
+    if game.draw_offer_sender and game.draw_offer_sender != user_id:
+        #  Accept draw offer, if it's already exist.
+        #  Tasks of the game run in order, so it's called directly.
+        accept_draw_offer(user_id, game_id)
+        return
+    elif game.draw_offer_sender:
+        return
 
-        game.draw_offer_sender = user_id
-        game.save()
+    game.draw_offer_sender = user_id
+    game.save()
 
     opp_sid: str
     if user_id == game.white_user.id:
@@ -366,13 +310,12 @@ def accept_draw_offer(user_id: int, game_id: int):
     '''Accepts draw offer, if it exists'''
     game = Game.get(game_id)
 
-    with rom.util.EntityLock(game, 10, 10):
-        if game.draw_offer_sender and game.draw_offer_sender != user_id:
-            # opp_sid = User.get(game.draw_offer_sender).sid
-            # sio.emit('draw_offer_accepted', room=opp_sid)
-            game.draw_offer_sender = None
-            game.save()
-            end_game.delay(game_id, "1/2-1/2", "Draw.")
+    if game.draw_offer_sender and game.draw_offer_sender != user_id:
+        # opp_sid = User.get(game.draw_offer_sender).sid
+        # sio.emit('draw_offer_accepted', room=opp_sid)
+        game.draw_offer_sender = None
+        game.save()
+        end_game.delay(game_id, "1/2-1/2", "Draw.")
 
 
 @celery.task(name='decline_draw_offer', ignore_result=True)
@@ -380,12 +323,11 @@ def decline_draw_offer(user_id: int, game_id: int):
     '''Declines draw offer, if it exists'''
     game = Game.get(game_id)
 
-    with rom.util.EntityLock(game, 10, 10):
-        if game.draw_offer_sender and game.draw_offer_sender != user_id:
-            # opp_sid = User.get(game.draw_offer_sender).sid
-            # sio.emit('draw_offer_declined', room=opp_sid)
-            game.draw_offer_sender = None
-            game.save()
+    if game.draw_offer_sender and game.draw_offer_sender != user_id:
+        # opp_sid = User.get(game.draw_offer_sender).sid
+        # sio.emit('draw_offer_declined', room=opp_sid)
+        game.draw_offer_sender = None
+        game.save()
 
 
 @celery.task(name='end_game', ignore_result=True)
@@ -393,75 +335,20 @@ def end_game(game_id: int,
              result: str,
              reason: str,
              update_stats=True) -> None:
-    '''Marks game as finished, emits 'game_ended' signal to users,
-     closes the room,
-     recalculates ratings and k-factors if update_stats is True'''
+    '''Settles the game, emits 'game_ended' signal to users.
+     Ratings and k-factors are recalculated if update_stats is True'''
 
     game = Game.get(game_id)
 
     if game.is_finished:
         return
-
-    if game.first_move_timed_out_task_id:
-        revoke(game.first_move_timed_out_task_id)
-
-    if game.white_disconnect_timed_out_task_id:
-        revoke(game.white_disconnect_timed_out_task_id)
-
-    if game.black_disconnect_timed_out_task_id:
-        revoke(game.black_disconnect_timed_out_task_id)
-
-    if game.white_time_is_up_task_id:
-        revoke(game.white_time_is_up_task_id)
-
-    if game.black_time_is_up_task_id:
-        revoke(game.black_time_is_up_task_id)
-
-    data = {'result': result}
-    sio.emit('game_ended', data, room=game_id)  # Emit to spectators
-
-    data['reason'] = reason
-    sio.emit('game_ended', data, room=game.white_user.sid)
-    sio.emit('game_ended', data, room=game.black_user.sid)
-
-    with rom.util.EntityLock(game, 10, 10):
-        game.is_finished = 1
-        game.result = result
-        with rom.util.EntityLock(game.white_user, 10, 10):
-            game.white_user.cur_game_id = None
-            game.white_user.save()
-
-        with rom.util.EntityLock(game.black_user, 10, 10):
-            game.black_user.cur_game_id = None
-            game.black_user.save()
-
-        game.save()
-
-    if update_stats is False:
+    if not settle_game(game, result, update_stats,
+                       app.config['LEADERBOARD_TIME_CONTROLS']):
         return
 
-    rating_changes = get_rating_changes(game_id)
-
-    with rom.util.EntityLock(game.white_user, 10, 10):
-        game.white_user.games_played += 1
-        game.white_user.save()
-
-    with rom.util.EntityLock(game.black_user, 10, 10):
-        game.black_user.games_played += 1
-        game.black_user.save()
-
-    if result == "1-0":
-        update_rating.delay(game.white_user.id, rating_changes["w"].win)
-        update_rating.delay(game.black_user.id, rating_changes["b"].lose)
-    elif result == "1/2-1/2":
-        update_rating.delay(game.white_user.id, rating_changes["w"].draw)
-        update_rating.delay(game.black_user.id, rating_changes["b"].draw)
-    elif result == "0-1":
-        update_rating.delay(game.white_user.id, rating_changes["w"].lose)
-        update_rating.delay(game.black_user.id, rating_changes["b"].win)
-
-    update_k_factor.delay(game.white_user.id)
-    update_k_factor.delay(game.black_user.id)
+    # Spectators ignore the reason
+    data = {'result': result, 'reason': reason}
+    sio.emit('game_ended', data, room=game_id)
 
 
 # TODO
@@ -502,7 +389,7 @@ def on_disconnect_timed_out(user_id: int, game_id: int) -> None:
         result = "1-0"
         reason = "Black player disconnected. White won."
 
-    end_game(game_id, result, reason)
+    end_game.delay(game_id, result, reason)
 
 
 @celery.task(name="on_time_is_up", ignore_results=True)
@@ -536,152 +423,123 @@ def on_time_is_up(user_id: int, game_id: int) -> None:
     end_game.delay(game_id, result, reason)
 
 
-class RatingChange:
-    '''Class for comfortable work with rating changes'''
-    def __init__(self, win=None, draw=None, lose=None):
-        self.win = win
-        self.draw = draw
-        self.lose = lose
-
-    @staticmethod
-    def from_formula(k: int, e: float):
-        '''Build up RatingChange object from ELO rating system formula'''
-        win = ceil(k * (1 - e))
-        draw = ceil(k * (0.5 - e))
-        lose = ceil(k * (-e))
-        return RatingChange(win, draw, lose)
-
-    def to_dict(self):
-        '''Get rating changes in dict'''
-        return {"win": self.win,
-                "draw": self.draw,
-                "lose": self.lose}
-
-
-def get_rating_changes(game_id: int) -> Dict[str, RatingChange]:
-    '''Returns rating changes for game in dict.
-        Example: {"w": RatingChange, "b": RatingChange}'''
-    game = Game.get(game_id)
-    r_white = game.white_user.rating
-    r_black = game.black_user.rating
-
-    R_white = 10 ** (r_white / 400)
-    R_black = 10 ** (r_black / 400)
-
-    R_sum = R_white + R_black
-
-    E_white = R_white / R_sum
-    E_black = R_black / R_sum
-
-    k_factor_white = game.white_user.k_factor
-    k_factor_black = game.black_user.k_factor
+def create_game(white_user: User, black_user: User, seconds: int) -> None:
+    '''Creates the game, redirects players to it and starts it'''
+    game = Game(
+        white_user=white_user,
+        black_user=black_user,
+        white_rating=white_user.rating,
+        black_rating=black_user.rating,
+        is_started=0,
+    )
+    game.rating_changes = compute_rating_changes(
+        white_user.rating, white_user.k_factor,
+        black_user.rating, black_user.k_factor,
+    )
+    tdelta = timedelta(seconds=seconds)
+    game.total_clock = tdelta
+    game.white_clock = tdelta
+    game.black_clock = tdelta
+    game.save()
+
+    for user in (white_user, black_user):
+        with rom.util.EntityLock(user, 10, 10):
+            user.cur_game_id = game.id
+            user.in_search = False
+            user.save()
 
-    rating_change_white = RatingChange.from_formula(k_factor_white, E_white)
-    rating_change_black = RatingChange.from_formula(k_factor_black, E_black)
+        sio.emit(
+            'redirect',
+            {'url': f'/game/{game.id}'},
+            room=user.sid,
+        )
 
-    return {"w": rating_change_white,
-            "b": rating_change_black}
+    start_game.delay(game.id)
 
 
-@celery.task(name="update_k_factor", ignore_result=True)
-def update_k_factor(user_id: int) -> None:
-    '''Updates k_factor by FIDE rules (after 2014)'''
+@celery.task(name="search_game", ignore_result=True)
+def search_game(user_id: int, seconds: int, token: int) -> None:
+    '''If there is appropriate seek in the order book, it starts a new game.
+       Else it adds the user's seek to the order book. The search with a
+       token of matchmaking.new_search_token(...) is ignored, if the user
+       has cancelled it since.'''
     user = User.get(user_id)
+    opp = None
+    while opp is None:
+        opp_id = matchmaking.pair_or_seek(user_id, user.rating, seconds, token)
+        if opp_id is None:
+            eta = datetime.utcnow() + \
+                timedelta(seconds=matchmaking.MATCH_TICK)
+            timers.arm(timers.match_seeks_timer(seconds), eta,
+                       'match_seeks', (seconds, ), only_new=True)
+            return
+        # The opponent may have been deleted while seeking
+        opp = User.get(opp_id)
 
-    with rom.util.EntityLock(user, 10, 10):
-        if user.k_factor == 40 and user.games_played >= 30:
-            user.k_factor = 20
-            user.save()
+    create_game(user, opp, seconds)
 
-        if (user.k_factor == 20 and user.games_played >= 3
-                and user.rating >= 2400):
-            user.k_factor = 10
-            user.save()
 
+@celery.task(name="match_seeks", ignore_result=True)
+def match_seeks(seconds: int) -> None:
+    '''Pairs waiting seeks of the time control in a batch.
+       Runs again after MATCH_TICK seconds while there are seeks left.'''
+    seeks = matchmaking.get_seeks(seconds)
+    pairs = matchmaking.claim_pairs(seconds, matchmaking.pair_seeks(seeks))
 
-@celery.task(name="update_rating", ignore_result=True)
-def update_rating(user_id: int, rating_delta: int) -> None:
-    '''Update database info about user's rating'''
-    user = User.get(user_id)
-    with rom.util.EntityLock(user, 10, 10):
-        user.rating += rating_delta
-        user.save()
+    for white_id, black_id in pairs:
+        users = User.get([white_id, black_id])
+        if len(users) == 2:
+            create_game(*users, seconds)
+        else:
+            # One was deleted since the claim, the other's search is over
+            matchmaking.cancel_seeks(
+                {user.id: matchmaking.new_search_token(user.id)
+                 for user in users})
 
+    if len(seeks) > 2 * len(pairs):
+        eta = datetime.utcnow() + timedelta(seconds=matchmaking.MATCH_TICK)
+        timers.arm(timers.match_seeks_timer(seconds), eta,
+                   'match_seeks', (seconds, ), only_new=True)
 
-@celery.task(name="search_game", ignore_result=True)
-def search_game(user_id: int, seconds: int) -> None:
-    '''If there is appropriate game request, it starts a new game.
-       Else it makes the game request and adds it to the database.'''
-    user = User.get(user_id)
-    with rom.util.EntityLock(user, 10, 10):
-        game_requests = \
-                rom.query.Query(GameRequest).filter(time=seconds).all()
-
-        added_to_existed = False
-        if game_requests:
-            accepted_request = \
-                min(game_requests,
-                    key=lambda x: abs(User.get(x.user_id).rating - user.rating))
-            if abs(user.rating -
-                   User.get(accepted_request.user_id).rating) <= 200:
-                added_to_existed = True
-
-                accepted_request.delete()
-                user_to_play_with = User.get(accepted_request.user_id)
-
-                game = Game(
-                    white_user=user,
-                    black_user=user_to_play_with,
-                    white_rating=user.rating,
-                    black_rating=user_to_play_with.rating,
-                    is_started=0,
-                )
-                tdelta = timedelta(seconds=seconds)
-                game.total_clock = tdelta
-                game.white_clock = tdelta
-                game.black_clock = tdelta
-                game.save()
 
-                user.cur_game_id = game.id
-                user.save()
+@celery.task(name="cancel_search", ignore_result=True)
+def cancel_search(user_id: int, token: int):
+    '''Cancel game search, if it's possible. The token is of
+       matchmaking.new_search_token(...).'''
+    matchmaking.cancel_seek(user_id, token)
 
-                with rom.util.EntityLock(user_to_play_with, 10, 10):
-                    user_to_play_with.cur_game_id = game.id
-                    user_to_play_with.in_search = False
-                    user_to_play_with.save()
 
-                sio.emit(
-                    'redirect',
-                    {'url': f'/game/{game.id}'},
-                    room=user.sid,
-                )
-                sio.emit(
-                    'redirect',
-                    {'url': f'/game/{game.id}'},
-                    room=user_to_play_with.sid,
-                )
-                start_game.delay(game.id)
+def cancel_search_later(user_id: int) -> None:
+    '''Queues cancel of game search to the next cancel_searches batch.
+       Used on disconnect of every user, most of them aren't searching.'''
+    token = matchmaking.new_search_token(user_id)
+    if task_batching.add('cancel_searches', user_id, token):
+        cancel_searches.delay()
 
-        if added_to_existed is False:
-            user.in_search = True
-            user.save()
 
-            game_request = GameRequest(time=seconds, user_id=user_id)
-            game_request.save()
+@celery.task(name="cancel_searches", ignore_result=True)
+def cancel_searches() -> None:
+    '''Cancels game searches queued by cancel_search_later(...) in bulk'''
+    calls, calls_left = task_batching.take('cancel_searches')
+    if calls_left:
+        cancel_searches.delay()
 
+    if not calls:  # Taken by a previous flush
+        return
 
-@celery.task(name="cancel_search", ignore_result=True)
-def cancel_search(user_id: int):
-    '''Cancel game search, if it's possible'''
-    user = User.get(user_id)
+    tokens = {}
+    for user_id, token in calls:
+        tokens[user_id] = max(token, tokens.get(user_id, 0))
+    matchmaking.cancel_seeks(tokens)
 
-    if not user.in_search:
-        return
 
-    with rom.util.EntityLock(user, 10, 10):
-        user.in_search = False
-        user.save()
+@celery.task(name="process_avatar", ignore_result=True)
+def process_avatar(user_id: int, avatar_hash: str) -> None:
+    '''Makes sized variants of the uploaded profile image and sets it to
+       the user'''
+    if not avatars.process_upload(avatar_hash):
+        return
 
-    game_request = GameRequest.get_by(user_id=user_id, _limit=(0, 1))
-    if game_request:
-        game_request[0].delete()
+    user = User.get(user_id)
+    user.avatar_hash = avatar_hash
+    user.save()
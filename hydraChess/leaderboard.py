@@ -0,0 +1,65 @@
+'''Leaderboards. Ratings of players are kept in Redis sorted sets, so rank
+of a player is found in O(log n) and top players are read page by page.
+The overall board has every player, who finished a rated game. Boards of
+time controls have players, who played it. Ratings aren't kept per time
+control, so every board has the player's current rating: the end of game
+settlement updates it on all boards of TIME_CONTROLS the player is on.'''
+from typing import List, Optional, Tuple
+import rom.util
+
+
+LEADERBOARD_KEY = 'leaderboard'
+PAGE_SIZE = 10
+# Seconds of time controls, which are offered to players
+TIME_CONTROLS = (60, 120, 180, 300, 600, 1200, 1800, 3600)
+
+
+def board_key(seconds: Optional[int] = None) -> str:
+    '''Key of the overall board or of the time control board'''
+    if seconds is None:
+        return LEADERBOARD_KEY
+    return f'{LEADERBOARD_KEY}:{int(seconds)}'
+
+
+def update_rating(user_id: int, rating: int,
+                  seconds: Optional[int] = None) -> None:
+    '''Puts the rating to the overall board and to the time control board,
+       if seconds are given'''
+    pipe = rom.util.get_connection().pipeline(True)
+    pipe.zadd(board_key(), {user_id: rating})
+    if seconds is not None:
+        pipe.zadd(board_key(seconds), {user_id: rating})
+    pipe.execute()
+
+
+def get_rank(user_id: int, seconds: Optional[int] = None) -> Optional[int]:
+    '''Returns 1-based rank of the user, None if the user isn't ranked'''
+    rank = rom.util.get_connection().zrevrank(board_key(seconds), user_id)
+    if rank is None:
+        return None
+    return rank + 1
+
+
+def get_top(start: int = 0, count: int = PAGE_SIZE,
+            seconds: Optional[int] = None) -> List[Tuple[int, int]]:
+    '''Returns (user_id, rating) of players ranked from start + 1'''
+    entries = rom.util.get_connection().zrevrange(
+        board_key(seconds), start, start + count - 1, withscores=True)
+    return [(int(user_id), int(rating)) for user_id, rating in entries]
+
+
+def get_top_players(start: int = 0, count: int = PAGE_SIZE,
+                    seconds: Optional[int] = None) -> List[dict]:
+    '''Returns rank, nickname and rating of players ranked from start + 1'''
+    top = get_top(start, count, seconds)
+
+    pipe = rom.util.get_connection().pipeline(False)
+    for user_id, _ in top:
+        pipe.hget(f'User:{user_id}', 'login')
+    logins = pipe.execute()
+
+    return [{'rank': start + i + 1,
+             'nickname': login.decode(),
+             'rating': rating}
+            for i, ((_, rating), login) in enumerate(zip(top, logins))
+            if login is not None]
@@ -0,0 +1,267 @@
+'''Order books of game seeks. Every time control has a Redis sorted set of
+seeking users scored by their rating, so the nearest opponent is found in
+O(log n). Seeks are matched and removed atomically by Lua scripts.
+
+New seeks are matched greedily on arrival. Seeks, that are still waiting,
+are matched in batches by match_seeks task, which widens their rating
+windows the longer they wait.
+
+Search and cancel requests of a user can run in any order, because they
+run on different shards and workers. So the web process takes a new search
+token of the user for each request. A search, whose token is not the last
+one, was cancelled and doesn't add a seek. A cancel removes only seeks of
+searches requested before it. The scripts set in_search of the user.'''
+from time import time
+from typing import Dict, List, Optional, Tuple
+import rom.util
+from hydraChess.models import USER_CHANGES_CHANNEL
+from hydraChess.redis_utils import LuaScript
+
+
+SEEKS_KEY_PREFIX = 'seeks:'
+SEEKS_USERS_KEY = 'seeks:users'  # user_id -> seconds of the user's seek
+SEEKS_SINCE_KEY = 'seeks:since'  # user_id -> timestamp of the user's seek
+SEEKS_TOKENS_KEY = 'seeks:tokens'  # user_id -> search token of the seek
+SEARCH_TOKEN_KEY_PREFIX = 'search_token:'
+
+MAX_RATING_DIFF = 200
+RATING_DIFF_GROWTH = 10  # Points per second of waiting
+WIDENED_RATING_DIFF_LIMIT = 800
+
+MATCH_TICK = 2  # Seconds between batch matchings of one time control
+PAIRING_LOOKBACK = 3
+
+
+_pair_or_seek_lua = LuaScript('''
+if redis.call('GET', KEYS[5]) ~= ARGV[6] then
+    -- Cancelled since it was requested
+    return false
+end
+if redis.call('HEXISTS', KEYS[2], ARGV[1]) == 1 then
+    return false
+end
+
+local rating = tonumber(ARGV[2])
+local max_diff = tonumber(ARGV[3])
+local lower = redis.call('ZREVRANGEBYSCORE', KEYS[1], rating,
+                         rating - max_diff, 'WITHSCORES', 'LIMIT', 0, 1)
+local upper = redis.call('ZRANGEBYSCORE', KEYS[1], rating, rating + max_diff,
+                         'WITHSCORES', 'LIMIT', 0, 1)
+
+local opp_id = lower[1]
+if upper[1] and (not opp_id or
+        tonumber(upper[2]) - rating < rating - tonumber(lower[2])) then
+    opp_id = upper[1]
+end
+
+if opp_id then
+    redis.call('ZREM', KEYS[1], opp_id)
+    redis.call('HDEL', KEYS[2], opp_id)
+    redis.call('HDEL', KEYS[3], opp_id)
+    redis.call('HDEL', KEYS[4], opp_id)
+    return tonumber(opp_id)
+end
+
+redis.call('ZADD', KEYS[1], rating, ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[4])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[5])
+redis.call('HSET', KEYS[4], ARGV[1], ARGV[6])
+if redis.call('EXISTS', KEYS[6]) == 1 then
+    redis.call('HSET', KEYS[6], 'in_search', '1')
+    redis.call('PUBLISH', ARGV[7], ARGV[1])
+end
+return false
+''')
+
+_cancel_seeks_lua = LuaScript('''
+local removed = 0
+for i = 3, #ARGV, 2 do
+    local user_id, token = ARGV[i], tonumber(ARGV[i + 1])
+    local token_key, user_key = KEYS[i + 1], KEYS[i + 2]
+
+    local seconds = redis.call('HGET', KEYS[1], user_id)
+    local seek_token = tonumber(redis.call('HGET', KEYS[3], user_id))
+    if seconds and (not seek_token or seek_token < token) then
+        redis.call('HDEL', KEYS[1], user_id)
+        redis.call('HDEL', KEYS[2], user_id)
+        redis.call('HDEL', KEYS[3], user_id)
+        removed = removed + redis.call('ZREM', ARGV[1] .. seconds, user_id)
+    end
+
+    -- The user isn't searching, unless a search was requested since
+    if tonumber(redis.call('GET', token_key)) == token and
+            redis.call('HGET', user_key, 'in_search') == '1' then
+        redis.call('HSET', user_key, 'in_search', '')
+        redis.call('PUBLISH', ARGV[2], user_id)
+    end
+end
+return removed
+''')
+
+_get_seeks_lua = LuaScript('''
+local seeks = redis.call('ZRANGE', KEYS[1], 0, -1, 'WITHSCORES')
+local result = {}
+for i = 1, #seeks, 2 do
+    table.insert(result, seeks[i])
+    table.insert(result, seeks[i + 1])
+    table.insert(result, redis.call('HGET', KEYS[2], seeks[i]) or '0')
+end
+return result
+''')
+
+_claim_pairs_lua = LuaScript('''
+local function remove_seek(user_id)
+    redis.call('ZREM', KEYS[1], user_id)
+    redis.call('HDEL', KEYS[2], user_id)
+    redis.call('HDEL', KEYS[3], user_id)
+    redis.call('HDEL', KEYS[4], user_id)
+end
+
+local claimed = {}
+for i = 1, #ARGV, 2 do
+    if redis.call('ZSCORE', KEYS[1], ARGV[i]) and
+            redis.call('ZSCORE', KEYS[1], ARGV[i + 1]) then
+        local white_exists = redis.call('EXISTS', KEYS[4 + i]) == 1
+        local black_exists = redis.call('EXISTS', KEYS[5 + i]) == 1
+        -- Seeks of deleted users are dropped, their opponents keep waiting
+        if not white_exists then
+            remove_seek(ARGV[i])
+        end
+        if not black_exists then
+            remove_seek(ARGV[i + 1])
+        end
+        if white_exists and black_exists then
+            remove_seek(ARGV[i])
+            remove_seek(ARGV[i + 1])
+            table.insert(claimed, ARGV[i])
+            table.insert(claimed, ARGV[i + 1])
+        end
+    end
+end
+return claimed
+''')
+
+
+def seeks_key(seconds: int) -> str:
+    return f'{SEEKS_KEY_PREFIX}{int(seconds)}'
+
+
+def search_token_key(user_id: int) -> str:
+    return f'{SEARCH_TOKEN_KEY_PREFIX}{user_id}'
+
+
+def new_search_token(user_id: int) -> int:
+    '''Returns token of a new search or cancel request of the user.
+       Searches requested before it are ignored by pair_or_seek(...).'''
+    return rom.util.get_connection().incr(search_token_key(user_id))
+
+
+def pair_or_seek(user_id: int, rating: int, seconds: int,
+                 token: int) -> Optional[int]:
+    '''Removes the seek of the nearest by rating opponent and returns their
+       id. If there is no opponent within MAX_RATING_DIFF, adds the user's
+       seek, sets in_search of the user and returns None. Does nothing if
+       the user is already seeking or the search token isn't the last one.'''
+    return _pair_or_seek_lua(
+        keys=(seeks_key(seconds), SEEKS_USERS_KEY, SEEKS_SINCE_KEY,
+              SEEKS_TOKENS_KEY, search_token_key(user_id), f'User:{user_id}'),
+        args=(user_id, rating, MAX_RATING_DIFF, int(seconds), time(), token,
+              USER_CHANGES_CHANNEL),
+    )
+
+
+def cancel_seek(user_id: int, token: int) -> bool:
+    '''Removes the user's seek, if its search was requested before the
+       cancel with the token. Clears in_search of the user, unless a search
+       was requested after the cancel. Returns False if no seek was removed.'''
+    return cancel_seeks({user_id: token}) > 0
+
+
+def cancel_seeks(tokens: Dict[int, int]) -> int:
+    '''Does cancel_seek(...) for each user_id -> token at once.
+       Returns count of removed seeks.'''
+    keys, args = [], []
+    for user_id, token in tokens.items():
+        keys += [search_token_key(user_id), f'User:{user_id}']
+        args += [user_id, token]
+    return _cancel_seeks_lua(
+        keys=(SEEKS_USERS_KEY, SEEKS_SINCE_KEY, SEEKS_TOKENS_KEY, *keys),
+        args=(SEEKS_KEY_PREFIX, USER_CHANGES_CHANNEL, *args))
+
+
+def get_seeks(seconds: int) -> List[Tuple[int, int, float]]:
+    '''Returns seeks of the time control as (user_id, rating, waited seconds)
+       sorted by rating'''
+    now = time()
+    raw_seeks = _get_seeks_lua(keys=(seeks_key(seconds), SEEKS_SINCE_KEY))
+    return [(int(raw_seeks[i]), int(float(raw_seeks[i + 1])),
+             now - float(raw_seeks[i + 2]))
+            for i in range(0, len(raw_seeks), 3)]
+
+
+def claim_pairs(seconds: int,
+                pairs: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    '''Atomically removes seeks of the pairs, whose both seeks and users
+       still exist. Seeks of deleted users are removed as well.
+       Returns the removed pairs.'''
+    if not pairs:
+        return []
+
+    user_ids = [user_id for pair in pairs for user_id in pair]
+    claimed = _claim_pairs_lua(
+        keys=(seeks_key(seconds), SEEKS_USERS_KEY, SEEKS_SINCE_KEY,
+              SEEKS_TOKENS_KEY, *[f'User:{user_id}' for user_id in user_ids]),
+        args=user_ids,
+    )
+    return [(int(claimed[i]), int(claimed[i + 1]))
+            for i in range(0, len(claimed), 2)]
+
+
+def get_rating_window(waited: float) -> float:
+    '''Max rating difference the seek accepts after waiting for a while'''
+    return min(MAX_RATING_DIFF + RATING_DIFF_GROWTH * waited,
+               WIDENED_RATING_DIFF_LIMIT)
+
+
+def pair_seeks(seeks: List[Tuple[int, int, float]]) -> List[Tuple[int, int]]:
+    '''Pairs seeks sorted by rating, maximizing the number of pairs, then
+       minimizing their total rating difference. Two seeks can be paired if
+       the difference fits into rating windows of both ones.
+
+       Only seeks, that are close in the rating order, are paired, so it
+       takes O(n * PAIRING_LOOKBACK). Longer waiting seek goes first.'''
+    n = len(seeks)
+    windows = [get_rating_window(waited) for _, _, waited in seeks]
+
+    # best[i] is (-pairs count, total difference) for the first i seeks,
+    # prev[i] is the first seek of the last pair or -1 if seek i-1 is free.
+    best = [(0, 0)] * (n + 1)
+    prev = [-1] * (n + 1)
+    for i in range(2, n + 1):
+        best[i], prev[i] = best[i - 1], -1
+        rating = seeks[i - 1][1]
+        for j in range(i - 2, max(i - 2 - PAIRING_LOOKBACK, -1), -1):
+            diff = rating - seeks[j][1]
+            if diff > windows[i - 1]:
+                break
+            if diff > windows[j]:
+                continue
+            pairs_cnt, total_diff = best[j]
+            candidate = (pairs_cnt - 1, total_diff + diff)
+            if candidate < best[i]:
+                best[i], prev[i] = candidate, j
+
+    pairs = []
+    i = n
+    while i >= 2:
+        j = prev[i]
+        if j == -1:
+            i -= 1
+            continue
+
+        first, second = seeks[j], seeks[i - 1]
+        if first[2] < second[2]:
+            first, second = second, first
+        pairs.append((first[0], second[0]))
+        i = j
+    return pairs
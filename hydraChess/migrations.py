@@ -0,0 +1,108 @@
+'''Data migrations. Run them with "python3 -m hydraChess.migrations"'''
+import os
+import rom.util
+from hydraChess.config import ProductionConfig
+from hydraChess.models import User, Game, migrate_raw_moves
+from hydraChess import avatars, game_history, leaderboard
+
+
+def drop_game_requests() -> int:
+    '''Drops GameRequest entities, which were replaced by order books.
+       Their users have to start the search again.'''
+    conn = rom.util.get_connection()
+    dropped = 0
+    for key in conn.scan_iter('GameRequest:*'):
+        if not key.split(b':')[1].isdigit():
+            conn.delete(key)
+            continue
+
+        user = User.get(int(conn.hget(key, 'user_id') or 0))
+        if user:
+            user.in_search = False
+            user.save()
+
+        conn.delete(key)
+        dropped += 1
+    return dropped
+
+
+def fill_leaderboards() -> int:
+    '''Puts players of finished games to the leaderboards.
+       Returns number of the players.'''
+    ranked = set()
+    for game in Game.query.iter_result():
+        if not game.is_finished or \
+                game.result not in game_history.RATED_RESULTS:
+            continue
+
+        seconds = int(game.total_clock.total_seconds())
+        for user in (game.white_user, game.black_user):
+            leaderboard.update_rating(user.id, user.rating, seconds)
+            ranked.add(user.id)
+    return len(ranked)
+
+
+def fill_game_histories() -> int:
+    '''Adds finished games to game histories of their players.
+       Returns number of the games.'''
+    added = 0
+    for game in Game.query.iter_result():
+        if not game.is_finished or \
+                game.result not in game_history.RATED_RESULTS:
+            continue
+
+        seconds = int(game.total_clock.total_seconds())
+        end_datetime = game.end_datetime or game.last_move_datetime
+        for user, is_white in ((game.white_user, True),
+                               (game.black_user, False)):
+            outcome = game_history.get_outcome(game.result, is_white)
+            game_history.add_game(user.id, game.id, outcome, seconds,
+                                  end_datetime)
+        added += 1
+    return added
+
+
+def fill_rating_changes() -> int:
+    '''Stores rating stakes of unfinished games created before they were
+       stored. Returns number of the games.'''
+    filled = 0
+    for game in Game.query.iter_result():
+        if game.is_finished or game.raw_rating_changes:
+            continue
+
+        game.rating_changes = game.rating_changes
+        game.save()
+        filled += 1
+    return filled
+
+
+def make_avatar_variants() -> int:
+    '''Makes sized variants of profile images uploaded as single JPEG files.
+       Returns number of the images.'''
+    made = 0
+    for user in User.query.iter_result():
+        avatar_hash = user.avatar_hash
+        path = os.path.join(avatars.AVATARS_DIR, f'{avatar_hash}.jpg')
+        if avatar_hash == avatars.DEFAULT_AVATAR or \
+                avatars.has_variants(avatar_hash) or not os.path.exists(path):
+            continue
+
+        with open(path, 'rb') as img:
+            avatars.make_variants(img.read(), avatar_hash)
+        made += 1
+    return made
+
+
+def run_migrations() -> None:
+    print(f"Packed moves of {migrate_raw_moves()} games")
+    print(f"Dropped {drop_game_requests()} game requests")
+    print(f"Put {fill_leaderboards()} players to leaderboards")
+    print(f"Added {fill_game_histories()} games to game histories")
+    print(f"Stored rating stakes of {fill_rating_changes()} games")
+    print(f"Made variants of {make_avatar_variants()} profile images")
+
+
+if __name__ == '__main__':
+    rom.util.set_connection_settings(db=ProductionConfig.REDIS_DB_ID)
+    rom.util.use_null_session()
+    run_migrations()
@@ -1,9 +1,19 @@
 from datetime import timedelta
-from werkzeug.security import generate_password_hash, check_password_hash
-from chess import Board, WHITE, BLACK
+from math import ceil
+from struct import pack, iter_unpack
+from typing import Dict, Iterator, List, Optional, Set, Union
+import json
+from chess import Board, Move, WHITE, BLACK
 from flask_login import UserMixin
 import rom
 import rom.util
+from hydraChess.board_cache import board_cache
+from hydraChess import archive, auth
+from hydraChess.redis_utils import LuaScript
+
+
+# Ids of changed users are published there, see user_cache
+USER_CHANGES_CHANNEL = 'user_changes'
 
 
 class User(rom.Model, UserMixin):
@@ -28,10 +38,120 @@ class User(rom.Model, UserMixin):
     avatar_hash = rom.Text(default="default")
 
     def set_password(self, password: str) -> None:
-        self.hashed_password = generate_password_hash(password)
+        self.hashed_password = auth.hash_password(password)
 
     def check_password(self, password: str) -> bool:
-        return check_password_hash(self.hashed_password, password)
+        return auth.check_password(self.hashed_password, password)
+
+    def set_sid(self, sid: str) -> None:
+        '''Stores socket id of the user in one round trip. sid isn't
+           indexed, so the user doesn't need to be locked.'''
+        pipe = self._connection.pipeline(False)
+        pipe.hset(self._pk, 'sid', sid)
+        pipe.publish(USER_CHANGES_CHANNEL, self.id)
+        pipe.execute()
+
+    def _after_update(self) -> None:
+        self._connection.publish(USER_CHANGES_CHANNEL, self.id)
+
+    def _after_delete(self) -> None:
+        self._connection.publish(USER_CHANGES_CHANNEL, self.id)
+
+
+class RatingChange:
+    '''Class for comfortable work with rating changes'''
+    def __init__(self, win=None, draw=None, lose=None):
+        self.win = win
+        self.draw = draw
+        self.lose = lose
+
+    @staticmethod
+    def from_formula(k: int, e: float):
+        '''Build up RatingChange object from ELO rating system formula'''
+        win = ceil(k * (1 - e))
+        draw = ceil(k * (0.5 - e))
+        lose = ceil(k * (-e))
+        return RatingChange(win, draw, lose)
+
+    def to_dict(self):
+        '''Get rating changes in dict'''
+        return {"win": self.win,
+                "draw": self.draw,
+                "lose": self.lose}
+
+
+def compute_rating_changes(white_rating: int, white_k_factor: int,
+                           black_rating: int, black_k_factor: int,
+                           ) -> Dict[str, RatingChange]:
+    '''Returns rating changes for game in dict.
+        Example: {"w": RatingChange, "b": RatingChange}'''
+    R_white = 10 ** (white_rating / 400)
+    R_black = 10 ** (black_rating / 400)
+
+    R_sum = R_white + R_black
+
+    E_white = R_white / R_sum
+    E_black = R_black / R_sum
+
+    return {"w": RatingChange.from_formula(white_k_factor, E_white),
+            "b": RatingChange.from_formula(black_k_factor, E_black)}
+
+
+def parse_clock(raw_clock: str) -> timedelta:
+    '''Parses clock stored as "seconds.microseconds"'''
+    seconds, microseconds = map(int, raw_clock.split('.'))
+    return timedelta(seconds=seconds, microseconds=microseconds)
+
+
+def pack_move(move: Move) -> bytes:
+    '''Packs move into 2 bytes: from square, to square and promotion'''
+    code = move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+    return pack('<H', code)
+
+
+def unpack_moves(packed: bytes) -> List[Move]:
+    '''Unpacks moves packed by pack_move(...)'''
+    return [Move(code & 63, code >> 6 & 63, code >> 12 or None)
+            for code, in iter_unpack('<H', packed)]
+
+
+_save_info_lua = LuaScript('''
+local info = redis.call('GET', KEYS[1])
+local fields = cjson.decode(ARGV[1])
+if not info and fields.moves == nil then
+    return false
+end
+
+info = info and cjson.decode(info) or {version = 0}
+for field, value in pairs(fields) do
+    if value == cjson.null then
+        info[field] = nil
+    else
+        info[field] = value
+    end
+end
+info.version = info.version + 1
+
+info = cjson.encode(info)
+redis.call('SET', KEYS[1], info)
+return info
+''')
+
+
+# Info snapshot field -> columns of the game, which it's derived from
+INFO_FIELD_COLUMNS = {
+    'white_user': ('white_user', 'white_rating'),
+    'black_user': ('black_user', 'black_rating'),
+    'moves_cnt': ('moves_cnt', 'raw_moves'),
+    'white_clock': ('raw_white_clock', ),
+    'black_clock': ('raw_black_clock', ),
+    'last_move_datetime': ('last_move_datetime', ),
+    'draw_offer_sender': ('draw_offer_sender', ),
+    'is_finished': ('is_finished', ),
+    'result': ('result', ),
+    'total_clock': ('raw_total_clock', ),
+    'rating_changes': ('white_user', 'black_user', 'raw_rating_changes'),
+}
 
 
 class Game(rom.Model):
@@ -47,34 +167,32 @@ class Game(rom.Model):
     is_finished = rom.Boolean(default=False)
     result = rom.Text(default='*')
 
+    # Moves are packed by pack_move(...) and stored in a separate binary
+    # string, see moves_key. raw_moves only holds comma separated SAN moves
+    # of games that were not migrated yet.
     raw_moves = rom.Text(default="")
+    moves_cnt = rom.Integer(default=0)
+    # Position after the last capture or pawn move and its ply number.
+    # Replaying moves made after it restores the board with the whole
+    # history needed for repetition detection.
+    board_fen = rom.Text()
+    board_fen_ply = rom.Integer(default=0)
     last_move_datetime = rom.DateTime()
+    end_datetime = rom.DateTime()
 
     raw_total_clock = rom.Text(default="0.0")
     raw_white_clock = rom.Text(default="0.0")
     raw_black_clock = rom.Text(default="0.0")
 
-    first_move_timed_out_task_id = rom.Text()
-    first_move_timed_out_task_eta = rom.DateTime()
-
-    white_time_is_up_task_id = rom.Text()
-    white_time_is_up_task_eta = rom.DateTime()
-
-    white_disconnect_timed_out_task_id = rom.Text()
-    white_disconnect_timed_out_task_eta = rom.DateTime()
-
-    black_disconnect_timed_out_task_id = rom.Text()
-    black_disconnect_timed_out_task_eta = rom.DateTime()
-
-    white_time_is_up_task_id = rom.Text()
-    black_time_is_up_task_id = rom.Text()
-
     draw_offer_sender = rom.Integer(default=None)
 
+    # Win, draw and lose rating changes of white, then of black,
+    # computed when the game is created.
+    raw_rating_changes = rom.Text()
+
     @property
     def total_clock(self) -> timedelta:
-        seconds, microseconds = map(int, self.raw_total_clock.split('.'))
-        return timedelta(seconds=seconds, microseconds=microseconds)
+        return parse_clock(self.raw_total_clock)
 
     @total_clock.setter
     def total_clock(self, tdelta: timedelta) -> None:
@@ -84,8 +202,7 @@ class Game(rom.Model):
 
     @property
     def black_clock(self) -> timedelta:
-        seconds, microseconds = map(int, self.raw_black_clock.split('.'))
-        return timedelta(seconds=seconds, microseconds=microseconds)
+        return parse_clock(self.raw_black_clock)
 
     @black_clock.setter
     def black_clock(self, tdelta: timedelta) -> None:
@@ -95,8 +212,7 @@ class Game(rom.Model):
 
     @property
     def white_clock(self) -> timedelta:
-        seconds, microseconds = map(int, self.raw_white_clock.split('.'))
-        return timedelta(seconds=seconds, microseconds=microseconds)
+        return parse_clock(self.raw_white_clock)
 
     @white_clock.setter
     def white_clock(self, tdelta: timedelta) -> None:
@@ -104,31 +220,270 @@ class Game(rom.Model):
         microseconds = tdelta.microseconds
         self.raw_white_clock = f"{seconds}.{microseconds}"
 
+    @property
+    def rating_changes(self) -> Dict[str, RatingChange]:
+        '''Rating changes, that are at stake in the game.
+           Example: {"w": RatingChange, "b": RatingChange}'''
+        if not self.raw_rating_changes:
+            # Games created before the stakes were stored. They're computed
+            # without setting the column, so reading it doesn't make the
+            # game modified, see fill_rating_changes() in migrations.py
+            return compute_rating_changes(
+                self.white_user.rating, self.white_user.k_factor,
+                self.black_user.rating, self.black_user.k_factor,
+            )
+
+        changes = list(map(int, self.raw_rating_changes.split(',')))
+        return {"w": RatingChange(*changes[:3]),
+                "b": RatingChange(*changes[3:])}
+
+    @rating_changes.setter
+    def rating_changes(self, changes: Dict[str, RatingChange]) -> None:
+        self.raw_rating_changes = ','.join(
+            str(value) for color in ('w', 'b')
+            for value in (changes[color].win, changes[color].draw,
+                          changes[color].lose))
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Packed moves, if they were loaded, and moves to be saved
+        self._packed_moves = b"" if self._new else None
+        self._pending_moves = b""
+        self._moves_replaced = False
+        # Games loaded from the archive are read-only
+        self.is_archived = False
+        self._archived_info = None
+
+    @classmethod
+    def get(cls, ids):
+        '''Loads games from Redis, falling back to the archive'''
+        single = not isinstance(ids, (list, tuple, set, frozenset))
+        games = super().get(ids)
+        if single:
+            if games is None:
+                games = cls._get_archived([int(ids)])
+                return games[0] if games else None
+            return games
+
+        ids = [int(game_id) for game_id in ids]
+        loaded_ids = {game.id for game in games}
+        missing_ids = [game_id for game_id in ids
+                       if game_id not in loaded_ids]
+        if not missing_ids:
+            return games
+
+        games_by_id = {game.id: game
+                       for game in games + cls._get_archived(missing_ids)}
+        return [games_by_id[game_id] for game_id in ids
+                if game_id in games_by_id]
+
+    @classmethod
+    def _get_archived(cls, ids: List[int]) -> List['Game']:
+        games = []
+        for data, packed_moves, info in archive.get_games(ids).values():
+            # Archived games are not tracked by the session, so they are
+            # never written back to Redis
+            game = cls(_loading=True, _bypass_session_entirely=True, **data)
+            game._packed_moves = packed_moves
+            game.is_archived = True
+            game._archived_info = info
+            games.append(game)
+        return games
+
+    @property
+    def moves_key(self) -> str:
+        return f"{self._pk}:moves"
+
+    @property
+    def info_key(self) -> str:
+        return f"{self._pk}:info"
+
+    def _before_update(self) -> None:
+        self._changed_columns = self._get_changed_columns()
+
+    def _after_insert(self) -> None:
+        self._save_moves()
+        self._save_info()
+
+    def _after_update(self) -> None:
+        moves_changed = self._moves_replaced or bool(self._pending_moves)
+        self._save_moves()
+        self._save_info(moves_changed, self._changed_columns)
+
+    def _after_delete(self) -> None:
+        self._connection.delete(self.moves_key, self.info_key)
+
+    def _get_changed_columns(self) -> Set[str]:
+        '''Columns, which save() is going to write, compared the same way
+           as rom does it'''
+        changed = set()
+        for attr, column in self._columns.items():
+            old = self._last.get(attr)
+            if old is not None:
+                old = column._from_redis(old)
+            if self._data.get(attr) != old:
+                changed.add(attr)
+        return changed
+
+    def _save_moves(self) -> None:
+        if self._moves_replaced:
+            self._connection.set(self.moves_key, self._packed_moves)
+        elif self._pending_moves:
+            self._connection.append(self.moves_key, self._pending_moves)
+
+        self._pending_moves = b""
+        self._moves_replaced = False
+
+    def _get_info_fields(self, moves_changed: bool = True,
+                         columns: Optional[Set[str]] = None) -> dict:
+        '''Fields of the info snapshot. Only fields derived from the columns
+           are returned, if they are given.'''
+        fields = {}
+        for field, field_columns in INFO_FIELD_COLUMNS.items():
+            if columns is None or not columns.isdisjoint(field_columns):
+                fields[field] = None
+
+        if 'white_user' in fields:
+            fields['white_user'] = self._get_user_info(self.white_user,
+                                                       self.white_rating)
+        if 'black_user' in fields:
+            fields['black_user'] = self._get_user_info(self.black_user,
+                                                       self.black_rating)
+        if 'moves_cnt' in fields:
+            fields['moves_cnt'] = self.get_moves_cnt()
+        if 'white_clock' in fields:
+            fields['white_clock'] = self.raw_white_clock
+        if 'black_clock' in fields:
+            fields['black_clock'] = self.raw_black_clock
+        if 'last_move_datetime' in fields and self.last_move_datetime:
+            fields['last_move_datetime'] = \
+                repr(rom.util.dt2ts(self.last_move_datetime))
+        if 'draw_offer_sender' in fields:
+            fields['draw_offer_sender'] = self.draw_offer_sender
+        if 'is_finished' in fields:
+            fields['is_finished'] = bool(self.is_finished)
+        if 'result' in fields:
+            fields['result'] = self.result
+        if 'total_clock' in fields:
+            fields['total_clock'] = self.raw_total_clock
+        if 'rating_changes' in fields and self.white_user and \
+                self.black_user:
+            fields['rating_changes'] = {
+                color: change.to_dict()
+                for color, change in self.rating_changes.items()}
+        if moves_changed:
+            fields['moves'] = ','.join(self.moves)
+        return fields
+
+    def _save_info(self, moves_changed: bool = True,
+                   columns: Optional[Set[str]] = None) -> Optional[bytes]:
+        '''Merges state of the game into its info snapshot. Only fields of
+           the changed columns are merged, if they are given, so a game
+           loaded before a move was committed by a script doesn't overwrite
+           the move's fields. Returns the new snapshot.'''
+        fields = self._get_info_fields(moves_changed, columns)
+        if not fields:
+            return None
+        info = _save_info_lua(keys=(self.info_key, ),
+                              args=(json.dumps(fields), ),
+                              conn=self._connection)
+        if info is None and not moves_changed:
+            # The snapshot doesn't exist yet
+            return self._save_info(moves_changed=True)
+        return info
+
+    @staticmethod
+    def _get_user_info(user: Optional[User], rating: int) -> Optional[dict]:
+        if user is None:
+            return None
+        return {'id': user.id, 'nickname': user.login, 'rating': rating}
+
+    def get_archived_info(self) -> dict:
+        '''Returns info snapshot of the archived game'''
+        if self._archived_info is not None:
+            info = json.loads(self._archived_info)
+            if 'rating_changes' in info:
+                return info
+
+        info = {key: value for key, value in self._get_info_fields().items()
+                if value is not None}
+        info['version'] = 0
+        return info
+
+    def _migrate_raw_moves(self) -> None:
+        '''Converts SAN moves of the old format to packed ones'''
+        board = Board()
+        packed_moves = b""
+        for move_san in self.raw_moves.split(','):
+            move = board.push_san(move_san)
+            packed_moves += pack_move(move)
+
+        self._packed_moves = packed_moves
+        self._moves_replaced = True
+        self.moves_cnt = len(board.move_stack)
+        self.raw_moves = ""
+
+    def get_packed_moves(self, start: int = 0) -> bytes:
+        '''Returns packed moves, starting from the given ply'''
+        if self.raw_moves:
+            self._migrate_raw_moves()
+
+        if self._packed_moves is not None:
+            return self._packed_moves[2 * start:]
+
+        saved_cnt = self.moves_cnt - len(self._pending_moves) // 2
+        if start >= saved_cnt:
+            return self._pending_moves[2 * (start - saved_cnt):]
+
+        saved_moves = self._connection.getrange(self.moves_key, 2 * start, -1)
+        if start == 0:
+            self._packed_moves = saved_moves + self._pending_moves
+        return saved_moves + self._pending_moves
+
     @property
     def moves(self) -> list:
-        raw_moves = self.raw_moves
-        if raw_moves:
-            return list(raw_moves.split(','))
-        return []
+        '''SAN moves. They are rendered on each access, so use it only
+           when SAN is really needed.'''
+        board = Board()
+        moves = []
+        for move in unpack_moves(self.get_packed_moves()):
+            moves.append(board.san(move))
+            board.push(move)
+        return moves
 
     @moves.setter
     def moves(self, moves: list) -> None:
-        if not moves:
-            self.raw_moves = ""
-        else:
-            self.raw_moves = ','.join(moves)
+        board = Board()
+        packed_moves = b""
+        for move_san in moves or []:
+            packed_moves += pack_move(board.push_san(move_san))
 
-    def get_moves_cnt(self) -> int:
-        raw_moves = self.raw_moves
-        if raw_moves:
-            return raw_moves.count(',') + 1
-        return 0
+        self.raw_moves = ""
+        self._packed_moves = packed_moves
+        self._pending_moves = b""
+        self._moves_replaced = True
+        self.moves_cnt = len(board.move_stack)
 
-    def append_move(self, move_san: str) -> None:
+        self.board_fen = None
+        self.board_fen_ply = 0
+        board_cache.discard(self.id)
+
+    def get_moves_cnt(self) -> int:
         if self.raw_moves:
-            self.raw_moves += f",{move_san}"
-        else:
-            self.raw_moves = move_san
+            self._migrate_raw_moves()
+        return self.moves_cnt
+
+    def append_move(self, move: Union[Move, str]) -> None:
+        '''Appends move to the game. SAN move is parsed in the current
+           position.'''
+        if isinstance(move, str):
+            move = self.get_board().parse_san(move)
+
+        packed_move = pack_move(move)
+        if self._packed_moves is not None:
+            self._packed_moves += packed_move
+        self._pending_moves += packed_move
+        self.moves_cnt = self.get_moves_cnt() + 1
 
     def get_next_to_move(self) -> bool:
         moves_cnt = self.get_moves_cnt()
@@ -136,15 +491,85 @@ class Game(rom.Model):
             return WHITE
         return BLACK
 
+    def push_san(self, board: Board, move_san: str) -> None:
+        '''Makes move on the board, which must be taken from get_board(),
+           and appends it to the game. Raises ValueError on illegal move.'''
+        move = board.push_san(move_san)
+        self.append_move(move)
+
+        moves_cnt = self.get_moves_cnt()
+        if board.halfmove_clock == 0 or not self.board_fen:
+            tail = min(board.halfmove_clock, len(board.move_stack))
+            self.board_fen = board.copy(stack=tail).root().fen()
+            self.board_fen_ply = moves_cnt - tail
+
+        board_cache.put(self.id, moves_cnt, board)
+
     def get_board(self) -> Board:
-        board = Board()
-        for move in self.moves:
-            board.push_san(move)
-        return board
+        '''Returns board with the current position. Its move stack only
+           reaches back to the last capture or pawn move.'''
+        moves_cnt = self.get_moves_cnt()
+        board = board_cache.get(self.id, moves_cnt)
+        if board is not None:
+            return board
 
+        if self.board_fen and self.board_fen_ply <= moves_cnt:
+            board = Board(self.board_fen)
+            packed_moves = self.get_packed_moves(self.board_fen_ply)
+        else:
+            board = Board()
+            packed_moves = self.get_packed_moves()
+
+        for move in unpack_moves(packed_moves):
+            board.push(move)
+
+        board_cache.put(self.id, moves_cnt, board)
+        return board
 
-class GameRequest(rom.Model):
-    id = rom.PrimaryKey(index=True)
 
-    time = rom.Float(index=True)
-    user_id = rom.Integer(index=True)
+def get_game_info(game_id: int) -> Optional[dict]:
+    '''Returns info snapshot of the game, which is kept up to date on each
+       move and each save of the game. Snapshots of old games are created on
+       the first request.'''
+    info = rom.util.get_connection().get(f'Game:{game_id}:info')
+    if info is not None:
+        info = json.loads(info)
+
+    if info is None or 'rating_changes' not in info:
+        game = Game.get(game_id)
+        if game is None:
+            return None
+        if game.is_archived:
+            return game.get_archived_info()
+        info = json.loads(game._save_info())
+    return info
+
+
+def iter_game_ids(batch_size: int = 100) -> Iterator[int]:
+    '''Yields ids of games stored in Redis in order of creation'''
+    conn = rom.util.get_connection()
+    min_score = '-inf'
+    while True:
+        game_ids = conn.zrangebyscore('Game:id:idx', min_score, '+inf',
+                                      start=0, num=batch_size)
+        for game_id in game_ids:
+            yield int(game_id)
+
+        if len(game_ids) < batch_size:
+            return
+        min_score = f'({int(game_ids[-1])}'
+
+
+def migrate_raw_moves() -> int:
+    '''Packs moves of all games, which still use the old format, and
+       stores moves_cnt of the old games without moves.
+       Returns number of migrated games.'''
+    migrated = 0
+    for game_id in iter_game_ids():
+        game = Game.get(game_id)
+        if game is not None and (game.raw_moves or
+                                 game._last.get('moves_cnt') is None):
+            game.get_moves_cnt()
+            game.save()
+            migrated += 1
+    return migrated
@@ -0,0 +1,284 @@
+'''Move commit path. A move is validated against the cached board of the game
+and committed by one Lua script, which checks the ply and the turn, appends
+the packed move, updates clocks and last_move_datetime, clears the opponent's
+draw offer, re-arms game timers and updates the info snapshot of the game.
+Nothing is locked: the script rejects the move, if another one was committed
+since the board was read.
+
+Web processes pre-validate moves with prevalidate_move(...), so junk and
+out-of-turn moves never reach the broker.'''
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from time import monotonic
+from typing import NamedTuple, Optional, Tuple
+import json
+from chess import Board, Move
+import rom.util
+from hydraChess.board_cache import board_cache
+from hydraChess.models import Game, pack_move, parse_clock, unpack_moves
+from hydraChess.redis_utils import LuaScript
+from hydraChess import entity_session, timers
+
+
+_commit_move_lua = LuaScript('''
+local function parse_clock(raw)
+    local seconds, microseconds = string.match(raw, '(%d+)%.(%d+)')
+    return tonumber(seconds) * 1000000 + tonumber(microseconds)
+end
+
+local function parse_timestamp(raw)
+    -- Exact microseconds, float seconds lose them in multiplication
+    local seconds, fraction = string.match(raw, '(%d+)%.?(%d*)')
+    fraction = string.sub(fraction .. '000000', 1, 6)
+    return tonumber(seconds) * 1000000 + tonumber(fraction)
+end
+
+local function format_clock(clock)
+    clock = math.max(clock, 0)
+    return string.format('%d.%d', math.floor(clock / 1000000),
+                         clock % 1000000)
+end
+
+local state = redis.call('HMGET', KEYS[1], 'is_finished', 'moves_cnt',
+                         'white_user', 'black_user',
+                         'raw_white_clock', 'raw_black_clock',
+                         'last_move_datetime', 'draw_offer_sender')
+local ply = tonumber(ARGV[1])
+if state[1] ~= '' or tonumber(state[2]) ~= ply then
+    return false
+end
+
+local mover, opp = 1, 2  -- Indices of white and black
+if ply % 2 == 1 then
+    mover, opp = 2, 1
+end
+if state[2 + mover] ~= ARGV[2] then
+    return false
+end
+
+local now = parse_timestamp(ARGV[4])
+local clocks = {parse_clock(state[5]), parse_clock(state[6])}
+if ply ~= 0 and state[7] then
+    clocks[mover] = clocks[mover] - (now - parse_timestamp(state[7]))
+end
+clocks = {format_clock(clocks[1]), format_clock(clocks[2])}
+
+redis.call('APPEND', KEYS[2], ARGV[3])
+redis.call('HSET', KEYS[1], 'moves_cnt', ply + 1,
+           'raw_white_clock', clocks[1], 'raw_black_clock', clocks[2],
+           'last_move_datetime', ARGV[4])
+if ARGV[5] ~= '' then
+    redis.call('HSET', KEYS[1], 'board_fen', ARGV[5], 'board_fen_ply', ply + 1)
+end
+local draw_offer_declined = state[8] and state[8] ~= ARGV[2]
+if draw_offer_declined then
+    -- Decline draw offer only if it was asked by the opp
+    redis.call('HDEL', KEYS[1], 'draw_offer_sender')
+end
+
+-- Re-arming the game timer cancels the timer of the mover
+redis.call('ZADD', KEYS[3], (now + parse_clock(clocks[opp])) / 1000000,
+           ARGV[6])
+redis.call('HSET', KEYS[4], ARGV[6], ARGV[7])
+
+if ARGV[9] == 'cancel' then
+    redis.call('ZREM', KEYS[3], ARGV[8])
+    redis.call('HDEL', KEYS[4], ARGV[8])
+elseif ARGV[9] ~= '' then
+    redis.call('ZADD', KEYS[3], ARGV[9], ARGV[8])
+    redis.call('HSET', KEYS[4], ARGV[8], ARGV[10])
+end
+
+-- Snapshots of old games are created on the first request
+local info = redis.call('GET', KEYS[5])
+if info then
+    info = cjson.decode(info)
+    if info.moves == '' then
+        info.moves = ARGV[11]
+    else
+        info.moves = info.moves .. ',' .. ARGV[11]
+    end
+    info.moves_cnt = ply + 1
+    info.white_clock, info.black_clock = clocks[1], clocks[2]
+    info.last_move_datetime = ARGV[4]
+    if draw_offer_declined then
+        info.draw_offer_sender = nil
+    end
+    info.version = info.version + 1
+    redis.call('SET', KEYS[5], cjson.encode(info))
+end
+
+return clocks
+''')
+
+
+# Reasons of rejection, which are reported to clients
+GAME_NOT_FOUND = "Game not found."
+GAME_IS_OVER = "The game is over."
+NOT_PLAYER = "You are not a player of the game."
+NOT_YOUR_TURN = "Not your turn."
+ILLEGAL_MOVE = "Illegal move."
+MOVE_ALREADY_SENT = "The move is already sent."
+
+# Ply count and time, at which a move of each game was forwarded by this
+# process. The same ply can be sent again after MOVE_RESEND_DELAY seconds.
+_forwarded_plies = OrderedDict()
+_MAX_FORWARDED_PLIES = 1024
+MOVE_RESEND_DELAY = 2
+
+
+class MoveContext(NamedTuple):
+    '''State of the game needed to validate a move'''
+    game_id: int
+    white_user_id: int
+    black_user_id: int
+    ply: int
+    board: Board
+
+
+def load_move_context(game_id: int) -> Optional[MoveContext]:
+    '''Reads the game state in one round trip, if its board is cached.
+       Returns None if the game doesn't exist or is finished.'''
+    is_finished, white_user_id, black_user_id, moves_cnt, raw_moves = \
+        rom.util.get_connection().hmget(
+            f'Game:{game_id}', 'is_finished', 'white_user', 'black_user',
+            'moves_cnt', 'raw_moves')
+    if is_finished is None or is_finished == b'1':
+        return None
+
+    # Games of the old formats are migrated, before moves are packed
+    is_migrated = moves_cnt is not None and not raw_moves
+    board = None
+    if is_migrated:
+        ply = int(moves_cnt)
+        board = board_cache.get(game_id, ply)
+    if board is None:
+        game = Game.get(game_id)
+        if not is_migrated:
+            game.get_moves_cnt()
+            game.save()
+        ply = game.get_moves_cnt()
+        board = game.get_board()
+
+    return MoveContext(game_id, int(white_user_id), int(black_user_id),
+                       ply, board)
+
+
+def _get_web_board(game_id: int, ply: int) -> Optional[Board]:
+    '''Returns board of the given ply count, replaying only moves made
+       since the cached board'''
+    board = board_cache.get(game_id, ply)
+    if board is not None:
+        return board
+
+    cached = board_cache.get_latest(game_id)
+    if cached is not None and cached[0] < ply:
+        cached_ply, board = cached
+        packed_moves = rom.util.get_connection().getrange(
+            f'Game:{game_id}:moves', 2 * cached_ply, -1)
+        if len(packed_moves) == 2 * (ply - cached_ply):
+            for move in unpack_moves(packed_moves):
+                board.push(move)
+            board_cache.put(game_id, ply, board)
+            return board
+
+    game = Game.get(game_id)
+    if game is None or game.get_moves_cnt() != ply:
+        return None
+    return game.get_board()
+
+
+def prevalidate_move(user_id: int, game_id: int,
+                     move_san: str) -> Optional[str]:
+    '''Cheap check of a move in the web process, before it's sent to the
+       broker. Usually takes one round trip, the board is cached.
+       Returns reason of rejection, None if the move should be sent.
+       Workers validate moves anyway.'''
+    is_finished, white_user_id, black_user_id, moves_cnt, raw_moves = \
+        rom.util.get_connection().hmget(
+            f'Game:{game_id}', 'is_finished', 'white_user', 'black_user',
+            'moves_cnt', 'raw_moves')
+    if is_finished is None:
+        return GAME_NOT_FOUND
+    if is_finished == b'1':
+        return GAME_IS_OVER
+
+    player_ids = (int(white_user_id or 0), int(black_user_id or 0))
+    if user_id not in player_ids:
+        return NOT_PLAYER
+
+    # Games of the old formats are migrated and validated by workers
+    if raw_moves or moves_cnt is None:
+        return None
+
+    ply = int(moves_cnt)
+    if user_id != player_ids[ply % 2]:
+        return NOT_YOUR_TURN
+    forwarded_ply, forwarded_at = _forwarded_plies.get(game_id, (None, 0))
+    if forwarded_ply == ply and monotonic() - forwarded_at < MOVE_RESEND_DELAY:
+        return MOVE_ALREADY_SENT
+
+    board = _get_web_board(game_id, ply)
+    if board is not None:
+        try:
+            board.parse_san(move_san)
+        except ValueError:
+            return ILLEGAL_MOVE
+
+    _forwarded_plies[game_id] = (ply, monotonic())
+    _forwarded_plies.move_to_end(game_id)
+    if len(_forwarded_plies) > _MAX_FORWARDED_PLIES:
+        _forwarded_plies.popitem(last=False)
+    return None
+
+
+def forget_forwarded_move(game_id: int) -> None:
+    '''Lets a move of the game be sent again at once, because the previous
+       one failed to be sent or was rejected'''
+    _forwarded_plies.pop(game_id, None)
+
+
+def commit_move(context: MoveContext, user_id: int, move: Move,
+                request_datetime: datetime,
+                first_move_eta: Optional[datetime] = None,
+                ) -> Optional[Tuple[timedelta, timedelta]]:
+    '''Commits the move, which must be legal on context.board, in one round
+       trip. Arms the first move timer, if first_move_eta is given, and
+       cancels it after the second move.
+       Returns new white and black clocks, None if the move is rejected.'''
+    game_id = context.game_id
+    opp_id = context.black_user_id
+    if user_id == context.black_user_id:
+        opp_id = context.white_user_id
+
+    board = context.board
+    move_san = board.san(move)
+    board.push(move)
+    # Position after the last capture or pawn move, see Game.board_fen
+    board_fen = board.fen() if board.halfmove_clock == 0 else ''
+
+    first_move_timer = ''
+    if first_move_eta is not None:
+        first_move_timer = rom.util.dt2ts(first_move_eta)
+    elif context.ply + 1 == 2:
+        first_move_timer = 'cancel'
+
+    clocks = _commit_move_lua(
+        keys=(f'Game:{game_id}', f'Game:{game_id}:moves',
+              timers.TIMERS_KEY, timers.TIMERS_TASKS_KEY,
+              f'Game:{game_id}:info'),
+        args=(context.ply, user_id, pack_move(move),
+              repr(rom.util.dt2ts(request_datetime)), board_fen,
+              timers.time_is_up_timer(game_id),
+              json.dumps(['on_time_is_up', [opp_id, game_id]]),
+              timers.first_move_timer(game_id), first_move_timer,
+              json.dumps(['on_first_move_timed_out', [game_id]]),
+              move_san),
+    )
+    if not clocks:
+        board_cache.discard(game_id)
+        return None
+
+    entity_session.forget(Game, game_id)
+    board_cache.put(game_id, context.ply + 1, board)
+    return parse_clock(clocks[0].decode()), parse_clock(clocks[1].decode())
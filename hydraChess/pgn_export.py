@@ -0,0 +1,211 @@
+'''PGN export of finished games. Games are streamed: their ids are read from
+an index page by page, every page of games is fetched with two pipelined
+round trips and rendered one by one, so memory use doesn't depend on the
+number of exported games. Rendering SAN is CPU bound, so other greenlets
+of the web process run after each game.
+
+Export all games with "python3 -m hydraChess.pgn_export -o games.pgn.gz"'''
+from typing import Iterable, Iterator, List, Optional
+import argparse
+import sys
+import zlib
+from chess import Board
+import gevent
+import rom.util
+from hydraChess.config import ProductionConfig
+from hydraChess.models import User, iter_game_ids, unpack_moves
+from hydraChess import archive, game_history
+
+
+BATCH_SIZE = 100
+
+_GAME_FIELDS = ('is_finished', 'white_user', 'black_user', 'white_rating',
+                'black_rating', 'result', 'raw_total_clock', 'raw_moves',
+                'end_datetime', 'last_move_datetime')
+
+
+def iter_all_game_ids(batch_size: int = BATCH_SIZE) -> Iterator[int]:
+    '''Yields ids of archived games, then of games stored in Redis'''
+    yield from archive.iter_game_ids(batch_size)
+    yield from iter_game_ids(batch_size)
+
+
+def iter_user_game_ids(user_id: int,
+                       batch_size: int = BATCH_SIZE) -> Iterator[int]:
+    '''Yields ids of finished games of the user in order of their end'''
+    conn = rom.util.get_connection()
+    key = game_history.history_key(user_id)
+    start = 0
+    while True:
+        game_ids = conn.zrange(key, start, start + batch_size - 1)
+        for game_id in game_ids:
+            yield int(game_id)
+
+        if len(game_ids) < batch_size:
+            return
+        start += batch_size
+
+
+def _batches(game_ids: Iterable[int], batch_size: int) -> Iterator[List[int]]:
+    batch = []
+    for game_id in game_ids:
+        batch.append(game_id)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def fetch_games(game_ids: List[int]) -> List[dict]:
+    '''Reads finished games, which have a result, with nicknames of their
+       players in two pipelined round trips and one archive query'''
+    conn = rom.util.get_connection()
+
+    pipe = conn.pipeline(False)
+    for game_id in game_ids:
+        pipe.hmget(f'Game:{game_id}', *_GAME_FIELDS)
+        pipe.get(f'Game:{game_id}:moves')
+    replies = pipe.execute()
+
+    games = []
+    for game_id, values, packed_moves in zip(game_ids, replies[::2],
+                                             replies[1::2]):
+        game = {field: value.decode() if value is not None else None
+                for field, value in zip(_GAME_FIELDS, values)}
+        game['id'] = game_id
+        game['packed_moves'] = packed_moves or b''
+        games.append(game)
+
+    # Games missing in Redis are looked up in the archive
+    archived = archive.get_games([game['id'] for game in games
+                                  if game['is_finished'] is None])
+    for game in games:
+        if game['id'] in archived:
+            data, packed_moves, _ = archived[game['id']]
+            game.update({field: data.get(field) for field in _GAME_FIELDS})
+            game['packed_moves'] = packed_moves
+
+    games = [game for game in games
+             if game['is_finished'] == '1' and
+             game['result'] in game_history.RATED_RESULTS]
+
+    user_ids = list({int(game[color]) for game in games
+                     for color in ('white_user', 'black_user')})
+    pipe = conn.pipeline(False)
+    for user_id in user_ids:
+        pipe.hget(f'User:{user_id}', 'login')
+    logins = dict(zip(user_ids, pipe.execute()))
+
+    for game in games:
+        for color in ('white_user', 'black_user'):
+            login = logins[int(game[color])]
+            game[color] = login.decode() if login is not None else '?'
+    return games
+
+
+def render_pgn(game: dict) -> str:
+    '''Renders game fetched by fetch_games(...) to PGN'''
+    date = '????.??.??'
+    end_ts = game['end_datetime'] or game['last_move_datetime']
+    if end_ts:
+        date = rom.util.ts2dt(float(end_ts)).strftime('%Y.%m.%d')
+
+    result = game['result']
+    seconds = (game['raw_total_clock'] or '0.0').split('.')[0]
+
+    headers = [
+        ('Event', 'Hydra Chess game'),
+        ('Site', f"/game/{game['id']}"),
+        ('Date', date),
+        ('Round', '-'),
+        ('White', game['white_user']),
+        ('Black', game['black_user']),
+        ('Result', result),
+        ('WhiteElo', game['white_rating'] or '?'),
+        ('BlackElo', game['black_rating'] or '?'),
+        ('TimeControl', f'{seconds}+0'),
+    ]
+
+    if game['raw_moves']:  # Games, which were not migrated yet
+        moves = game['raw_moves'].split(',')
+    else:
+        board = Board()
+        moves = []
+        for move in unpack_moves(game['packed_moves']):
+            moves.append(board.san(move))
+            board.push(move)
+
+    movetext = []
+    for i, move_san in enumerate(moves):
+        if i % 2 == 0:
+            movetext.append(f'{i // 2 + 1}.')
+        movetext.append(move_san)
+    movetext.append(result)
+
+    lines = [f'[{name} "{value}"]' for name, value in headers]
+    lines.append('')
+    # PGN lines should not be longer than 80 characters
+    line = ''
+    for token in movetext:
+        if line and len(line) + 1 + len(token) > 79:
+            lines.append(line)
+            line = token
+        else:
+            line = f'{line} {token}' if line else token
+    lines.append(line)
+    return '\n'.join(lines) + '\n\n'
+
+
+def export_pgn(game_ids: Iterable[int],
+               batch_size: int = BATCH_SIZE) -> Iterator[str]:
+    '''Yields PGN of finished games one by one'''
+    for batch in _batches(game_ids, batch_size):
+        for game in fetch_games(batch):
+            yield render_pgn(game)
+            gevent.sleep(0)
+
+
+def gzip_stream(chunks: Iterable[str]) -> Iterator[bytes]:
+    '''Compresses the stream into gzip format'''
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Export games to PGN')
+    parser.add_argument('-u', '--user', help='export games of the user')
+    parser.add_argument('-o', '--output', help='output file, stdout if not '
+                        'given. Compressed if its name ends with .gz')
+    parser.add_argument('--gzip', action='store_true', help='compress output')
+    args = parser.parse_args(argv)
+
+    rom.util.set_connection_settings(db=ProductionConfig.REDIS_DB_ID)
+    rom.util.use_null_session()
+
+    if args.user:
+        user = User.get_by(login=args.user)
+        if user is None:
+            sys.exit(f'User {args.user} not found')
+        game_ids = iter_user_game_ids(user.id)
+    else:
+        game_ids = iter_all_game_ids()
+
+    chunks = export_pgn(game_ids)
+    output = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    if args.gzip or (args.output or '').endswith('.gz'):
+        chunks = gzip_stream(chunks)
+    else:
+        chunks = (chunk.encode() for chunk in chunks)
+
+    with output:
+        for chunk in chunks:
+            output.write(chunk)
+
+
+if __name__ == '__main__':
+    main()
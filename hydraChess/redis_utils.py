@@ -0,0 +1,18 @@
+from hashlib import sha1
+from redis import Redis
+from redis.exceptions import NoScriptError
+import rom.util
+
+
+class LuaScript:
+    '''Lua script, which is sent to Redis only if it isn't cached there'''
+    def __init__(self, script: str):
+        self.script = script
+        self.sha = sha1(script.encode()).hexdigest()
+
+    def __call__(self, keys=(), args=(), conn: Redis = None):
+        conn = conn or rom.util.get_connection()
+        try:
+            return conn.evalsha(self.sha, len(keys), *keys, *args)
+        except NoScriptError:
+            return conn.eval(self.script, len(keys), *keys, *args)
@@ -0,0 +1,74 @@
+'''Routing of celery tasks to partitioned queues'''
+
+
+SEARCH_SHARDS = 4
+
+# Every game is owned by one partition. Each partition queue is consumed by
+# a single solo worker, so tasks of a game run one by one in order of
+# sending and don't need to lock the game.
+#
+# Moves made inline by web processes (MOVE_EXECUTION = 'inline') bypass the
+# partitions. Their correctness depends only on the Lua script of
+# move_commit, which commits a move only on the ply count and the unfinished
+# game it was validated on. Settlement is atomic as well, and other tasks
+# save only the columns they change, so they don't overwrite moves.
+GAME_PARTITIONS = 30
+
+# Task name -> position of game_id in its args
+GAME_TASKS = {
+    'send_game_info': 0,
+    'start_game': 0,
+    'end_game': 0,
+    'on_first_move_timed_out': 0,
+    'make_move': 1,
+    'resign': 1,
+    'reconnect': 1,
+    'on_disconnect': 1,
+    'make_draw_offer': 1,
+    'accept_draw_offer': 1,
+    'decline_draw_offer': 1,
+    'on_disconnect_timed_out': 1,
+    'on_time_is_up': 1,
+}
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    '''Jump consistent hash (Lamping, Veach). Maps the key to one of the
+       buckets, so that adding a bucket moves only 1/buckets of the keys.'''
+    key &= 0xFFFFFFFFFFFFFFFF
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def search_queue(seconds: int) -> str:
+    '''Seeks of one time control are always matched on the same shard'''
+    return f'search.{jump_hash(int(seconds), SEARCH_SHARDS)}'
+
+
+def game_queue(game_id: int) -> str:
+    return f'high.{jump_hash(int(game_id), GAME_PARTITIONS)}'
+
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    if name in GAME_TASKS:
+        if args and len(args) > GAME_TASKS[name]:
+            game_id = args[GAME_TASKS[name]]
+        else:
+            game_id = kwargs['game_id']
+        return {'queue': game_queue(game_id)}
+    if name == 'search_game':
+        seconds = args[1] if args else kwargs['seconds']
+        return {'queue': search_queue(seconds)}
+    if name == 'match_seeks':
+        seconds = args[0] if args else kwargs['seconds']
+        return {'queue': search_queue(seconds)}
+    return None
+
+
+if __name__ == '__main__':
+    # Used by scripts/run_high.sh
+    print(GAME_PARTITIONS)
@@ -0,0 +1,136 @@
+'''End of game settlement. One Lua script marks the game finished, clears
+cur_game_id of the players, applies rating changes, counts the game,
+updates k-factors by FIDE rules (after 2014), leaderboards and game
+histories, so nothing is locked and no tasks are queued.'''
+from datetime import datetime
+from typing import Optional
+import rom.util
+from hydraChess.models import User, Game, USER_CHANGES_CHANNEL
+from hydraChess.redis_utils import LuaScript
+from hydraChess import entity_session, game_history, leaderboard, timers
+
+
+_settle_game_lua = LuaScript('''
+local game_id = ARGV[1]
+if redis.call('HGET', KEYS[1], 'is_finished') ~= '' then
+    return 0
+end
+
+redis.call('HSET', KEYS[1], 'is_finished', '1', 'result', ARGV[2],
+           'end_datetime', ARGV[9])
+
+local info = redis.call('GET', KEYS[2])
+if info then
+    info = cjson.decode(info)
+    info.is_finished = true
+    info.result = ARGV[2]
+    info.total_clock = redis.call('HGET', KEYS[1], 'raw_total_clock')
+    info.version = info.version + 1
+    redis.call('SET', KEYS[2], cjson.encode(info))
+end
+
+local boards_cnt = tonumber(ARGV[8])
+for i, user_key in ipairs({KEYS[3], KEYS[4]}) do
+    if redis.call('HGET', user_key, 'cur_game_id') == game_id then
+        redis.call('HDEL', user_key, 'cur_game_id')
+    end
+
+    local user_id = ARGV[5 + i]
+    if ARGV[3] == '1' then
+        local rating = redis.call('HINCRBY', user_key, 'rating', ARGV[3 + i])
+        local games_played = redis.call('HINCRBY', user_key,
+                                        'games_played', 1)
+        local k_factor = tonumber(redis.call('HGET', user_key, 'k_factor'))
+        if k_factor == 40 and games_played >= 30 then
+            k_factor = 20
+        end
+        if k_factor == 20 and games_played >= 3 and rating >= 2400 then
+            k_factor = 10
+        end
+        redis.call('HSET', user_key, 'k_factor', k_factor)
+
+        redis.call('ZADD', KEYS[7], rating, user_id)
+        -- The board of the game's time control goes first, the rating is
+        -- updated on boards of other time controls, the user is on
+        for j = 8, 7 + boards_cnt do
+            if j == 8 then
+                redis.call('ZADD', KEYS[j], rating, user_id)
+            else
+                redis.call('ZADD', KEYS[j], 'XX', rating, user_id)
+            end
+        end
+    end
+    redis.call('PUBLISH', ARGV[10], user_id)
+end
+
+-- History indices of both players, if the game wasn't cancelled
+for i = 8 + boards_cnt, #KEYS do
+    redis.call('ZADD', KEYS[i], ARGV[9], game_id)
+end
+
+redis.call('ZREM', KEYS[5], unpack(ARGV, 11))
+redis.call('HDEL', KEYS[6], unpack(ARGV, 11))
+return 1
+''')
+
+
+def settle_game(game: Game, result: str, update_stats: bool = True,
+                time_control_boards: bool = False,
+                end_datetime: Optional[datetime] = None) -> bool:
+    '''Finishes the game with the result and cancels its timers.
+       Updates players' ratings, games played, k-factors and the leaderboard,
+       if update_stats is True. If time_control_boards is True, the players
+       are put to the leaderboard of the game's time control, and their
+       ratings are updated on the other ones. Games with a result are
+       added to game histories of the players. Ids of the players are
+       published to USER_CHANGES_CHANNEL.
+       Returns False if the game was already finished.'''
+    white_delta = black_delta = 0
+    if update_stats:
+        rating_changes = game.rating_changes
+        if result == "1-0":
+            white_delta = rating_changes["w"].win
+            black_delta = rating_changes["b"].lose
+        elif result == "1/2-1/2":
+            white_delta = rating_changes["w"].draw
+            black_delta = rating_changes["b"].draw
+        elif result == "0-1":
+            white_delta = rating_changes["w"].lose
+            black_delta = rating_changes["b"].win
+
+    white_user_id, black_user_id = game.white_user.id, game.black_user.id
+    seconds = int(game.total_clock.total_seconds())
+
+    history_keys = []
+    for user_id, is_white in ((white_user_id, True), (black_user_id, False)):
+        outcome = game_history.get_outcome(result, is_white)
+        if outcome is not None:
+            history_keys += game_history.get_history_keys(user_id, outcome,
+                                                          seconds)
+
+    board_keys = []
+    if time_control_boards:
+        board_keys = [leaderboard.board_key(seconds)]
+        board_keys += [leaderboard.board_key(other)
+                       for other in leaderboard.TIME_CONTROLS
+                       if other != seconds]
+
+    end_datetime = end_datetime or datetime.utcnow()
+    settled = bool(_settle_game_lua(
+        keys=(f'Game:{game.id}', game.info_key,
+              f'User:{white_user_id}', f'User:{black_user_id}',
+              timers.TIMERS_KEY, timers.TIMERS_TASKS_KEY,
+              leaderboard.board_key(), *board_keys, *history_keys),
+        args=(game.id, result, int(update_stats), white_delta, black_delta,
+              white_user_id, black_user_id, len(board_keys),
+              repr(rom.util.dt2ts(end_datetime)), USER_CHANGES_CHANNEL,
+              timers.first_move_timer(game.id),
+              timers.time_is_up_timer(game.id),
+              timers.disconnect_timer(game.id, white_user_id),
+              timers.disconnect_timer(game.id, black_user_id)),
+    ))
+
+    # Stale copies of the game and the players mustn't be saved
+    entity_session.forget(Game, game.id)
+    entity_session.forget(User, white_user_id, black_user_id)
+    return settled
@@ -19,6 +19,7 @@
   var firstMoveTimer = new Timer('first_move_seconds')
 
   var $oppDisconnectedAlert = $('#opp_disconnected_alert')
+  var $moveRejectedAlert = $('#move_rejected_alert')
   var oppDisconnectedTimer = new Timer('reconnect_wait_seconds')
 
   var clockPair = new ClockPair(['clock_a', 'clock_b'], 0)
@@ -321,6 +322,9 @@
   }
 
   function onFirstMoveWaiting(data) {
+    // Signal emitted to the game room is meant for the player of data.color
+    if (data.color !== undefined && data.color !== color) return
+
     var waitTime = data.wait_time
 
     firstMoveTimer.stop()
@@ -343,6 +347,13 @@
     $oppDisconnectedAlert.fadeIn()
   }
 
+  function onMoveRejected(data) {
+    // The move was only shown on the board
+    board.position(game.fen())
+    $moveRejectedAlert.text(data.reason)
+    $moveRejectedAlert.fadeIn().delay(2000).fadeOut()
+  }
+
   function onOppReconnected() {
     $oppDisconnectedAlert.hide()
     oppDisconnectedTimer.stop()
@@ -475,6 +486,7 @@
   sio.on('first_move_waiting', onFirstMoveWaiting)
   sio.on('opp_disconnected', onOppDisconnected)
   sio.on('opp_reconnected', onOppReconnected)
+  sio.on('move_rejected', onMoveRejected)
   sio.on('draw_offer', onDrawOffer)
   // sio.on('draw_offer_accepted', onDrawOfferAccepted)
   // sio.on('draw_offer_declined', onDrawOfferDeclined)
@@ -0,0 +1,49 @@
+'''Batching of low priority tasks. Arguments of calls are appended to a
+Redis list of the batch and a single flush message is sent per batch: only
+by the call, which finds the list empty. The flush task takes all queued
+calls at once and processes them in bulk, so under load many calls share
+one message. A timer sends the flush task too, in case the message is
+lost.'''
+from datetime import datetime, timedelta
+from typing import List, Tuple
+import msgpack
+import rom.util
+from hydraChess.redis_utils import LuaScript
+from hydraChess import timers
+
+
+BATCH_SIZE = 200  # Calls taken by one flush task at most
+FLUSH_DELAY = 5  # Seconds, after which queued calls are flushed anyway
+
+
+_take_lua = LuaScript('''
+local calls = redis.call('LRANGE', KEYS[1], 0, ARGV[1] - 1)
+redis.call('LTRIM', KEYS[1], #calls, -1)
+return {calls, redis.call('LLEN', KEYS[1])}
+''')
+
+
+def batch_key(name: str) -> str:
+    return f'batch:{name}'
+
+
+def add(name: str, *args) -> bool:
+    '''Queues the call. Returns True if the flush task must be sent.
+       The flush task must be named as the batch, the timer sends it after
+       FLUSH_DELAY seconds as well.'''
+    pipe = rom.util.get_connection().pipeline(True)
+    pipe.rpush(batch_key(name), msgpack.packb(args))
+    timers.arm(timers.batch_flush_timer(name),
+               datetime.utcnow() + timedelta(seconds=FLUSH_DELAY),
+               name, (), only_new=True, pipe=pipe)
+    length = pipe.execute()[0]
+    # It's sent again each BATCH_SIZE calls, so long batches are flushed
+    # by several tasks
+    return length % BATCH_SIZE == 1
+
+
+def take(name: str, limit: int = BATCH_SIZE) -> Tuple[List[list], bool]:
+    '''Atomically removes queued calls. Returns their args and whether
+       calls are left, in which case the flush task must be sent again.'''
+    calls, left = _take_lua(keys=(batch_key(name), ), args=(limit, ))
+    return [msgpack.unpackb(call) for call in calls], left > 0
@@ -0,0 +1,157 @@
+'''Game timers. Every timer is a member of one Redis sorted set scored by its
+expiration time, so arming, re-arming and cancelling it costs O(log n).
+Expired timers are fired by a single poller, which sends the celery task
+stored with the timer. Run it with "python3 -m hydraChess.timers"
+
+The poller moves expired timers to the set of leases and removes them only
+after their tasks are sent. Timers of a poller, which crashed meanwhile,
+fire again when their leases expire.'''
+from datetime import datetime, timedelta
+from time import sleep
+from typing import List, Optional, Tuple
+import json
+from redis.client import Pipeline
+import rom.util
+from hydraChess.redis_utils import LuaScript
+
+
+TIMERS_KEY = 'timers'
+TIMERS_TASKS_KEY = 'timers:tasks'
+TIMERS_LEASES_KEY = 'timers:leases'
+
+POLL_INTERVAL = 0.05
+POLL_BATCH_SIZE = 100
+LEASE_SECONDS = 30
+
+
+_claim_expired_lua = LuaScript('''
+local expired_leases = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[1])
+for _, name in ipairs(expired_leases) do
+    -- Unless the timer was re-armed since it was claimed
+    if not redis.call('ZSCORE', KEYS[1], name) then
+        redis.call('ZADD', KEYS[1], ARGV[1], name)
+    end
+    redis.call('ZREM', KEYS[3], name)
+end
+
+local names = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                         'LIMIT', 0, ARGV[2])
+local claimed = {}
+for _, name in ipairs(names) do
+    local task = redis.call('HGET', KEYS[2], name)
+    if task then
+        redis.call('ZADD', KEYS[3], ARGV[3], name)
+        table.insert(claimed, name)
+        table.insert(claimed, task)
+    end
+end
+if #names > 0 then
+    redis.call('ZREM', KEYS[1], unpack(names))
+end
+return claimed
+''')
+
+_release_lua = LuaScript('''
+for _, name in ipairs(ARGV) do
+    redis.call('ZREM', KEYS[3], name)
+    -- Task of the timer re-armed since it was claimed is kept
+    if not redis.call('ZSCORE', KEYS[1], name) then
+        redis.call('HDEL', KEYS[2], name)
+    end
+end
+''')
+
+
+def first_move_timer(game_id: int) -> str:
+    return f'first_move_timed_out:{game_id}'
+
+
+def time_is_up_timer(game_id: int) -> str:
+    '''Only the clock of the player to move is running, so there is
+       one timer per game'''
+    return f'time_is_up:{game_id}'
+
+
+def disconnect_timer(game_id: int, user_id: int) -> str:
+    return f'disconnect_timed_out:{game_id}:{user_id}'
+
+
+def match_seeks_timer(seconds: int) -> str:
+    return f'match_seeks:{int(seconds)}'
+
+
+def batch_flush_timer(name: str) -> str:
+    return f'flush_batch:{name}'
+
+
+def arm(name: str, eta: datetime, task_name: str, args: tuple,
+        only_new: bool = False, pipe: Optional[Pipeline] = None) -> None:
+    '''Arms timer, which sends the task at eta. Re-arms it if it exists,
+       unless only_new is True. If pipe is given, the commands are only
+       queued to it.'''
+    execute = pipe is None
+    if execute:
+        pipe = rom.util.get_connection().pipeline(True)
+    pipe.zadd(TIMERS_KEY, {name: rom.util.dt2ts(eta)}, nx=only_new)
+    pipe.hset(TIMERS_TASKS_KEY, name, json.dumps([task_name, list(args)]))
+    if execute:
+        pipe.execute()
+
+
+def cancel(*names: str) -> None:
+    pipe = rom.util.get_connection().pipeline(True)
+    pipe.zrem(TIMERS_KEY, *names)
+    pipe.hdel(TIMERS_TASKS_KEY, *names)
+    pipe.execute()
+
+
+def get_eta(name: str) -> Optional[datetime]:
+    '''Returns expiration time of the timer, None if it isn't armed'''
+    score = rom.util.get_connection().zscore(TIMERS_KEY, name)
+    if score is None:
+        return None
+    return rom.util.ts2dt(score)
+
+
+def claim_expired(now: Optional[datetime] = None,
+                  limit: int = POLL_BATCH_SIZE
+                  ) -> List[Tuple[str, str, list]]:
+    '''Atomically leases expired timers for LEASE_SECONDS. Returns them
+       as (name, task_name, args), release(...) them after their tasks are
+       sent.'''
+    now = now or datetime.utcnow()
+    claimed = _claim_expired_lua(
+        keys=(TIMERS_KEY, TIMERS_TASKS_KEY, TIMERS_LEASES_KEY),
+        args=(rom.util.dt2ts(now), limit,
+              rom.util.dt2ts(now + timedelta(seconds=LEASE_SECONDS))))
+    return [(claimed[i].decode(), *json.loads(claimed[i + 1]))
+            for i in range(0, len(claimed), 2)]
+
+
+def release(*names: str) -> None:
+    '''Removes claimed timers, which weren't re-armed since'''
+    if names:
+        _release_lua(keys=(TIMERS_KEY, TIMERS_TASKS_KEY, TIMERS_LEASES_KEY),
+                     args=names)
+
+
+def run_poller(celery) -> None:
+    '''Sends tasks of expired timers forever'''
+    while True:
+        timers = claim_expired()
+        sent = []
+        try:
+            for name, task_name, args in timers:
+                celery.send_task(task_name, args=args)
+                sent.append(name)
+        finally:
+            # The rest is sent again when the leases expire
+            release(*sent)
+
+        if len(timers) < POLL_BATCH_SIZE:
+            sleep(POLL_INTERVAL)
+
+
+if __name__ == '__main__':
+    from hydraChess.game_management import celery
+    run_poller(celery)
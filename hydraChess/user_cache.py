@@ -0,0 +1,69 @@
+'''In-process cache of users for the web tier, so current_user of HTTP
+requests and Socket.IO events is usually resolved without Redis.
+
+Each save of a user and each game settlement publishes the user id to
+USER_CHANGES_CHANNEL. A listener evicts published users from the cache and
+bumps their versions, so a load, which started before the change, isn't
+cached. Entries also expire after the TTL, in case a message was lost.'''
+from time import monotonic
+from typing import Dict, Optional, Tuple
+import threading
+import rom.util
+from hydraChess.models import User, USER_CHANGES_CHANNEL
+
+
+USER_CACHE_TTL = 10  # Seconds
+USER_CACHE_SIZE = 10000
+
+
+class UserCache:
+    def __init__(self, ttl: float = USER_CACHE_TTL,
+                 max_size: int = USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._users: Dict[int, Tuple[float, User]] = {}
+        self._versions: Dict[int, int] = {}
+        self._listener = None
+
+    def get(self, user_id: int) -> Optional[User]:
+        '''Returns the cached user, loads it if it's missing or expired'''
+        self.ensure_listener()
+
+        entry = self._users.get(user_id)
+        if entry is not None and entry[0] > monotonic():
+            return entry[1]
+
+        version = self._versions.get(user_id, 0)
+        user = User.get(user_id)
+        if user is not None and self._versions.get(user_id, 0) == version:
+            if len(self._users) >= self.max_size:
+                # Entries are stored in order of their loading
+                self._users.pop(next(iter(self._users)), None)
+            self._users[user_id] = (monotonic() + self.ttl, user)
+        return user
+
+    def invalidate(self, user_id: int) -> None:
+        self._versions[user_id] = self._versions.get(user_id, 0) + 1
+        self._users.pop(user_id, None)
+
+    def clear(self) -> None:
+        self._users.clear()
+
+    def ensure_listener(self) -> None:
+        '''Starts listening to user changes, if it isn't started yet'''
+        if self._listener is None or not self._listener.is_alive():
+            # Entries loaded before the listener started may miss changes
+            self.clear()
+            self._listener = threading.Thread(target=self._listen,
+                                              daemon=True)
+            self._listener.start()
+
+    def _listen(self) -> None:
+        pubsub = rom.util.get_connection().pubsub(
+            ignore_subscribe_messages=True)
+        pubsub.subscribe(USER_CHANGES_CHANNEL)
+        for message in pubsub.listen():
+            self.invalidate(int(message['data']))
+
+
+user_cache = UserCache()
@@ -13,6 +13,8 @@ split -h \"./run_normal.sh\" ';' \
 select-pane -t 2 ';' \
 split -h \"./run_low.sh\" ';' \
 split -h \"./run_searcher.sh\" ';' \
+split -h \"./run_timers.sh\" ';' \
+split -h \"./run_archiver.sh\" ';' \
 select-pane -t {bottom} ';' \
 split -h \"./run_app.sh\" ';'"
 
@@ -3,4 +3,13 @@
 SCRIPTS_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 source ${SCRIPTS_DIR}/../dev/bin/activate
 cd ${SCRIPTS_DIR}/..
-celery -A hydraChess.game_management.celery worker --concurrency 30 -Q high -n worker.high -l=WARNING
+
+# One solo worker per game partition, so tasks of a game run in order
+PARTITIONS=$(python3 -m hydraChess.routing)
+for ((i = 0; i < PARTITIONS; i++)); do
+    celery -A hydraChess.game_management.celery worker --pool solo \
+        -Q high.$i -n worker.high.$i -l=WARNING &
+done
+
+trap 'kill $(jobs -p)' EXIT
+wait
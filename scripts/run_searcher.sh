@@ -1,6 +1,12 @@
 #!/bin/bash
 
+# Usage: run_searcher.sh [QUEUES] [CONCURRENCY]
+# Seeks are matched atomically in Redis, so any number of searchers may run,
+# each one consuming some of the search.N shards.
+
 SCRIPTS_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 source ${SCRIPTS_DIR}/../dev/bin/activate
 cd ${SCRIPTS_DIR}/..
-celery -A hydraChess.game_management.celery worker --concurrency 1 -Q search -n worker.searcher -l=WARNING  # DO NOT CHANGE THE CONCURRENCY VALUE
+QUEUES=${1:-search,search.0,search.1,search.2,search.3}
+CONCURRENCY=${2:-4}
+celery -A hydraChess.game_management.celery worker --concurrency $CONCURRENCY -Q $QUEUES -n worker.searcher.$$ -l=WARNING
@@ -0,0 +1,41 @@
+import unittest
+from random import randint
+from typing import List
+import rom.util
+from hydraChess.config import TestingConfig
+from hydraChess.models import User, Game
+
+
+def create_users(*prefixes: str, **kwargs) -> List[User]:
+    '''Saves a user for every prefix, logins are unique across test runs'''
+    suffix = randint(10 ** 9, 10 ** 10)
+    users = [User(login=f'{prefix}_{suffix}', **kwargs)
+             for prefix in prefixes]
+    for user in users:
+        user.save()
+    return users
+
+
+class GameTestCase(unittest.TestCase):
+    '''Every test gets new white and black users and a game between them'''
+    white_user_kwargs: dict = {}
+    black_user_kwargs: dict = {}
+    game_kwargs: dict = {}
+
+    @classmethod
+    def setUpClass(cls):
+        rom.util.set_connection_settings(db=TestingConfig.REDIS_DB_ID)
+        rom.util.use_null_session()
+
+    def setUp(self):
+        self.white_user, = create_users('white', **self.white_user_kwargs)
+        self.black_user, = create_users('black', **self.black_user_kwargs)
+
+        self.game = Game(white_user=self.white_user,
+                         black_user=self.black_user, **self.game_kwargs)
+        self.game.save()
+
+    def tearDown(self):
+        Game.get(self.game.id).delete()
+        self.white_user.delete()
+        self.black_user.delete()
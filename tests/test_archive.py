@@ -0,0 +1,93 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import rom.util
+from hydraChess.config import TestingConfig
+from hydraChess.models import Game, get_game_info
+from hydraChess.settlement import settle_game
+from hydraChess import archive, pgn_export
+from tests.helpers import create_users
+
+
+class TestArchive(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rom.util.set_connection_settings(db=TestingConfig.REDIS_DB_ID)
+        archive.set_archive_path(TestingConfig.ARCHIVE_PATH)
+
+    def setUp(self):
+        self.white_user, self.black_user = create_users('white', 'black')
+
+        self.games = []
+        for _ in range(2):
+            game = Game(white_user=self.white_user,
+                        black_user=self.black_user,
+                        white_rating=1200, black_rating=1200)
+            game.total_clock = timedelta(seconds=60)
+            game.moves = ['e4', 'e5', 'Qh5']
+            game.save()
+            self.games.append(game)
+
+    def test_archive_games(self):
+        old_game, new_game = self.games
+        end_datetime = datetime.utcnow() - timedelta(days=10)
+        settle_game(old_game, '1-0', update_stats=False,
+                    end_datetime=end_datetime)
+        settle_game(new_game, '0-1', update_stats=False)
+        info = get_game_info(old_game.id)
+
+        archived = archive.archive_games(datetime.utcnow() -
+                                         timedelta(days=1))
+        self.assertGreaterEqual(archived, 1)
+
+        conn = rom.util.get_connection()
+        self.assertFalse(conn.exists(f'Game:{old_game.id}',
+                                     f'Game:{old_game.id}:moves',
+                                     f'Game:{old_game.id}:info'))
+        self.assertIsNone(conn.zscore('Game:id:idx', old_game.id))
+        self.assertTrue(conn.exists(f'Game:{new_game.id}'))
+
+        game = Game.get(old_game.id)
+        self.assertTrue(game.is_archived)
+        self.assertEqual(game.result, '1-0')
+        self.assertEqual(game.moves, ['e4', 'e5', 'Qh5'])
+        self.assertEqual(game.white_user.id, self.white_user.id)
+        self.assertEqual(game.total_clock, timedelta(seconds=60))
+        self.assertEqual(get_game_info(old_game.id), info)
+
+        games = Game.get([new_game.id, old_game.id])
+        self.assertEqual([game.id for game in games],
+                         [new_game.id, old_game.id])
+        self.assertFalse(games[0].is_archived)
+
+        pgn = ''.join(pgn_export.export_pgn([old_game.id]))
+        self.assertIn('1. e4 e5 2. Qh5 1-0', pgn)
+        self.assertIn(old_game.id, pgn_export.iter_all_game_ids())
+
+    def test_live_games_are_kept(self):
+        game = self.games[0]
+        archive.archive_games(datetime.utcnow() + timedelta(days=1))
+        self.assertFalse(Game.get(game.id).is_archived)
+
+    def test_shared_connection(self):
+        def connection():
+            with archive._connect() as conn:
+                return conn
+
+        with ThreadPoolExecutor(1) as executor:
+            self.assertIs(executor.submit(connection).result(), connection())
+
+    def tearDown(self):
+        for game in Game.get([game.id for game in self.games]):
+            if not game.is_archived:
+                game.delete()
+        self.white_user.delete()
+        self.black_user.delete()
+
+    @classmethod
+    def tearDownClass(cls):
+        archive.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
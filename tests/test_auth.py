@@ -0,0 +1,45 @@
+import unittest
+from uuid import uuid4
+import rom.util
+from hydraChess.config import TestingConfig
+from hydraChess import auth
+
+
+class TestAuth(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rom.util.set_connection_settings(db=TestingConfig.REDIS_DB_ID)
+
+    def setUp(self):
+        self.ip = uuid4().hex
+        self.login = uuid4().hex
+
+    def test_hashing(self):
+        hashed_password = auth.hash_password('testtesttest')
+        self.assertTrue(auth.check_password(hashed_password, 'testtesttest'))
+        self.assertFalse(auth.check_password(hashed_password, 'test'))
+
+    def test_account_limit(self):
+        for i in range(auth.SIGN_IN_ATTEMPTS_PER_ACCOUNT):
+            self.assertTrue(auth.admit_sign_in(f'{self.ip}_{i}', self.login))
+        self.assertFalse(auth.admit_sign_in(self.ip, self.login))
+        self.assertTrue(auth.admit_sign_in(self.ip, f'{self.login}_2'))
+
+    def test_ip_limit(self):
+        for i in range(auth.SIGN_IN_ATTEMPTS_PER_IP):
+            self.assertTrue(auth.admit_sign_in(self.ip, f'{self.login}_{i}'))
+        self.assertFalse(auth.admit_sign_in(self.ip, self.login))
+
+        for _ in range(auth.REGISTRATIONS_PER_IP):
+            self.assertTrue(auth.admit_registration(self.ip))
+        self.assertFalse(auth.admit_registration(self.ip))
+
+    def test_attempts_expire(self):
+        auth.admit_registration(self.ip)
+        ttl = rom.util.get_connection().ttl(
+            f'attempts:register:ip:{self.ip}')
+        self.assertTrue(0 < ttl <= auth.ATTEMPTS_WINDOW)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import unittest
+from io import BytesIO
+from PIL import Image
+from hydraChess import avatars
+
+
+class TestAvatars(unittest.TestCase):
+    def setUp(self):
+        self.dirs = (avatars.AVATARS_DIR, avatars.UPLOADS_DIR)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        avatars.AVATARS_DIR = self.tmp_dir.name
+        avatars.UPLOADS_DIR = os.path.join(self.tmp_dir.name, 'uploads')
+
+    def make_image(self, width: int, height: int) -> bytes:
+        raw_img = BytesIO()
+        Image.new('RGB', (width, height), (200, 30, 30)).save(raw_img, 'PNG')
+        return raw_img.getvalue()
+
+    def test_process_upload(self):
+        raw_img = self.make_image(640, 480)
+        avatar_hash = avatars.content_hash(raw_img)
+        self.assertEqual(avatar_hash, avatars.content_hash(raw_img))
+        self.assertFalse(avatars.has_variants(avatar_hash))
+
+        avatars.save_upload(raw_img, avatar_hash)
+        self.assertTrue(avatars.process_upload(avatar_hash))
+        self.assertTrue(avatars.has_variants(avatar_hash))
+        self.assertEqual(os.listdir(avatars.UPLOADS_DIR), [])
+
+        for size in avatars.AVATAR_SIZES:
+            path = os.path.join(avatars.AVATARS_DIR,
+                                avatars.avatar_filename(avatar_hash, size))
+            with Image.open(path) as img:
+                self.assertEqual(img.format, 'WEBP')
+                self.assertEqual(img.size, (size, size))
+
+        # Processed by another task
+        self.assertTrue(avatars.process_upload(avatar_hash))
+
+    def test_broken_upload(self):
+        raw_img = self.make_image(10, 10)[:50]
+        avatar_hash = avatars.content_hash(raw_img)
+        avatars.save_upload(raw_img, avatar_hash)
+
+        self.assertFalse(avatars.process_upload(avatar_hash))
+        self.assertFalse(avatars.has_variants(avatar_hash))
+        self.assertEqual(os.listdir(avatars.UPLOADS_DIR), [])
+
+    def tearDown(self):
+        avatars.AVATARS_DIR, avatars.UPLOADS_DIR = self.dirs
+        self.tmp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    unittest.main()
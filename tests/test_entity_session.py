@@ -0,0 +1,87 @@
+import unittest
+import rom
+import rom.util
+from hydraChess.config import TestingConfig
+from hydraChess.models import User, Game, get_game_info
+from hydraChess.settlement import settle_game
+from hydraChess import entity_session, leaderboard
+from tests.helpers import GameTestCase
+
+
+class TestEntitySession(GameTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        entity_session.set_connection_settings(db=TestingConfig.REDIS_DB_ID)
+
+    def setUp(self):
+        super().setUp()
+        entity_session.reset_task_stats()
+
+    def read_players(self, game_id: int) -> None:
+        for _ in range(3):
+            game = Game.get(game_id)
+            game.white_user.sid, game.black_user.id
+
+    def test_entities_are_loaded_once(self):
+        counters = entity_session.counters
+        round_trips = counters.round_trips
+        self.read_players(self.game.id)
+        uncached = counters.round_trips - round_trips
+
+        with entity_session.scope('read_players'):
+            self.assertIs(Game.get(self.game.id), Game.get(self.game.id))
+            self.read_players(self.game.id)
+
+        stats = entity_session.get_task_stats()['read_players']
+        self.assertEqual(stats['calls'], 1)
+        self.assertLessEqual(stats['round_trips'], 3)
+        self.assertLess(stats['round_trips'], uncached)
+
+        # Outside of scopes nothing is cached
+        self.assertIsNot(Game.get(self.game.id), Game.get(self.game.id))
+
+    def test_modified_entities_are_saved(self):
+        with entity_session.scope():
+            user = User.get(self.white_user.id)
+            user.sid = 'sid'
+            self.assertEqual(
+                rom.util.get_connection().hget(user._pk, 'sid'), None)
+        self.assertEqual(User.get(self.white_user.id).sid, 'sid')
+
+        with self.assertRaises(ValueError):
+            with entity_session.scope():
+                User.get(self.white_user.id).sid = 'another sid'
+                raise ValueError
+        self.assertEqual(User.get(self.white_user.id).sid, 'sid')
+
+    def test_nested_scopes(self):
+        with entity_session.scope('outer'):
+            game = Game.get(self.game.id)
+            with entity_session.scope('inner'):
+                self.assertIs(Game.get(self.game.id), game)
+        self.assertEqual(list(entity_session.get_task_stats()), ['outer'])
+
+    def test_settled_game_is_not_saved(self):
+        # Rating stakes of the game weren't stored, they're computed
+        with entity_session.scope():
+            game = Game.get(self.game.id)
+            self.assertTrue(settle_game(game, '1-0'))
+            self.assertIsNot(Game.get(self.game.id), game)
+
+        game = Game.get(self.game.id)
+        self.assertTrue(game.is_finished)
+        self.assertEqual(game.result, '1-0')
+        self.assertFalse(game.raw_rating_changes)
+        info = get_game_info(self.game.id)
+        self.assertTrue(info['is_finished'])
+        self.assertEqual(info['result'], '1-0')
+
+    def tearDown(self):
+        rom.util.get_connection().zrem(
+            leaderboard.board_key(), self.white_user.id, self.black_user.id)
+        super().tearDown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+from datetime import datetime, timedelta
+import rom.util
+from hydraChess.config import TestingConfig
+from hydraChess.models import Game, RatingChange
+from hydraChess.settlement import settle_game
+from hydraChess import game_history, leaderboard
+from tests.helpers import create_users
+
+
+class TestGameHistory(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rom.util.set_connection_settings(db=TestingConfig.REDIS_DB_ID)
+
+    def setUp(self):
+        self.first_user, self.second_user = create_users('first', 'second')
+        self.games = list()
+
+    def play(self, white_user, black_user, minutes, result, end_datetime):
+        game = Game(white_user=white_user, black_user=black_user)
+        game.total_clock = timedelta(minutes=minutes)
+        game.rating_changes = {'w': RatingChange(20, 0, -20),
+                               'b': RatingChange(20, 0, -20)}
+        game.save()
+        self.games.append(game)
+
+        settle_game(game, result, end_datetime=end_datetime)
+        return game.id
+
+    def test_history(self):
+        now = datetime.utcnow()
+        first, second = self.first_user, self.second_user
+        game_ids = [
+            self.play(first, second, 5, '1-0', now),
+            self.play(second, first, 5, '1-0', now + timedelta(seconds=1)),
+            self.play(first, second, 10, '1/2-1/2',
+                      now + timedelta(seconds=2)),
+            self.play(second, first, 10, '0-1', now + timedelta(seconds=3)),
+        ]
+        # Cancelled games aren't added to the history
+        self.play(first, second, 5, '-', now + timedelta(seconds=4))
+
+        games, cursor = game_history.get_games(first.id, count=3)
+        self.assertEqual([game['id'] for game in games],
+                         game_ids[::-1][:3])
+        self.assertEqual([game['outcome'] for game in games],
+                         ['win', 'draw', 'loss'])
+        self.assertEqual(games[0]['minutes'], 10)
+        self.assertEqual(games[0]['white_user'], second.login)
+
+        games, cursor = game_history.get_games(first.id, cursor, count=3)
+        self.assertEqual([game['id'] for game in games], game_ids[:1])
+        self.assertIsNone(cursor)
+
+        games, _ = game_history.get_games(first.id, outcome='win')
+        self.assertEqual([game['id'] for game in games],
+                         [game_ids[3], game_ids[0]])
+
+        games, _ = game_history.get_games(second.id, outcome='win',
+                                          seconds=5 * 60)
+        self.assertEqual([game['id'] for game in games], [game_ids[1]])
+
+    def tearDown(self):
+        conn = rom.util.get_connection()
+        for user in (self.first_user, self.second_user):
+            conn.delete(*conn.keys(game_history.history_key(user.id) + '*'))
+            conn.zrem(leaderboard.board_key(), user.id)
+            user.delete()
+
+        for game in self.games:
+            game.delete()
+
+
+if __name__ == "__main__":
+    unittest.main()
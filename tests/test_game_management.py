@@ -0,0 +1,162 @@
+from gevent import monkey
+monkey.patch_all()
+
+
+import unittest
+from datetime import timedelta
+from random import randint
+from time import time
+from unittest.mock import patch
+import gevent
+import rom.util
+from hydraChess.config import TestingConfig
+from hydraChess.models import User, Game
+from hydraChess.move_commit import load_move_context
+from hydraChess.game_management import execute_move, cancel_search, \
+    cancel_searches, get_game_info_data, match_seeks, search_game
+from hydraChess import matchmaking, task_batching, timers
+from tests.helpers import GameTestCase, create_users
+
+
+class TestExecuteMove(GameTestCase):
+    def setUp(self):
+        super().setUp()
+        self.game.white_clock = timedelta(seconds=60)
+        self.game.black_clock = timedelta(seconds=60)
+        self.game.save()
+
+    def test_inline_moves(self):
+        game_id = self.game.id
+        self.assertTrue(execute_move(self.white_user.id, game_id, 'e4'))
+        # Not user's turn
+        self.assertFalse(execute_move(self.white_user.id, game_id, 'd4'))
+        self.assertFalse(execute_move(self.black_user.id, game_id, 'junk'))
+        self.assertTrue(execute_move(self.black_user.id, game_id, 'e5'))
+
+        self.assertEqual(Game.get(game_id).moves, ['e4', 'e5'])
+
+    def test_concurrent_moves(self):
+        # Inline moves aren't serialized by game partitions
+        def load_and_wait(game_id):
+            context = load_move_context(game_id)
+            gevent.sleep(0.01)  # Both moves are validated on the same ply
+            return context
+
+        with patch('hydraChess.game_management.load_move_context',
+                   load_and_wait):
+            greenlets = [gevent.spawn(execute_move, self.white_user.id,
+                                      self.game.id, move_san)
+                         for move_san in ('e4', 'd4')]
+            gevent.joinall(greenlets, raise_error=True)
+
+        committed = [greenlet.value for greenlet in greenlets]
+        self.assertEqual(sorted(committed), [False, True])
+        self.assertEqual(Game.get(self.game.id).moves,
+                         ['e4' if committed[0] else 'd4'])
+
+    def test_game_info_data(self):
+        execute_move(self.white_user.id, self.game.id, 'e4')
+
+        data = get_game_info_data(self.game.id, self.black_user.id)
+        self.assertEqual(data['moves'], 'e4')
+        self.assertEqual(data['color'], 'b')
+        self.assertTrue(data['can_send_draw_offer'])
+        self.assertEqual(data['white_clock'], 60)
+        self.assertLessEqual(data['black_clock'], 60)
+
+        self.assertFalse(get_game_info_data(self.game.id)['is_player'])
+
+    def tearDown(self):
+        timers.cancel(timers.first_move_timer(self.game.id),
+                      timers.time_is_up_timer(self.game.id))
+        super().tearDown()
+
+
+class TestCancelSearches(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rom.util.set_connection_settings(db=TestingConfig.REDIS_DB_ID)
+        rom.util.use_null_session()
+
+    def setUp(self):
+        self.users = create_users('searching', 'idle')
+
+    def test_cancel_searches(self):
+        searching_user, idle_user = self.users
+        self.assertIsNone(matchmaking.pair_or_seek(
+            searching_user.id, 1200, 7777,
+            matchmaking.new_search_token(searching_user.id)))
+        self.assertTrue(User.get(searching_user.id).in_search)
+
+        for user_id in (searching_user.id, idle_user.id, searching_user.id):
+            task_batching.add('cancel_searches', user_id,
+                              matchmaking.new_search_token(user_id))
+        cancel_searches()
+
+        self.assertFalse(User.get(searching_user.id).in_search)
+        self.assertFalse(User.get(idle_user.id).in_search)
+        self.assertFalse(matchmaking.cancel_seek(
+            searching_user.id,
+            matchmaking.new_search_token(searching_user.id)))
+        self.assertEqual(task_batching.take('cancel_searches'), ([], False))
+
+    def test_search_cancelled_before_it_runs(self):
+        searching_user = self.users[0]
+        token = matchmaking.new_search_token(searching_user.id)
+        cancel_search(searching_user.id,
+                      matchmaking.new_search_token(searching_user.id))
+        search_game(searching_user.id, 7777, token)
+
+        self.assertFalse(User.get(searching_user.id).in_search)
+        self.assertNotIn(searching_user.id,
+                         [user_id for user_id, _, _ in
+                          matchmaking.get_seeks(7777)])
+
+    def tearDown(self):
+        timers.cancel(timers.batch_flush_timer('cancel_searches'))
+        conn = rom.util.get_connection()
+        for user in self.users:
+            conn.delete(matchmaking.search_token_key(user.id))
+            user.delete()
+
+
+class TestMatchSeeks(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rom.util.set_connection_settings(db=TestingConfig.REDIS_DB_ID)
+        rom.util.use_null_session()
+
+    def setUp(self):
+        self.seconds = randint(10 ** 6, 10 ** 7)
+        self.user, = create_users('seeking')
+        self.deleted_user_id = randint(10 ** 11, 10 ** 12)
+
+    def seek(self, user_id: int, rating: int) -> None:
+        matchmaking.pair_or_seek(user_id, rating, self.seconds,
+                                 matchmaking.new_search_token(user_id))
+        # Waited long enough to accept each other
+        rom.util.get_connection().hset(matchmaking.SEEKS_SINCE_KEY, user_id,
+                                       time() - 60)
+
+    def test_deleted_user(self):
+        # The seek of the deleted user is dropped, the other one waits
+        self.seek(self.deleted_user_id, 1200)
+        self.seek(self.user.id, 1500)
+        match_seeks(self.seconds)
+
+        self.assertEqual([user_id for user_id, _, _ in
+                          matchmaking.get_seeks(self.seconds)],
+                         [self.user.id])
+
+    def tearDown(self):
+        conn = rom.util.get_connection()
+        for user_id in (self.user.id, self.deleted_user_id):
+            matchmaking.cancel_seek(user_id,
+                                    matchmaking.new_search_token(user_id))
+            conn.delete(matchmaking.search_token_key(user_id))
+        timers.cancel(timers.match_seeks_timer(self.seconds))
+        self.user.delete()
+
+
+if __name__ == "__main__":
+    unittest.main()
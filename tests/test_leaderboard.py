@@ -0,0 +1,55 @@
+import unittest
+from random import randint
+import rom.util
+from hydraChess.config import TestingConfig
+from hydraChess.models import User
+from hydraChess import leaderboard
+
+
+class TestLeaderboard(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rom.util.set_connection_settings(db=TestingConfig.REDIS_DB_ID)
+
+    def setUp(self):
+        # Unique time control, so tests don't see each other's boards
+        self.seconds = randint(10 ** 6, 10 ** 7)
+        self.users = list()
+        for rating in (1500, 1200, 1800):
+            user = User(login=f'leaderboard_{self.seconds}_{rating}',
+                        rating=rating)
+            user.save()
+            self.users.append(user)
+            leaderboard.update_rating(user.id, rating, self.seconds)
+
+    def test_rank(self):
+        ranks = [leaderboard.get_rank(user.id, self.seconds)
+                 for user in self.users]
+        self.assertEqual(ranks, [2, 3, 1])
+        self.assertIsNone(leaderboard.get_rank(-1, self.seconds))
+
+        leaderboard.update_rating(self.users[1].id, 1900, self.seconds)
+        self.assertEqual(leaderboard.get_rank(self.users[1].id, self.seconds),
+                         1)
+
+    def test_top_players(self):
+        top_players = leaderboard.get_top_players(0, 2, self.seconds)
+        self.assertEqual([player['rating'] for player in top_players],
+                         [1800, 1500])
+        self.assertEqual(top_players[0]['nickname'], self.users[2].login)
+
+        top_players = leaderboard.get_top_players(2, 2, self.seconds)
+        self.assertEqual(top_players, [{'rank': 3,
+                                        'nickname': self.users[1].login,
+                                        'rating': 1200}])
+
+    def tearDown(self):
+        conn = rom.util.get_connection()
+        conn.delete(leaderboard.board_key(self.seconds))
+        for user in self.users:
+            conn.zrem(leaderboard.board_key(), user.id)
+            user.delete()
+
+
+if __name__ == "__main__":
+    unittest.main()
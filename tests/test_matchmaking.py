@@ -0,0 +1,121 @@
+import unittest
+from random import randint
+import rom.util
+from hydraChess.config import TestingConfig
+from hydraChess import matchmaking
+
+
+class TestOrderBook(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rom.util.set_connection_settings(db=TestingConfig.REDIS_DB_ID)
+
+    def setUp(self):
+        # Unique time control, so tests don't see each other's seeks
+        self.seconds = randint(10 ** 6, 10 ** 7)
+        self.first_user_id = randint(10 ** 9, 10 ** 10)
+        self.user_ids = list()
+
+    def seek(self, rating: int):
+        user_id = self.first_user_id + len(self.user_ids)
+        self.user_ids.append(user_id)
+        token = matchmaking.new_search_token(user_id)
+        return user_id, matchmaking.pair_or_seek(user_id, rating, self.seconds,
+                                                 token)
+
+    def cancel(self, user_id: int) -> bool:
+        return matchmaking.cancel_seek(
+            user_id, matchmaking.new_search_token(user_id))
+
+    def test_nearest_opponent(self):
+        user_1000, _ = self.seek(1000)
+        user_1500, _ = self.seek(1500)
+        user_1900, _ = self.seek(1900)
+
+        _, opp_id = self.seek(1650)
+        self.assertEqual(opp_id, user_1500)
+
+        _, opp_id = self.seek(1750)
+        self.assertEqual(opp_id, user_1900)
+
+        _, opp_id = self.seek(1101)
+        self.assertEqual(opp_id, user_1000)
+
+    def test_rating_window(self):
+        _, opp_id = self.seek(1200)
+        self.assertIsNone(opp_id)
+
+        _, opp_id = self.seek(1200 + matchmaking.MAX_RATING_DIFF + 1)
+        self.assertIsNone(opp_id)
+
+    def test_cancel_seek(self):
+        user_id, _ = self.seek(1200)
+
+        self.assertEqual(self.cancel(user_id), True)
+        self.assertEqual(self.cancel(user_id), False)
+
+        _, opp_id = self.seek(1200)
+        self.assertIsNone(opp_id)
+
+    def test_seeking_twice(self):
+        user_id, _ = self.seek(1200)
+        token = matchmaking.new_search_token(user_id)
+        self.assertIsNone(
+            matchmaking.pair_or_seek(user_id, 1200, self.seconds, token))
+
+    def test_cancel_before_search(self):
+        # The cancel runs before the search requested before it
+        user_id = self.first_user_id
+        self.user_ids.append(user_id)
+        search_token = matchmaking.new_search_token(user_id)
+        cancel_token = matchmaking.new_search_token(user_id)
+        self.assertFalse(matchmaking.cancel_seek(user_id, cancel_token))
+        self.assertIsNone(matchmaking.pair_or_seek(user_id, 1200, self.seconds,
+                                                   search_token))
+
+        _, opp_id = self.seek(1200)
+        self.assertIsNone(opp_id)
+
+    def test_cancel_after_next_search(self):
+        # The cancel runs after the search requested after it
+        user_id = self.first_user_id
+        self.user_ids.append(user_id)
+        cancel_token = matchmaking.new_search_token(user_id)
+        search_token = matchmaking.new_search_token(user_id)
+        matchmaking.pair_or_seek(user_id, 1200, self.seconds, search_token)
+        self.assertFalse(matchmaking.cancel_seek(user_id, cancel_token))
+
+        _, opp_id = self.seek(1200)
+        self.assertEqual(opp_id, user_id)
+
+    def tearDown(self):
+        conn = rom.util.get_connection()
+        for user_id in self.user_ids:
+            self.cancel(user_id)
+            conn.delete(matchmaking.search_token_key(user_id))
+
+
+class TestPairing(unittest.TestCase):
+    def test_window_widening(self):
+        seeks = [(1, 1000, 0), (2, 1500, 0)]
+        self.assertEqual(matchmaking.pair_seeks(seeks), [])
+
+        seeks = [(1, 1000, 60), (2, 1500, 40)]
+        self.assertEqual(matchmaking.pair_seeks(seeks), [(1, 2)])
+
+    def test_most_pairs_with_least_difference(self):
+        seeks = [(1, 1000, 0), (2, 1100, 0), (3, 1150, 0), (4, 1250, 0)]
+        self.assertEqual(sorted(matchmaking.pair_seeks(seeks)),
+                         [(1, 2), (3, 4)])
+
+        seeks = [(1, 1000, 0), (2, 1100, 0), (3, 1120, 0)]
+        self.assertEqual(matchmaking.pair_seeks(seeks), [(2, 3)])
+
+    def test_skipping_seek(self):
+        # The middle seek doesn't accept anyone yet, but others do
+        seeks = [(1, 1000, 40), (2, 1300, 0), (3, 1550, 40)]
+        self.assertEqual(matchmaking.pair_seeks(seeks), [(1, 3)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,10 @@
 import unittest
 from datetime import timedelta
-from chess import Board, WHITE, BLACK
+from chess import Board, Move, WHITE, BLACK, QUEEN, KNIGHT
 import rom.util
-from hydraChess.models import User, Game
+from hydraChess.models import User, Game, pack_move, unpack_moves, \
+    get_game_info, compute_rating_changes, migrate_raw_moves
+from hydraChess.board_cache import board_cache
 from hydraChess.config import TestingConfig
 
 
@@ -86,6 +88,119 @@ class TestGame(unittest.TestCase):
 
         self.assertEqual(game.get_board(), expected_board)
 
+    def test_board_snapshot(self):
+        game = Game()
+        game.save()
+        self.used_game_ids.append(game.id)
+
+        # The capture resets the snapshot, knights' moves repeat the position
+        moves = ['e4', 'd5', 'exd5', 'Nf6', 'Nf3', 'Ng8', 'Ng1', 'Nf6']
+
+        expected_board = Board()
+        board = game.get_board()
+        for move in moves:
+            expected_board.push_san(move)
+            game.push_san(board, move)
+        game.save()
+
+        self.assertEqual(game.board_fen_ply, 3)
+
+        board_cache.clear()
+        game = Game.get(game.id)
+        board = game.get_board()
+
+        self.assertEqual(board, expected_board)
+        self.assertEqual(board.is_repetition(2), True)
+        self.assertEqual(game.get_board(), expected_board)
+
+    def test_pack_and_unpack_moves(self):
+        moves = [Move.from_uci('e2e4'), Move.from_uci('a7a8q'),
+                 Move(QUEEN, KNIGHT, KNIGHT), Move.from_uci('h2h1n')]
+        packed_moves = b"".join(map(pack_move, moves))
+
+        self.assertEqual(len(packed_moves), 2 * len(moves))
+        self.assertEqual(unpack_moves(packed_moves), moves)
+
+    def test_raw_moves_migration(self):
+        game = Game(raw_moves='e4,e5,Nf3,Nc6')
+        game.save()
+        self.used_game_ids.append(game.id)
+
+        game = Game.get(game.id)
+        self.assertEqual(game.get_moves_cnt(), 4)
+        game.save()
+
+        game = Game.get(game.id)
+        self.assertEqual(game.raw_moves, "")
+        self.assertEqual(game.moves, ['e4', 'e5', 'Nf3', 'Nc6'])
+
+    def test_migrating_game_without_moves(self):
+        game = Game(is_started=True)
+        game.save()
+        self.used_game_ids.append(game.id)
+        rom.session.forget(game)
+        # Games created before moves_cnt have no field of it
+        conn = rom.util.get_connection()
+        conn.hdel(f'Game:{game.id}', 'moves_cnt')
+
+        self.assertGreaterEqual(migrate_raw_moves(), 1)
+        self.assertEqual(conn.hget(f'Game:{game.id}', 'moves_cnt'), b'0')
+
+    def test_game_info(self):
+        game = Game()
+        game.save()
+        self.used_game_ids.append(game.id)
+
+        info = get_game_info(game.id)
+        self.assertEqual(info['moves'], '')
+        self.assertEqual(info['is_finished'], False)
+
+        game.moves = ['e4', 'e5']
+        game.draw_offer_sender = 1
+        game.save()
+
+        new_info = get_game_info(game.id)
+        self.assertEqual(new_info['moves'], 'e4,e5')
+        self.assertEqual(new_info['draw_offer_sender'], 1)
+        self.assertGreater(new_info['version'], info['version'])
+
+        # Snapshot is rebuilt, if it's missing
+        rom.util.get_connection().delete(game.info_key)
+        game.draw_offer_sender = None
+        game.save()
+        info = get_game_info(game.id)
+        self.assertEqual(info['moves'], 'e4,e5')
+        self.assertNotIn('draw_offer_sender', info)
+
+    def test_rating_changes(self):
+        white_user = User(login='rating_changes_white', rating=1400)
+        white_user.save()
+        self.used_user_ids.append(white_user.id)
+        black_user = User(login='rating_changes_black', k_factor=20)
+        black_user.save()
+        self.used_user_ids.append(black_user.id)
+
+        rating_changes = compute_rating_changes(1400, 40, 1200, 20)
+        self.assertEqual(rating_changes['w'].to_dict(),
+                         {'win': 10, 'draw': -10, 'lose': -30})
+        self.assertEqual(rating_changes['b'].to_dict(),
+                         {'win': 16, 'draw': 6, 'lose': -4})
+
+        game = Game(white_user=white_user, black_user=black_user)
+        game.rating_changes = rating_changes
+        game.save()
+        self.used_game_ids.append(game.id)
+
+        # Stakes don't drift, if ratings change during the game
+        white_user.rating = 2000
+        white_user.save()
+
+        game = Game.get(game.id)
+        self.assertEqual(game.rating_changes['w'].to_dict(),
+                         rating_changes['w'].to_dict())
+        self.assertEqual(get_game_info(game.id)['rating_changes']['b'],
+                         rating_changes['b'].to_dict())
+
     def tearDown(self):
         for game_id in self.used_game_ids:
             game = Game.get(game_id)
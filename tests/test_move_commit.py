@@ -0,0 +1,187 @@
+import unittest
+from datetime import datetime, timedelta
+import rom.util
+from chess import Board
+from hydraChess.models import Game, get_game_info
+from hydraChess.move_commit import load_move_context, commit_move, \
+    prevalidate_move
+from hydraChess.board_cache import board_cache
+from hydraChess import move_commit, timers
+from tests.helpers import GameTestCase
+
+
+class TestMoveCommit(GameTestCase):
+    def setUp(self):
+        super().setUp()
+        self.game.white_clock = timedelta(seconds=60)
+        self.game.black_clock = timedelta(seconds=60)
+        self.game.save()
+        self.game_id = self.game.id
+
+    def commit(self, user, move_san, request_datetime, **kwargs):
+        context = load_move_context(self.game_id)
+        move = context.board.parse_san(move_san)
+        return commit_move(context, user.id, move, request_datetime,
+                           **kwargs)
+
+    def test_commit_moves(self):
+        start = datetime.utcnow()
+        first_move_eta = start + timedelta(seconds=15)
+
+        clocks = self.commit(self.white_user, 'e4', start,
+                             first_move_eta=first_move_eta)
+        self.assertEqual(clocks, (timedelta(seconds=60),
+                                  timedelta(seconds=60)))
+        self.assertEqual(
+            timers.get_eta(timers.first_move_timer(self.game_id)),
+            first_move_eta)
+
+        clocks = self.commit(self.black_user, 'e5',
+                             start + timedelta(seconds=2, microseconds=5))
+        self.assertEqual(clocks, (timedelta(seconds=60),
+                                  timedelta(seconds=57, microseconds=999995)))
+        self.assertIsNone(
+            timers.get_eta(timers.first_move_timer(self.game_id)))
+        self.assertEqual(
+            timers.get_eta(timers.time_is_up_timer(self.game_id)),
+            start + timedelta(seconds=62, microseconds=5))
+
+        board_cache.clear()
+        game = Game.get(self.game_id)
+        self.assertEqual(game.moves, ['e4', 'e5'])
+        self.assertEqual(game.black_clock,
+                         timedelta(seconds=57, microseconds=999995))
+        self.assertEqual(game.last_move_datetime,
+                         start + timedelta(seconds=2, microseconds=5))
+        self.assertEqual(game.board_fen, game.get_board().fen())
+
+        info = get_game_info(self.game_id)
+        self.assertEqual(info['moves'], 'e4,e5')
+        self.assertEqual(info['moves_cnt'], 2)
+        self.assertEqual(info['black_clock'], game.raw_black_clock)
+        self.assertEqual(info['white_user']['nickname'],
+                         self.white_user.login)
+
+    def test_clock_exact_microseconds(self):
+        # Difference of these timestamps as floats is below 2.000005 seconds
+        start = datetime(2026, 10, 16, 12, 0, 0, 49)
+        self.commit(self.white_user, 'e4', start)
+        clocks = self.commit(self.black_user, 'e5',
+                             start + timedelta(seconds=2, microseconds=5))
+        self.assertEqual(clocks[1], timedelta(seconds=57, microseconds=999995))
+
+    def make_legacy(self, raw_moves: str) -> None:
+        '''Turns the game into one created before moves were packed'''
+        conn = rom.util.get_connection()
+        conn.hdel(f'Game:{self.game_id}', 'moves_cnt', 'board_fen',
+                  'board_fen_ply')
+        conn.hset(f'Game:{self.game_id}', 'raw_moves', raw_moves)
+        conn.delete(f'Game:{self.game_id}:moves')
+        board_cache.discard(self.game_id)
+
+    def test_legacy_game(self):
+        self.make_legacy('e4,e5')
+
+        context = load_move_context(self.game_id)
+        self.assertEqual(context.ply, 2)
+        board = Board()
+        board.push_san('e4')
+        board.push_san('e5')
+        self.assertEqual(context.board, board)
+        self.assertIsNotNone(self.commit(self.white_user, 'Nf3',
+                                         datetime.utcnow()))
+        self.assertEqual(Game.get(self.game_id).moves, ['e4', 'e5', 'Nf3'])
+
+    def test_prevalidate_legacy_game(self):
+        # Forwarded to workers, which migrate the game
+        self.make_legacy('')
+        self.assertIsNone(
+            prevalidate_move(self.white_user.id, self.game_id, 'e4'))
+        self.make_legacy('e4')
+        self.assertIsNone(
+            prevalidate_move(self.black_user.id, self.game_id, 'e5'))
+
+    def test_rejected_moves(self):
+        now = datetime.utcnow()
+
+        # Not user's turn
+        self.assertIsNone(self.commit(self.black_user, 'e4', now))
+
+        # Another move was committed since the context was read
+        context = load_move_context(self.game_id)
+        stale_context = load_move_context(self.game_id)
+        move = context.board.parse_san('e4')
+        self.assertIsNotNone(
+            commit_move(context, self.white_user.id, move, now))
+        self.assertIsNone(
+            commit_move(stale_context, self.white_user.id, move, now))
+
+        self.assertEqual(Game.get(self.game_id).moves, ['e4'])
+
+    def test_stale_game_saved_after_commit(self):
+        start = datetime.utcnow()
+        stale_game = Game.get(self.game_id)
+
+        self.commit(self.white_user, 'e4', start)
+        self.commit(self.black_user, 'e5', start + timedelta(seconds=1))
+        stale_game.draw_offer_sender = self.white_user.id
+        stale_game.save()
+
+        info = get_game_info(self.game_id)
+        self.assertEqual(info['moves'], 'e4,e5')
+        self.assertEqual(info['moves_cnt'], 2)
+        self.assertEqual(info['black_clock'], '59.0')
+        self.assertIsNotNone(info['last_move_datetime'])
+        self.assertEqual(info['draw_offer_sender'], self.white_user.id)
+
+    def test_draw_offer_declined(self):
+        self.game.draw_offer_sender = self.black_user.id
+        self.game.save()
+
+        self.commit(self.white_user, 'e4', datetime.utcnow())
+        self.assertIsNone(Game.get(self.game_id).draw_offer_sender)
+
+    def test_prevalidate_move(self):
+        game_id = self.game_id
+        white_id, black_id = self.white_user.id, self.black_user.id
+
+        self.assertEqual(prevalidate_move(white_id, 10 ** 12, 'e4'),
+                         move_commit.GAME_NOT_FOUND)
+        self.assertEqual(prevalidate_move(10 ** 12, game_id, 'e4'),
+                         move_commit.NOT_PLAYER)
+        self.assertEqual(prevalidate_move(black_id, game_id, 'e5'),
+                         move_commit.NOT_YOUR_TURN)
+        self.assertEqual(prevalidate_move(white_id, game_id, 'e5'),
+                         move_commit.ILLEGAL_MOVE)
+        self.assertEqual(prevalidate_move(white_id, game_id, 'junk'),
+                         move_commit.ILLEGAL_MOVE)
+        self.assertIsNone(prevalidate_move(white_id, game_id, 'e4'))
+        self.assertEqual(prevalidate_move(white_id, game_id, 'd4'),
+                         move_commit.MOVE_ALREADY_SENT)
+
+        # Sending of the move failed, so it's retried at once
+        move_commit.forget_forwarded_move(game_id)
+        self.assertIsNone(prevalidate_move(white_id, game_id, 'd4'))
+
+        # The cached board catches up with moves made since
+        self.commit(self.white_user, 'e4', datetime.utcnow())
+        self.commit(self.black_user, 'e5', datetime.utcnow())
+        board_cache.put(game_id, 0, Board())
+        self.assertEqual(prevalidate_move(white_id, game_id, 'e4'),
+                         move_commit.ILLEGAL_MOVE)
+        self.assertIsNone(prevalidate_move(white_id, game_id, 'Nf3'))
+
+        self.game = Game.get(game_id)
+        self.game.is_finished = True
+        self.game.save()
+        self.assertEqual(prevalidate_move(white_id, game_id, 'Nf3'),
+                         move_commit.GAME_IS_OVER)
+
+    def tearDown(self):
+        timers.cancel(timers.first_move_timer(self.game_id),
+                      timers.time_is_up_timer(self.game_id))
+        super().tearDown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+import gzip
+import io
+from datetime import datetime
+import chess.pgn
+import gevent
+import rom.util
+from hydraChess.models import RatingChange
+from hydraChess.settlement import settle_game
+from hydraChess import game_history, leaderboard, pgn_export
+from tests.helpers import GameTestCase
+
+
+class TestPgnExport(GameTestCase):
+    white_user_kwargs = {'rating': 1300}
+    game_kwargs = {'white_rating': 1300, 'black_rating': 1200}
+
+    def setUp(self):
+        super().setUp()
+        self.moves = ['f3', 'e5', 'g4', 'Qh4#']
+        self.game.moves = self.moves
+        self.game.rating_changes = {'w': RatingChange(20, 0, -20),
+                                    'b': RatingChange(20, 0, -20)}
+        self.game.save()
+        settle_game(self.game, '0-1', end_datetime=datetime(2020, 5, 1))
+
+    def read_games(self, pgn: str) -> list:
+        games = []
+        pgn = io.StringIO(pgn)
+        while True:
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                return games
+            games.append(game)
+
+    def test_user_export(self):
+        game_ids = pgn_export.iter_user_game_ids(self.white_user.id,
+                                                 batch_size=1)
+        pgn = ''.join(pgn_export.export_pgn(game_ids))
+
+        games = self.read_games(pgn)
+        self.assertEqual(len(games), 1)
+        headers = games[0].headers
+        self.assertEqual(headers['White'], self.white_user.login)
+        self.assertEqual(headers['Black'], self.black_user.login)
+        self.assertEqual(headers['Result'], '0-1')
+        self.assertEqual(headers['WhiteElo'], '1300')
+        self.assertEqual(headers['Date'], '2020.05.01')
+        self.assertEqual(
+            [move.san() for move in games[0].mainline()], self.moves)
+
+    def test_export_yields_to_greenlets(self):
+        game_ids = pgn_export.iter_user_game_ids(self.white_user.id)
+        chunks = pgn_export.export_pgn(game_ids)
+        greenlet = gevent.spawn(lambda: None)
+        next(chunks)
+        self.assertFalse(greenlet.dead)
+        next(chunks, None)
+        self.assertTrue(greenlet.dead)
+
+    def test_all_games_export(self):
+        self.assertIn(self.game.id, pgn_export.iter_all_game_ids(2))
+
+    def test_gzip(self):
+        chunks = ['[Event "?"]\n'] * 1000
+        data = b''.join(pgn_export.gzip_stream(chunks))
+        self.assertEqual(gzip.decompress(data).decode(), ''.join(chunks))
+
+    def tearDown(self):
+        conn = rom.util.get_connection()
+        for user in (self.white_user, self.black_user):
+            conn.delete(*conn.keys(game_history.history_key(user.id) + '*'))
+            conn.zrem(leaderboard.board_key(), user.id)
+        super().tearDown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+from hydraChess import routing
+
+
+class TestRouting(unittest.TestCase):
+    def test_jump_hash(self):
+        for key in range(1000):
+            bucket = routing.jump_hash(key, 10)
+            self.assertTrue(0 <= bucket < 10)
+
+        # Adding a bucket moves keys only to the new bucket
+        for key in range(1000):
+            bucket = routing.jump_hash(key, 11)
+            self.assertIn(bucket, (routing.jump_hash(key, 10), 10))
+
+    def test_game_tasks_of_one_game(self):
+        game_id = 42
+        queue = routing.game_queue(game_id)
+
+        routes = [
+            routing.route_task('make_move', (1, game_id, 'e4'), {}, {}),
+            routing.route_task('resign', (1, game_id), {}, {}),
+            routing.route_task('send_game_info', (game_id, 'sid', True),
+                               {}, {}),
+            routing.route_task('end_game', (game_id, '1-0', 'Checkmate.'),
+                               {'update_stats': False}, {}),
+            routing.route_task('on_time_is_up', [1, game_id], {}, {}),
+            routing.route_task('start_game', (), {'game_id': game_id}, {}),
+        ]
+        for route in routes:
+            self.assertEqual(route, {'queue': queue})
+
+    def test_other_tasks(self):
+        self.assertEqual(routing.route_task('search_game', (1, 60), {}, {}),
+                         {'queue': routing.search_queue(60)})
+        self.assertIsNone(routing.route_task('cancel_search', (1, ), {}, {}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+from datetime import timedelta
+import rom.util
+from hydraChess.models import User, Game, RatingChange, get_game_info
+from hydraChess.settlement import settle_game
+from hydraChess import leaderboard
+from tests.helpers import GameTestCase
+
+
+class TestSettlement(GameTestCase):
+    white_user_kwargs = {'rating': 2390, 'k_factor': 20, 'games_played': 10}
+    black_user_kwargs = {'games_played': 29}
+
+    def setUp(self):
+        super().setUp()
+        self.game.rating_changes = {'w': RatingChange(15, 5, -5),
+                                    'b': RatingChange(5, -5, -15)}
+        self.game.save()
+
+        for user in (self.white_user, self.black_user):
+            user.cur_game_id = self.game.id
+            user.save()
+
+    def test_settle_game(self):
+        self.assertEqual(settle_game(self.game, '1-0'), True)
+
+        white_user = User.get(self.white_user.id)
+        black_user = User.get(self.black_user.id)
+        self.assertEqual(white_user.rating, 2405)
+        self.assertEqual(black_user.rating, 1185)
+        self.assertEqual(white_user.games_played, 11)
+        self.assertEqual(black_user.games_played, 30)
+        self.assertIsNone(white_user.cur_game_id)
+        self.assertIsNone(black_user.cur_game_id)
+
+        # FIDE rules
+        self.assertEqual(white_user.k_factor, 10)
+        self.assertEqual(black_user.k_factor, 20)
+
+        conn = rom.util.get_connection()
+        self.assertEqual(
+            conn.zscore(leaderboard.board_key(), self.white_user.id), 2405)
+
+        game = Game.get(self.game.id)
+        self.assertEqual(game.is_finished, True)
+        self.assertEqual(game.result, '1-0')
+        self.assertEqual(get_game_info(game.id)['result'], '1-0')
+
+        # The game is settled only once
+        self.assertEqual(settle_game(self.game, '0-1'), False)
+        self.assertEqual(User.get(self.white_user.id).rating, 2405)
+
+    def test_time_control_boards(self):
+        self.game.total_clock = timedelta(seconds=60)
+        self.game.save()
+        conn = rom.util.get_connection()
+        conn.zadd(leaderboard.board_key(300), {self.white_user.id: 2390})
+
+        settle_game(self.game, '1-0', time_control_boards=True)
+
+        for seconds in (60, 300):
+            self.assertEqual(
+                conn.zscore(leaderboard.board_key(seconds),
+                            self.white_user.id), 2405)
+        self.assertEqual(
+            conn.zscore(leaderboard.board_key(60), self.black_user.id), 1185)
+        # The black player hasn't played 5 minutes games
+        self.assertIsNone(
+            conn.zscore(leaderboard.board_key(300), self.black_user.id))
+
+    def test_without_stats(self):
+        self.assertEqual(settle_game(self.game, '-', update_stats=False),
+                         True)
+
+        white_user = User.get(self.white_user.id)
+        self.assertEqual(white_user.rating, 2390)
+        self.assertEqual(white_user.games_played, 10)
+        self.assertIsNone(white_user.cur_game_id)
+
+    def tearDown(self):
+        conn = rom.util.get_connection()
+        for seconds in (None, ) + leaderboard.TIME_CONTROLS:
+            conn.zrem(leaderboard.board_key(seconds),
+                      self.white_user.id, self.black_user.id)
+        super().tearDown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+from datetime import datetime, timedelta
+from uuid import uuid4
+import rom.util
+from hydraChess.config import TestingConfig
+from hydraChess import task_batching, timers
+
+
+class TestTaskBatching(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rom.util.set_connection_settings(db=TestingConfig.REDIS_DB_ID)
+
+    def setUp(self):
+        self.name = f'test_{uuid4().hex}'
+
+    def test_add_and_take(self):
+        self.assertTrue(task_batching.add(self.name, 1, 'a'))
+        self.assertFalse(task_batching.add(self.name, 2, 'b'))
+        self.assertFalse(task_batching.add(self.name, 3, 'c'))
+
+        self.assertEqual(task_batching.take(self.name, 2),
+                         ([[1, 'a'], [2, 'b']], True))
+        self.assertEqual(task_batching.take(self.name, 2), ([[3, 'c']], False))
+        self.assertEqual(task_batching.take(self.name), ([], False))
+
+        # Taken batch is flushed again by the next call
+        self.assertTrue(task_batching.add(self.name, 4, 'd'))
+
+    def test_resend(self):
+        flushes = sum(task_batching.add(self.name, i)
+                      for i in range(task_batching.BATCH_SIZE * 2))
+        self.assertEqual(flushes, 2)
+
+    def test_flush_timer(self):
+        # Flushes the batch, if the message of the flush task is lost
+        start = datetime.utcnow()
+        task_batching.add(self.name, 1)
+        timer = timers.batch_flush_timer(self.name)
+        eta = timers.get_eta(timer)
+        self.assertGreaterEqual(
+            eta, start + timedelta(seconds=task_batching.FLUSH_DELAY))
+
+        task_batching.add(self.name, 2)
+        self.assertEqual(timers.get_eta(timer), eta)
+
+        claimed = timers.claim_expired(
+            eta + timedelta(seconds=1), limit=10 ** 6)
+        self.assertIn((timer, self.name, []), claimed)
+        timers.release(timer)
+
+    def tearDown(self):
+        rom.util.get_connection().delete(task_batching.batch_key(self.name))
+        timers.cancel(timers.batch_flush_timer(self.name))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+from datetime import datetime, timedelta
+from random import randint
+import rom.util
+from hydraChess.config import TestingConfig
+from hydraChess import timers
+
+
+class TestTimers(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rom.util.set_connection_settings(db=TestingConfig.REDIS_DB_ID)
+
+    def setUp(self):
+        self.game_id = randint(10 ** 9, 10 ** 10)
+        self.names = [timers.first_move_timer(self.game_id),
+                      timers.time_is_up_timer(self.game_id)]
+
+    def test_arm_and_cancel(self):
+        name = timers.time_is_up_timer(self.game_id)
+        eta = datetime.utcnow() + timedelta(minutes=5)
+
+        self.assertIsNone(timers.get_eta(name))
+
+        timers.arm(name, eta, 'on_time_is_up', (1, self.game_id))
+        self.assertEqual(timers.get_eta(name), eta)
+
+        eta += timedelta(minutes=1)
+        timers.arm(name, eta, 'on_time_is_up', (2, self.game_id))
+        self.assertEqual(timers.get_eta(name), eta)
+
+        timers.cancel(name)
+        self.assertIsNone(timers.get_eta(name))
+
+    def test_claim_and_release(self):
+        now = datetime.utcnow()
+        timers.arm(self.names[0], now + timedelta(minutes=5),
+                   'on_first_move_timed_out', (self.game_id, ))
+        timers.arm(self.names[1], now - timedelta(seconds=1),
+                   'on_time_is_up', (1, self.game_id))
+
+        claimed = timers.claim_expired(now)
+        self.assertIn((self.names[1], 'on_time_is_up', [1, self.game_id]),
+                      claimed)
+        self.assertNotIn(self.names[0], [name for name, _, _ in claimed])
+
+        self.assertIsNone(timers.get_eta(self.names[1]))
+        self.assertIsNotNone(timers.get_eta(self.names[0]))
+
+        # Leased, so it isn't claimed again
+        claimed = timers.claim_expired(now)
+        self.assertNotIn(self.names[1], [name for name, _, _ in claimed])
+
+        timers.release(self.names[1])
+        claimed = timers.claim_expired(
+            now + timedelta(seconds=timers.LEASE_SECONDS + 1))
+        self.assertNotIn(self.names[1], [name for name, _, _ in claimed])
+
+    def test_expired_lease(self):
+        # The poller crashed before the task was sent
+        now = datetime.utcnow()
+        timers.arm(self.names[1], now - timedelta(seconds=1),
+                   'on_time_is_up', (1, self.game_id))
+        timers.claim_expired(now)
+
+        claimed = timers.claim_expired(
+            now + timedelta(seconds=timers.LEASE_SECONDS + 1))
+        self.assertIn((self.names[1], 'on_time_is_up', [1, self.game_id]),
+                      claimed)
+
+    def test_rearmed_while_claimed(self):
+        now = datetime.utcnow()
+        timers.arm(self.names[1], now - timedelta(seconds=1),
+                   'on_time_is_up', (1, self.game_id))
+        timers.claim_expired(now)
+
+        eta = now + timedelta(minutes=1)
+        timers.arm(self.names[1], eta, 'on_time_is_up', (2, self.game_id),
+                   only_new=True)
+        timers.release(self.names[1])
+        self.assertEqual(timers.get_eta(self.names[1]), eta)
+
+        claimed = timers.claim_expired(eta)
+        self.assertIn((self.names[1], 'on_time_is_up', [2, self.game_id]),
+                      claimed)
+
+    def test_poller_crash(self):
+        game_id = self.game_id
+
+        class Celery:
+            def send_task(self, task_name, args):
+                if task_name == 'on_time_is_up' and game_id in args:
+                    raise ConnectionError
+
+        now = datetime.utcnow()
+        timers.arm(self.names[0], now - timedelta(seconds=2),
+                   'on_first_move_timed_out', (game_id, ))
+        timers.arm(self.names[1], now - timedelta(seconds=1),
+                   'on_time_is_up', (1, game_id))
+        with self.assertRaises(ConnectionError):
+            timers.run_poller(Celery())
+
+        claimed = timers.claim_expired(
+            datetime.utcnow() + timedelta(seconds=timers.LEASE_SECONDS + 1))
+        self.assertIn((self.names[1], 'on_time_is_up', [1, game_id]),
+                      claimed)
+        self.assertNotIn(self.names[0], [name for name, _, _ in claimed])
+
+    def tearDown(self):
+        timers.cancel(*self.names)
+        timers.release(*self.names)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+from random import randint
+from time import sleep
+import rom.util
+from hydraChess.config import TestingConfig
+from hydraChess.models import User
+from hydraChess.user_cache import UserCache
+from hydraChess import entity_session
+
+
+class TestUserCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        entity_session.set_connection_settings(db=TestingConfig.REDIS_DB_ID)
+        rom.util.use_null_session()
+
+    def setUp(self):
+        self.user = User(login=f'user_{randint(10 ** 9, 10 ** 10)}')
+        self.user.save()
+        self.cache = UserCache()
+        self.cache.ensure_listener()
+        sleep(0.1)  # Until the listener is subscribed
+
+    def wait_for(self, condition) -> bool:
+        for _ in range(50):
+            if condition():
+                return True
+            sleep(0.02)
+        return False
+
+    def test_cached_user(self):
+        user = self.cache.get(self.user.id)
+        round_trips = entity_session.counters.round_trips
+        self.assertIs(self.cache.get(self.user.id), user)
+        self.assertEqual(entity_session.counters.round_trips, round_trips)
+        self.assertIsNone(self.cache.get(10 ** 11))
+
+    def test_changes_invalidate_user(self):
+        self.cache.get(self.user.id)
+
+        user = User.get(self.user.id)
+        user.cur_game_id = 1
+        user.save()
+        self.assertTrue(self.wait_for(
+            lambda: self.cache.get(self.user.id).cur_game_id == 1))
+
+        user.set_sid('sid')
+        self.assertTrue(self.wait_for(
+            lambda: self.cache.get(self.user.id).sid == 'sid'))
+
+    def test_expired_user(self):
+        cache = UserCache(ttl=0)
+        user = cache.get(self.user.id)
+        self.assertIsNot(cache.get(self.user.id), user)
+
+    def test_max_size(self):
+        another_user = User(login=f'user_{randint(10 ** 9, 10 ** 10)}')
+        another_user.save()
+
+        cache = UserCache(max_size=1)
+        cache.get(self.user.id)
+        cache.get(another_user.id)
+        self.assertEqual(list(cache._users), [another_user.id])
+        another_user.delete()
+
+    def tearDown(self):
+        self.user.delete()
+
+
+if __name__ == "__main__":
+    unittest.main()